@@ -63,14 +63,14 @@ class ConfigActionTest(client_test_lib.EmptyActionTest):
 
     # Now test that our location was actually updated.
 
-    def FakeUrlOpen(url=None, data=None, **_):
+    def FakeUrlOpen(unused_session, url=None, data=None, **_):
       self.urls.append(url)
       response = requests.Response()
       response.status_code = 200
       response._content = data
       return response
 
-    with utils.Stubber(requests, "request", FakeUrlOpen):
+    with utils.Stubber(requests.Session, "request", FakeUrlOpen):
       client_context = comms.GRRHTTPClient(worker_cls=MockClientWorker)
       client_context.MakeRequest("")
 
@@ -69,17 +69,21 @@ Examples:
 """
 
 import collections
+import hashlib
 import itertools
 import logging
 import os
 import pdb
 import posixpath
 import Queue
+import re
 import signal
+import struct
 import sys
 import threading
 import time
 import traceback
+import urlparse
 
 
 import psutil
@@ -117,6 +121,8 @@ class HTTPObject(object):
     self.code = code
     # Contains the decoded data from the 'control' endpoint.
     self.messages = self.source = self.nonce = None
+    # The poll interval the server asks for, if it is loaded.
+    self.min_poll_interval = 0
     self.duration = duration
 
   def Success(self):
@@ -156,6 +162,42 @@ class HTTPManager(object):
     self.active_base_url = None
     self.error_poll_min = config.CONFIG["Client.error_poll_min"]
 
+    # Requests to the same server reuse connections through these sessions,
+    # keyed by the scheme and network location of the URL.
+    self.keep_alive = config.CONFIG["Client.http_keep_alive"]
+    self.sessions = {}
+
+  def _GetSession(self, url):
+    """Returns the session used for requests to url."""
+    if not self.keep_alive:
+      return requests.Session()
+
+    key = urlparse.urlparse(url)[:2]
+    try:
+      return self.sessions[key]
+    except KeyError:
+      session = self.sessions[key] = requests.Session()
+      return session
+
+  def _CloseSession(self, url):
+    """Closes the connections used for requests to url."""
+    session = self.sessions.pop(urlparse.urlparse(url)[:2], None)
+    if session is not None:
+      session.close()
+
+  def _CountConnections(self, session):
+    """Returns the number of connections the session has opened so far."""
+    count = 0
+    for adapter in session.adapters.itervalues():
+      managers = [getattr(adapter, "poolmanager", None)]
+      managers.extend(getattr(adapter, "proxy_manager", {}).itervalues())
+      for manager in managers:
+        pools = getattr(manager, "pools", {})
+        for key in pools.keys():
+          count += getattr(pools[key], "num_connections", 0)
+
+    return count
+
   def _GetBaseURLs(self):
     """Gathers a list of base URLs we will try."""
     result = config.CONFIG["Client.server_urls"]
@@ -203,8 +245,8 @@ class HTTPManager(object):
                          timeout=None):
     """Search through all the base URLs to connect to one that works.
 
-    This is a thin wrapper around requests.request() so most parameters are
-    documented there.
+    This is a thin wrapper around requests.Session.request() so most
+    parameters are documented there.
 
     Args:
       path: The URL path to access in this endpoint.
@@ -364,7 +406,7 @@ class HTTPManager(object):
 
     Args:
       timeout: Timeout for retry.
-      **request_args: Args to the requests.request call.
+      **request_args: Args to the requests.Session.request call.
 
     Returns:
       a tuple of duration, urllib2.urlopen response.
@@ -376,7 +418,17 @@ class HTTPManager(object):
         if not timeout:
           timeout = config.CONFIG["Client.http_timeout"]
 
-        result = requests.request(**request_args)
+        session = self._GetSession(request_args["url"])
+        connections = self._CountConnections(session)
+        try:
+          result = session.request(**request_args)
+        finally:
+          stats.STATS.IncrementCounter("grr_client_http_requests")
+          if self._CountConnections(session) > connections:
+            stats.STATS.IncrementCounter("grr_client_http_connections")
+          if not self.keep_alive:
+            session.close()
+
         # By default requests doesn't raise on HTTP error codes.
         result.raise_for_status()
 
@@ -390,6 +442,12 @@ class HTTPManager(object):
       # Catch any exceptions that dont have a code (e.g. socket.error).
       except IOError as e:
         self.consecutive_connection_errors += 1
+        # Don't reuse connections that might be broken, especially when
+        # failing over to a different server or proxy. Error responses from
+        # the server leave the connection intact.
+        if getattr(e, "response", None) is None:
+          self._CloseSession(request_args["url"])
+
         # Request failed. If we connected successfully before we attempt a few
         # connections before we determine that it really failed. This might
         # happen if the front end is loaded and returns a few throttling 500
@@ -457,6 +515,10 @@ class Timer(object):
     """Switch to slow poll mode."""
     self.sleep_time = self.poll_max
 
+  def Backoff(self, min_sleep_time):
+    """Sleep for at least min_sleep_time, but no longer than poll_max."""
+    self.sleep_time = min(self.poll_max, max(self.sleep_time, min_sleep_time))
+
   def Wait(self):
     """Wait until the next action is needed."""
     time.sleep(self.sleep_time - int(self.sleep_time))
@@ -480,6 +542,10 @@ class CommsInit(registry.InitHook):
     stats.STATS.RegisterCounterMetric("grr_client_slave_restarts")
     stats.STATS.RegisterCounterMetric("grr_client_sent_bytes")
     stats.STATS.RegisterCounterMetric("grr_client_sent_messages")
+    # Requests made by the HTTPManager and the new connections they needed.
+    stats.STATS.RegisterCounterMetric("grr_client_http_requests")
+    stats.STATS.RegisterCounterMetric("grr_client_http_connections")
+    stats.STATS.RegisterCounterMetric("grr_client_spooled_messages")
 
 
 class GRRClientWorker(threading.Thread):
@@ -545,10 +611,20 @@ class GRRClientWorker(threading.Thread):
       self._out_queue = out_queue
     else:
       # The size of the output queue controls the worker thread. Once this queue
-      # is too large, the worker thread will block until the queue is drained.
+      # is too large, the worker thread will block until the queue is drained,
+      # unless the overflow can be spooled to disk.
+      spool = None
+      spool_directory = config.CONFIG["Client.spool_directory"]
+      if spool_directory and client is not None:
+        spool = MessageSpool(
+            spool_directory,
+            max_size=config.CONFIG["Client.spool_max_size"],
+            private_key=client.communicator.private_key)
+
       self._out_queue = SizeLimitedQueue(
           maxsize=config.CONFIG["Client.max_out_queue"],
-          heart_beat_cb=heart_beat_cb)
+          heart_beat_cb=heart_beat_cb,
+          spool=spool)
 
     self.daemon = True
 
@@ -851,15 +927,203 @@ class GRRClientWorker(threading.Thread):
       os.kill(os.getpid(), signal.SIGKILL)
 
 
+class _SpoolSegment(object):
+  """A file holding a sequence of spooled messages."""
+
+  def __init__(self, path, size=0):
+    self.path = path
+    self.size = size
+    self.read_offset = 0
+    self.read_handle = None
+    self.write_handle = None
+
+  def Close(self):
+    for handle in [self.read_handle, self.write_handle]:
+      if handle is not None:
+        handle.close()
+    self.read_handle = self.write_handle = None
+
+
+class MessageSpool(object):
+  """An encrypted on-disk spool for outgoing messages.
+
+  Messages are appended to segment files, there is a separate sequence of
+  segments for every priority. Records are encrypted and authenticated with
+  keys derived from the client's private key. Segments are deleted once all
+  their messages were read. Segments left over by a previous run are read
+  before any new messages. Read positions are not persisted, so messages from
+  a partially read segment are sent again after a restart.
+
+  This class is not thread safe, SizeLimitedQueue serializes all access.
+  """
+
+  # A new segment is started once the current one is larger than this.
+  segment_size = 1024 * 1024
+
+  _RECORD_HEADER = struct.Struct("<I")
+  _SEGMENT_NAME_RE = re.compile(r"^(\d+)-(\d+)\.spool$")
+
+  def __init__(self, directory, max_size, private_key):
+    """Constructor.
+
+    Args:
+      directory: The directory to keep the segments in.
+      max_size: The maximum number of bytes the segments may use on disk.
+      private_key: The client's private key, used to derive the keys the
+        messages are encrypted with.
+    """
+    key_material = hashlib.sha512(private_key.AsPEM()).digest()
+    self._encryption_key = rdf_crypto.EncryptionKey(key_material[:16])
+    self._hmac = rdf_crypto.HMAC(key_material[32:])
+
+    self._directory = directory
+    self._max_size = max_size
+    # Bytes used on disk and bytes not yet read, per priority.
+    self._disk_size = 0
+    self._unread_size = collections.Counter()
+    # The segments of each priority, oldest first. New messages are appended
+    # to the last segment unless it was left over by a previous run.
+    self._segments = collections.defaultdict(collections.deque)
+    self._write_segments = {}
+    self._sequence = 0
+
+    if not os.path.isdir(directory):
+      os.makedirs(directory, 0700)
+
+    self._LoadSegments()
+
+  def _LoadSegments(self):
+    segments = []
+    for filename in os.listdir(self._directory):
+      match = self._SEGMENT_NAME_RE.match(filename)
+      if match:
+        priority, sequence = int(match.group(1)), int(match.group(2))
+        segments.append((sequence, priority, filename))
+
+    for sequence, priority, filename in sorted(segments):
+      path = os.path.join(self._directory, filename)
+      segment = _SpoolSegment(path, size=os.path.getsize(path))
+      self._segments[priority].append(segment)
+      self._disk_size += segment.size
+      self._unread_size[priority] += segment.size
+      self._sequence = sequence + 1
+
+  def _Encrypt(self, message):
+    iv = rdf_crypto.EncryptionKey.GenerateRandomIV()
+    data = iv.RawBytes() + rdf_crypto.AES128CBCCipher(
+        self._encryption_key, iv).Encrypt(message)
+    return data + self._hmac.HMAC(data, use_sha256=True)
+
+  def _Decrypt(self, record):
+    data, digest = record[:-32], record[-32:]
+    self._hmac.Verify(data, digest)
+
+    iv = rdf_crypto.EncryptionKey(data[:16])
+    return rdf_crypto.AES128CBCCipher(self._encryption_key,
+                                      iv).Decrypt(data[16:])
+
+  def Put(self, message, priority):
+    """Appends a serialized message, returns False if the spool is full."""
+    record = self._Encrypt(message)
+    record = self._RECORD_HEADER.pack(len(record)) + record
+    if self._disk_size + len(record) > self._max_size:
+      return False
+
+    segment = self._write_segments.get(priority)
+    if segment is None or segment.size >= self.segment_size:
+      path = os.path.join(self._directory,
+                          "%d-%010d.spool" % (priority, self._sequence))
+      self._sequence += 1
+
+      segment = _SpoolSegment(path)
+      segment.write_handle = open(path, "ab")
+      self._segments[priority].append(segment)
+      self._write_segments[priority] = segment
+
+    segment.write_handle.write(record)
+    segment.write_handle.flush()
+
+    segment.size += len(record)
+    self._disk_size += len(record)
+    self._unread_size[priority] += len(record)
+    return True
+
+  def _ReadRecord(self, segment):
+    """Reads the next record of the segment, returns None at its end."""
+    if segment.read_offset >= segment.size:
+      return None
+
+    if segment.read_handle is None:
+      segment.read_handle = open(segment.path, "rb")
+      segment.read_handle.seek(segment.read_offset)
+
+    header = segment.read_handle.read(self._RECORD_HEADER.size)
+    if len(header) == self._RECORD_HEADER.size:
+      (length,) = self._RECORD_HEADER.unpack(header)
+      record = segment.read_handle.read(length)
+      if len(record) == length:
+        segment.read_offset += len(header) + length
+        return record
+
+    # A record that was only partially written before the client stopped.
+    logging.warning("Truncated message spool segment %s.", segment.path)
+    segment.read_offset = segment.size
+    return None
+
+  def Get(self, priority):
+    """Removes and returns the oldest message of priority or None."""
+    segments = self._segments[priority]
+    while segments:
+      segment = segments[0]
+      read_offset = segment.read_offset
+      record = self._ReadRecord(segment)
+      self._unread_size[priority] -= segment.read_offset - read_offset
+
+      if record is None:
+        # All messages of this segment were read.
+        if segment is self._write_segments.get(priority):
+          del self._write_segments[priority]
+
+        segments.popleft()
+        segment.Close()
+        os.remove(segment.path)
+        self._disk_size -= segment.size
+        continue
+
+      try:
+        return self._Decrypt(record)
+      except (ValueError, rdf_crypto.Error, rdf_crypto.CipherError) as e:
+        logging.warning("Dropping invalid message from spool segment %s: %s",
+                        segment.path, e)
+
+    return None
+
+  def HasMessages(self, priority):
+    return self._unread_size[priority] > 0
+
+  def Size(self):
+    """Returns the total size of the spooled messages that were not read."""
+    return sum(self._unread_size.itervalues())
+
+  def Close(self):
+    for segments in self._segments.itervalues():
+      for segment in segments:
+        segment.Close()
+
+
 class SizeLimitedQueue(object):
   """A Queue which limits the total size of its elements.
 
   The standard Queue implementations uses the total number of elements to block
   on. In the client we want to limit the total memory footprint, hence we need
   to use the total size as a measure of how full the queue is.
+
+  If a MessageSpool is given, messages that do not fit into the queue are
+  written to the spool instead of blocking the caller, until the spool is full
+  as well.
   """
 
-  def __init__(self, heart_beat_cb, maxsize=1024):
+  def __init__(self, heart_beat_cb, maxsize=1024, spool=None):
     self._queues = {
         rdf_flows.GrrMessage.Priority.LOW_PRIORITY:
             collections.deque(),
@@ -876,6 +1140,7 @@ class SizeLimitedQueue(object):
     self._total_size = 0
     self._maxsize = maxsize
     self._heart_beat_cb = heart_beat_cb
+    self._spool = spool
 
   def Put(self,
           message,
@@ -901,25 +1166,37 @@ class SizeLimitedQueue(object):
     # We only queue already serialized objects so we know how large they are.
     message = message.SerializeToString()
 
-    if priority >= rdf_flows.GrrMessage.Priority.HIGH_PRIORITY:
-      pass  # If high priority is set we don't care about the size of the queue.
-
-    elif not block:
-      if self.Full():
+    t0 = time.time()
+    while not self._Put(message, priority):
+      if not block:
         raise Queue.Full
 
-    else:
-      t0 = time.time()
-      while self.Full():
-        time.sleep(1)
-        self._heart_beat_cb()
+      time.sleep(1)
+      self._heart_beat_cb()
 
-        if time.time() - t0 > timeout:
-          raise Queue.Full
+      if time.time() - t0 > timeout:
+        raise Queue.Full
 
+  def _Put(self, message, priority):
+    """Queues the message if there is space, returns True on success."""
     with self._lock:
+      # If high priority is set we don't care about the size of the queue.
+      if priority < rdf_flows.GrrMessage.Priority.HIGH_PRIORITY:
+        # Once messages of a priority are spooled, the following ones have to
+        # be spooled as well so they are sent in order.
+        if self._spool is not None and (self.Full() or
+                                        self._spool.HasMessages(priority)):
+          if self._spool.Put(message, priority):
+            stats.STATS.IncrementCounter("grr_client_spooled_messages")
+            return True
+          return False
+
+        if self.Full():
+          return False
+
       self._queues[priority].appendleft(message)
       self._total_size += len(message)
+      return True
 
   def _GeneratePriority(self, priority):
     """Yields messages with given priority. Lock should be held by the caller.
@@ -929,7 +1206,17 @@ class SizeLimitedQueue(object):
     """
     queue = self._queues[priority]
     while queue:
-      yield queue.pop()
+      message = queue.pop()
+      self._total_size -= len(message)
+      yield message
+
+    # Spooled messages are always newer than the ones in memory.
+    if self._spool is not None:
+      while True:
+        message = self._spool.Get(priority)
+        if message is None:
+          break
+        yield message
 
   def _Generate(self):
     """Yields messages in priority order. Lock should be held by the caller."""
@@ -965,6 +1252,8 @@ class SizeLimitedQueue(object):
       return ret
 
   def Size(self):
+    if self._spool is not None:
+      return self._total_size + self._spool.Size()
     return self._total_size
 
   def Full(self):
@@ -1110,8 +1399,10 @@ class GRRHTTPClient(object):
 
     # Try to decrypt the message into the http_object.
     try:
-      http_object.messages, http_object.source, http_object.nonce = (
-          self.communicator.DecryptMessage(http_object.data))
+      (response_comms, http_object.messages, http_object.source,
+       http_object.nonce) = self.communicator.DecryptCommunication(
+           http_object.data)
+      http_object.min_poll_interval = response_comms.min_poll_interval
 
       return True
 
@@ -1185,6 +1476,11 @@ class GRRHTTPClient(object):
       # the input queue.
       payload.queue_size = self.client_worker.InQueueSize()
 
+    # A loaded server may reject bundles of only low priority messages early.
+    if message_list.job:
+      payload.message_priority = max(
+          message.priority for message in message_list.job)
+
     nonce = self.communicator.EncodeMessages(message_list, payload)
     payload_data = payload.SerializeToString()
     response = self.MakeRequest(payload_data)
@@ -1236,6 +1532,10 @@ class GRRHTTPClient(object):
         self.timer.FastPoll()
         break
 
+    # A loaded server asks us to poll less often so it can catch up.
+    if response.min_poll_interval:
+      self.timer.Backoff(response.min_poll_interval)
+
     # Process all messages. Messages can be processed by clients in
     # any order since clients do not have state.
     self.client_worker.QueueMessages(response.messages)
@@ -1370,6 +1670,7 @@ class ClientCommunicator(communicator.Communicator):
   def __init__(self, certificate=None, private_key=None):
     super(ClientCommunicator, self).__init__(
         certificate=certificate, private_key=private_key)
+    self.compression_level = config.CONFIG["Client.compression_level"]
     self.InitPrivateKey()
 
   def InitPrivateKey(self):
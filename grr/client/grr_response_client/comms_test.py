@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 """Test for client comms."""
 
+import os
 import Queue
 import time
 import mock
 import requests
 
+from grr import config
 from grr_response_client import comms
 from grr.lib import flags
 from grr.lib import utils
@@ -62,7 +64,7 @@ class RequestsInstrumentor(object):
        A context manager that when exits restores the mocks.
     """
     self.actions = []
-    return utils.MultiStubber((requests, "request", self.request),
+    return utils.MultiStubber((requests.Session, "request", self.request),
                               (time, "sleep", self.sleep))
 
 
@@ -92,8 +94,9 @@ class HTTPManagerTest(test_lib.GRRBaseTest):
   """Tests the HTTP Manager."""
 
   def MakeRequest(self, instrumentor, manager, path, verify_cb=lambda x: True):
-    with utils.MultiStubber((requests, "request", instrumentor.request),
-                            (time, "sleep", instrumentor.sleep)):
+    with utils.MultiStubber(
+        (requests.Session, "request", instrumentor.request),
+        (time, "sleep", instrumentor.sleep)):
       return manager.OpenServerEndpoint(path, verify_cb=verify_cb)
 
   def testBaseURLConcatenation(self):
@@ -237,6 +240,44 @@ class HTTPManagerTest(test_lib.GRRBaseTest):
 
     self.assertEqual(result.data, "Good")
 
+  def testSessionsAreReusedPerServer(self):
+    manager = MockHTTPManager()
+    session = manager._GetSession("http://server1/control")
+    self.assertIs(manager._GetSession("http://server1/server.pem"), session)
+    self.assertIsNot(manager._GetSession("http://server2/control"), session)
+    self.assertIsNot(manager._GetSession("https://server1/control"), session)
+
+    with test_lib.ConfigOverrider({"Client.http_keep_alive": False}):
+      manager = MockHTTPManager()
+
+    session = manager._GetSession("http://server1/control")
+    self.assertIsNot(manager._GetSession("http://server1/control"), session)
+    self.assertEqual(manager.sessions, {})
+
+  def testSessionIsClosedOnConnectionError(self):
+    instrumentor = RequestsInstrumentor()
+    manager = MockHTTPManager()
+
+    # Error responses from the server leave the connections open.
+    instrumentor.responses = [_make_200("Good"), _make_http_response(code=500),
+                              _make_200("Good")]
+    with instrumentor.instrument():
+      manager.OpenServerEndpoint("control")
+      session = manager._GetSession("http://server1/control")
+      manager.OpenServerEndpoint("control")
+
+    self.assertIs(manager._GetSession("http://server1/control"), session)
+
+    # After a connection error, a new connection is made.
+    instrumentor.responses = [
+        requests.ConnectionError("Error", response=None), _make_200("Good")
+    ]
+    with instrumentor.instrument():
+      manager.OpenServerEndpoint("control")
+
+    self.assertIsNot(manager._GetSession("http://server1/control"), session)
+    self.assertEqual(len(instrumentor.actions), 2)
+
 
 class SizeLimitedQueueTest(test_lib.GRRBaseTest):
 
@@ -313,6 +354,92 @@ class SizeLimitedQueueTest(test_lib.GRRBaseTest):
 
     self.assertTrue(heartbeat.called)
 
+  def _MakeSpool(self, max_size=1024 * 1024):
+    return comms.MessageSpool(
+        os.path.join(self.temp_dir, "spool"),
+        max_size=max_size,
+        private_key=config.CONFIG["Client.private_key"])
+
+  def testSizeLimitedQueueSpoolsOverflow(self):
+    messages = [rdf_flows.GrrMessage(name="A%d" % i) for i in range(20)]
+    high_priority = rdf_flows.GrrMessage(name="B")
+
+    queue = comms.SizeLimitedQueue(
+        maxsize=3 * len(messages[0].SerializeToString()),
+        heart_beat_cb=lambda: None,
+        spool=self._MakeSpool())
+
+    with utils.Stubber(comms.MessageSpool, "segment_size", 100):
+      for message in messages:
+        queue.Put(
+            message, rdf_flows.GrrMessage.Priority.MEDIUM_PRIORITY, block=False)
+      queue.Put(high_priority, rdf_flows.GrrMessage.Priority.HIGH_PRIORITY)
+
+      self.assertTrue(queue.Full())
+      self.assertGreater(queue.Size(),
+                         sum(len(m.SerializeToString()) for m in messages))
+
+      expected = [high_priority] + messages[:5]
+      result = queue.GetMessages(soft_size_limit=sum(
+          len(m.SerializeToString()) for m in expected) - 1)
+      self.assertEqual(list(result.job), expected)
+
+      result = queue.GetMessages()
+      self.assertEqual(list(result.job), messages[5:])
+
+    self.assertEqual(queue.Size(), 0)
+    self.assertFalse(queue.Full())
+    self.assertEqual(os.listdir(os.path.join(self.temp_dir, "spool")), [])
+
+  def testMessageSpoolSurvivesRestarts(self):
+    messages = [rdf_flows.GrrMessage(name="A%d" % i) for i in range(10)]
+
+    spool = self._MakeSpool()
+    for message in messages:
+      spool.Put(message.SerializeToString(),
+                rdf_flows.GrrMessage.Priority.LOW_PRIORITY)
+    spool.Close()
+
+    queue = comms.SizeLimitedQueue(
+        heart_beat_cb=lambda: None, spool=self._MakeSpool())
+    self.assertEqual(list(queue.GetMessages().job), messages)
+
+  def testMessageSpoolDiskBudget(self):
+    message = rdf_flows.GrrMessage(name="A")
+    queue = comms.SizeLimitedQueue(
+        maxsize=len(message.SerializeToString()),
+        heart_beat_cb=lambda: None,
+        spool=self._MakeSpool(max_size=500))
+
+    with self.assertRaises(Queue.Full):
+      for _ in range(100):
+        queue.Put(
+            message, rdf_flows.GrrMessage.Priority.MEDIUM_PRIORITY, block=False)
+
+    spool_dir = os.path.join(self.temp_dir, "spool")
+    self.assertLessEqual(
+        sum(os.path.getsize(os.path.join(spool_dir, f))
+            for f in os.listdir(spool_dir)), 500)
+
+  def testMessageSpoolDropsTamperedMessages(self):
+    spool = self._MakeSpool()
+    for name in ["A", "B"]:
+      spool.Put(rdf_flows.GrrMessage(name=name).SerializeToString(),
+                rdf_flows.GrrMessage.Priority.LOW_PRIORITY)
+    spool.Close()
+
+    spool_dir = os.path.join(self.temp_dir, "spool")
+    path = os.path.join(spool_dir, os.listdir(spool_dir)[0])
+    data = open(path, "rb").read()
+    with open(path, "wb") as fd:
+      fd.write(data[:10] + chr(ord(data[10]) ^ 1) + data[11:])
+
+    spool = self._MakeSpool()
+    message = spool.Get(rdf_flows.GrrMessage.Priority.LOW_PRIORITY)
+    self.assertEqual(rdf_flows.GrrMessage.FromSerializedString(message).name,
+                     "B")
+    self.assertIsNone(spool.Get(rdf_flows.GrrMessage.Priority.LOW_PRIORITY))
+
 
 def main(argv):
   test_lib.main(argv)
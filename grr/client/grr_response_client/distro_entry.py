@@ -36,3 +36,9 @@ def PoolClient():
   from grr_response_client import poolclient
   SetConfigOptions()
   flags.StartMain(poolclient.main)
+
+
+def LoadGenerator():
+  from grr_response_client import loadgen
+  SetConfigOptions()
+  flags.StartMain(loadgen.main)
@@ -0,0 +1,480 @@
+#!/usr/bin/env python
+"""A load generator for GRR servers built on the pool client.
+
+The load generator runs many simulated clients in one process against a test
+or staging deployment (frontend, worker and data store have to be started
+separately). Every client polls the frontend at a configurable interval and
+sends a configurable mix of client stats, file upload chunks and crash
+reports. Clients can go offline for a while, and an enrollment storm of new
+clients can be started during the run.
+
+When the run is over, latency percentiles, throughput and the resource usage of
+the load generator and of the given server processes are reported as JSON.
+
+Message latency is measured from the time a message is queued on the client
+until the frontend acknowledged the request carrying it. Messages to the
+well known flows that run on the frontend (TransferStore and Stats by default)
+are processed by then.
+"""
+
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+import zlib
+
+
+import psutil
+
+from grr import config
+from grr_response_client import client_startup
+from grr_response_client import poolclient
+from grr_response_client import vfs
+from grr.config import contexts
+from grr.lib import flags
+from grr.lib import queues
+from grr.lib import rdfvalue
+from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import crypto as rdf_crypto
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import paths as rdf_paths
+from grr.lib.rdfvalues import protodict as rdf_protodict
+
+flags.DEFINE_integer("duration", 600,
+                     "Number of seconds to generate load for.")
+
+flags.DEFINE_float("poll_interval", 10,
+                   "The average number of seconds between two polls of a "
+                   "client. Every client gets a random interval within 10% "
+                   "of this.")
+
+flags.DEFINE_float("stats_interval", 60,
+                   "Every client sends client stats this often (in seconds) "
+                   "on average. 0 disables client stats.")
+
+flags.DEFINE_float("upload_interval", 300,
+                   "Every client uploads a file chunk this often (in seconds) "
+                   "on average. 0 disables uploads.")
+
+flags.DEFINE_integer("upload_size", 64 * 1024,
+                     "The size in bytes of uploaded file chunks.")
+
+flags.DEFINE_float("crash_interval", 3600,
+                   "Every client sends a crash report this often (in seconds) "
+                   "on average. 0 disables crash reports.")
+
+flags.DEFINE_float("churn_probability", 0.0,
+                   "The probability that a client goes offline after a poll.")
+
+flags.DEFINE_float("offline_time", 300,
+                   "The average number of seconds clients stay offline.")
+
+flags.DEFINE_integer("enrollment_storm_clients", 0,
+                     "Number of new clients that enroll at the same time.")
+
+flags.DEFINE_integer("enrollment_storm_delay", 60,
+                     "Seconds after the start when the enrollment storm "
+                     "begins.")
+
+flags.DEFINE_list("component_pids", [],
+                  "Server processes to report resource usage for, as a list "
+                  "of name=pid pairs, e.g. frontend=1234,worker=2345.")
+
+flags.DEFINE_string("report_file", "",
+                    "Write the JSON report to this file instead of stdout.")
+
+
+def Percentile(sorted_values, percent):
+  """Returns the percentile of a sorted list using the nearest rank method."""
+  if not sorted_values:
+    return None
+
+  rank = int(math.ceil(percent * len(sorted_values) / 100.0))
+  return sorted_values[min(len(sorted_values), max(1, rank)) - 1]
+
+
+class LatencyRecorder(object):
+  """Collects latency samples by kind and summarizes them.
+
+  At most max_samples samples are kept per kind. Beyond that, a uniform random
+  sample of all recorded values is kept (reservoir sampling).
+  """
+
+  max_samples = 100000
+
+  def __init__(self):
+    self._samples = {}
+    self._counts = {}
+    self._lock = threading.Lock()
+
+  def Record(self, kind, latency):
+    with self._lock:
+      count = self._counts.get(kind, 0) + 1
+      self._counts[kind] = count
+      samples = self._samples.setdefault(kind, [])
+      if len(samples) < self.max_samples:
+        samples.append(latency)
+      else:
+        index = random.randrange(count)
+        if index < self.max_samples:
+          samples[index] = latency
+
+  def Count(self, kind):
+    with self._lock:
+      return self._counts.get(kind, 0)
+
+  def Summary(self, duration):
+    """Returns a dict with count, throughput and percentiles for every kind."""
+    result = {}
+    with self._lock:
+      for kind, samples in self._samples.iteritems():
+        samples = sorted(samples)
+        count = self._counts[kind]
+        result[kind] = dict(
+            count=count,
+            per_second=float(count) / duration if duration else None,
+            latency_p50=Percentile(samples, 50),
+            latency_p90=Percentile(samples, 90),
+            latency_p99=Percentile(samples, 99),
+            latency_max=samples[-1])
+
+    return result
+
+
+class ResourceMonitor(threading.Thread):
+  """Samples the CPU and memory usage of processes."""
+
+  def __init__(self, processes, sample_interval=1):
+    """Constructor.
+
+    Args:
+      processes: A dict mapping component names to process ids.
+      sample_interval: Seconds between two samples.
+    """
+    super(ResourceMonitor, self).__init__(name="LoadGenResourceMonitor")
+    self.daemon = True
+    self.sample_interval = sample_interval
+    self.processes = {
+        name: psutil.Process(pid)
+        for name, pid in processes.iteritems()
+    }
+    self.start_cpu = {}
+    self.max_rss = dict.fromkeys(self.processes, 0)
+    self.start_time = None
+    self.stop = False
+
+  def _CpuSeconds(self, process):
+    cpu_times = process.cpu_times()
+    return cpu_times.user + cpu_times.system
+
+  def run(self):
+    self.start_time = time.time()
+    for name, process in self.processes.iteritems():
+      self.start_cpu[name] = self._CpuSeconds(process)
+
+    while not self.stop:
+      for name, process in self.processes.iteritems():
+        try:
+          rss = process.memory_info().rss
+        except psutil.Error:
+          continue
+        self.max_rss[name] = max(self.max_rss[name], rss)
+
+      time.sleep(self.sample_interval)
+
+  def Stop(self):
+    self.stop = True
+
+  def Summary(self):
+    """Returns a dict with the resource usage of every process."""
+    elapsed = time.time() - self.start_time
+    result = {}
+    for name, process in self.processes.iteritems():
+      try:
+        cpu_seconds = self._CpuSeconds(process) - self.start_cpu[name]
+      except psutil.Error as e:
+        result[name] = dict(error=str(e))
+        continue
+
+      result[name] = dict(
+          pid=process.pid,
+          cpu_seconds=cpu_seconds,
+          cpu_percent=100.0 * cpu_seconds / elapsed if elapsed else None,
+          max_rss_bytes=self.max_rss[name])
+
+    return result
+
+
+class LoadGenClient(poolclient.PoolGRRClient):
+  """A pool client that generates a configurable workload."""
+
+  STATS_SESSION = rdfvalue.SessionID(queue=queues.STATS, flow_name="Stats")
+  UPLOAD_SESSION = rdfvalue.SessionID(flow_name="TransferStore")
+  CRASH_SESSION = rdfvalue.SessionID(flow_name="CrashHandler")
+
+  def __init__(self, recorder, workload, **kwargs):
+    """Constructor.
+
+    Args:
+      recorder: The LatencyRecorder to report to.
+      workload: A dict with the poll_interval, stats_interval, upload_interval,
+        upload_size, crash_interval, churn_probability and offline_time
+        settings as described by the flags of this module.
+      **kwargs: Passed to PoolGRRClient.
+    """
+    super(LoadGenClient, self).__init__(**kwargs)
+    self.recorder = recorder
+    self.workload = workload
+    self.start_time = None
+
+    # Clients poll at a fixed interval, with some jitter between clients so
+    # they do not all poll at the same time.
+    timer = self.client.timer
+    timer.poll_min = timer.poll_max = timer.sleep_time = (
+        workload["poll_interval"] * random.uniform(0.9, 1.1))
+
+    self.session_kinds = {
+        self.STATS_SESSION: "stats",
+        self.UPLOAD_SESSION: "upload",
+        self.CRASH_SESSION: "crash",
+    }
+    self.next_message_times = {}
+    # Timestamps of the messages sent in the current request.
+    self.in_flight = []
+
+    worker = self.client.client_worker
+    self._drain = worker.Drain
+    worker.Drain = self._Drain
+
+  def _Drain(self, **kwargs):
+    """Remembers which generated messages are sent to the server."""
+    message_list = self._drain(**kwargs)
+    for message in message_list.job:
+      kind = self.session_kinds.get(message.session_id)
+      if kind:
+        self.in_flight.append(
+            (kind, message.timestamp.AsMicroSecondsFromEpoch() / 1e6))
+
+    return message_list
+
+  def _NextInterval(self, interval):
+    return random.expovariate(1.0 / interval)
+
+  def _Due(self, kind, now):
+    """Returns True if a message of the kind should be sent now."""
+    interval = self.workload[kind + "_interval"]
+    if not interval:
+      return False
+
+    next_time = self.next_message_times.get(kind)
+    if next_time is None:
+      # Spread the first messages of all clients over the interval.
+      next_time = now + random.uniform(0, interval)
+    if next_time > now:
+      self.next_message_times[kind] = next_time
+      return False
+
+    self.next_message_times[kind] = now + self._NextInterval(interval)
+    return True
+
+  def _Send(self, payload, session_id, priority):
+    message = rdf_flows.GrrMessage(
+        session_id=session_id,
+        response_id=0,
+        request_id=0,
+        priority=priority,
+        require_fastpoll=False,
+        timestamp=rdfvalue.RDFDatetime.Now())
+    message.payload = payload
+    self.client.client_worker.QueueResponse(message, priority=priority)
+
+  def GenerateMessages(self):
+    """Queues the messages that are due according to the workload."""
+    now = time.time()
+    if self._Due("stats", now):
+      self._Send(
+          rdf_client.ClientStats(
+              RSS_size=random.randint(50, 200) * 1024 * 1024,
+              VMS_size=random.randint(200, 800) * 1024 * 1024,
+              memory_percent=random.uniform(0, 5),
+              bytes_received=random.randint(0, 1 << 20),
+              bytes_sent=random.randint(0, 1 << 20),
+              create_time=rdfvalue.RDFDatetime.Now()),
+          self.STATS_SESSION,
+          rdf_flows.GrrMessage.Priority.LOW_PRIORITY)
+
+    if self._Due("upload", now):
+      # Random data does not compress, like most real files we collect.
+      data = os.urandom(self.workload["upload_size"])
+      self._Send(
+          rdf_protodict.DataBlob(
+              data=zlib.compress(data),
+              compression=rdf_protodict.DataBlob.CompressionType.ZCOMPRESSION),
+          self.UPLOAD_SESSION,
+          rdf_flows.GrrMessage.Priority.MEDIUM_PRIORITY)
+
+    if self._Due("crash", now):
+      self._Send(
+          rdf_client.ClientCrash(
+              client_id=self.client.communicator.common_name,
+              crash_message="Simulated crash from the load generator.",
+              timestamp=rdfvalue.RDFDatetime.Now()),
+          self.CRASH_SESSION,
+          rdf_flows.GrrMessage.Priority.MEDIUM_PRIORITY)
+
+  def RunOnce(self):
+    """Polls the server once and records the latencies."""
+    self.GenerateMessages()
+
+    self.in_flight = []
+    start = time.time()
+    response = self.client.RunOnce()
+    now = time.time()
+
+    if response.code == 200 and response.messages is not None:
+      if not self.enrolled:
+        self.enrolled = True
+        self.recorder.Record("enrollment", now - self.start_time)
+
+      self.recorder.Record("poll", now - start)
+      for kind, timestamp in self.in_flight:
+        self.recorder.Record(kind, now - timestamp)
+    else:
+      # Failed messages are queued again by the client, we count them when
+      # they get through.
+      self.recorder.Record("failed_poll", now - start)
+
+  def Run(self):
+    self.start_time = time.time()
+    while not self.stop:
+      self.RunOnce()
+
+      if random.random() < self.workload["churn_probability"]:
+        self.recorder.Record("offline", 0)
+        offline_until = time.time() + self._NextInterval(
+            self.workload["offline_time"])
+        while not self.stop and time.time() < offline_until:
+          time.sleep(1)
+      else:
+        self.client.timer.Wait()
+
+
+def _ParseComponentPids(component_pids):
+  processes = {"load_generator": os.getpid()}
+  for component in component_pids:
+    name, pid = component.split("=", 1)
+    processes[name] = int(pid)
+
+  return processes
+
+
+def RunLoadGenerator():
+  """Runs the load generator and writes the report."""
+  workload = dict(
+      poll_interval=flags.FLAGS.poll_interval,
+      stats_interval=flags.FLAGS.stats_interval,
+      upload_interval=flags.FLAGS.upload_interval,
+      upload_size=flags.FLAGS.upload_size,
+      crash_interval=flags.FLAGS.crash_interval,
+      churn_probability=flags.FLAGS.churn_probability,
+      offline_time=flags.FLAGS.offline_time)
+  recorder = LatencyRecorder()
+  ca_cert = config.CONFIG["CA.certificate"]
+
+  try:
+    keys = poolclient.LoadPrivateKeys(flags.FLAGS.cert_file)
+  except (IOError, EOFError):
+    keys = []
+
+  bits = config.CONFIG["Client.rsa_key_length"]
+  new_keys = [
+      rdf_crypto.RSAPrivateKey.GenerateKey(bits=bits)
+      for _ in xrange(flags.FLAGS.nrclients - len(keys))
+  ]
+  if new_keys and flags.FLAGS.cert_file:
+    poolclient.SavePrivateKeys(flags.FLAGS.cert_file, keys + new_keys)
+
+  clients = [
+      LoadGenClient(recorder, workload, private_key=key, ca_cert=ca_cert)
+      for key in (keys + new_keys)[:flags.FLAGS.nrclients]
+  ]
+
+  # Storm clients always enroll from scratch.
+  storm = [
+      LoadGenClient(
+          recorder,
+          workload,
+          private_key=rdf_crypto.RSAPrivateKey.GenerateKey(bits=bits),
+          ca_cert=ca_cert) for _ in xrange(flags.FLAGS.enrollment_storm_clients)
+  ]
+
+  monitor = ResourceMonitor(_ParseComponentPids(flags.FLAGS.component_pids))
+  monitor.start()
+
+  logging.info("Starting %d clients.", len(clients))
+  start_time = time.time()
+  for c in clients:
+    c.start()
+
+  try:
+    storm_started = not storm
+    while time.time() < start_time + flags.FLAGS.duration:
+      time.sleep(1)
+      if (not storm_started and
+          time.time() >= start_time + flags.FLAGS.enrollment_storm_delay):
+        logging.info("Starting an enrollment storm of %d clients.", len(storm))
+        for c in storm:
+          c.start()
+        storm_started = True
+
+  except KeyboardInterrupt:
+    pass
+
+  finally:
+    for c in clients + storm:
+      c.Stop()
+    monitor.Stop()
+
+  duration = time.time() - start_time
+  report = dict(
+      clients=len(clients),
+      enrollment_storm_clients=len(storm),
+      duration=duration,
+      workload=workload,
+      enrolled_clients=len([c for c in clients + storm if c.enrolled]),
+      messages=recorder.Summary(duration),
+      resources=monitor.Summary())
+
+  data = json.dumps(report, indent=2, sort_keys=True)
+  if flags.FLAGS.report_file:
+    with open(flags.FLAGS.report_file, "wb") as fd:
+      fd.write(data)
+  else:
+    print data
+
+
+def main(argv):
+  del argv  # Unused.
+  config.CONFIG.AddContext(contexts.POOL_CLIENT_CONTEXT,
+                           "Context applied when we run the pool client.")
+
+  client_startup.ClientInit()
+
+  config.CONFIG.SetWriteBack("/dev/null")
+
+  poolclient.CheckLocation()
+
+  # Let the OS handler also handle sleuthkit requests since sleuthkit is not
+  # thread safe.
+  tsk = rdf_paths.PathSpec.PathType.TSK
+  os_type = rdf_paths.PathSpec.PathType.OS
+  vfs.VFS_HANDLERS[tsk] = vfs.VFS_HANDLERS[os_type]
+
+  RunLoadGenerator()
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
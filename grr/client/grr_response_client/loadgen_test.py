@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Tests for the load generator."""
+
+import os
+import random
+
+import unittest
+from grr_response_client import loadgen
+from grr.lib import flags
+from grr.test_lib import test_lib
+
+
+class PercentileTest(unittest.TestCase):
+
+  def testEmptyListHasNoPercentile(self):
+    self.assertIsNone(loadgen.Percentile([], 50))
+
+  def testUsesNearestRank(self):
+    values = range(1, 11)
+    self.assertEqual(loadgen.Percentile(values, 0), 1)
+    self.assertEqual(loadgen.Percentile(values, 10), 1)
+    self.assertEqual(loadgen.Percentile(values, 11), 2)
+    self.assertEqual(loadgen.Percentile(values, 50), 5)
+    self.assertEqual(loadgen.Percentile(values, 90), 9)
+    self.assertEqual(loadgen.Percentile(values, 99), 10)
+    self.assertEqual(loadgen.Percentile(values, 100), 10)
+
+  def testSingleValue(self):
+    for percent in [0, 50, 99, 100]:
+      self.assertEqual(loadgen.Percentile([42], percent), 42)
+
+  def testLargeList(self):
+    values = range(1, 1001)
+    self.assertEqual(loadgen.Percentile(values, 50), 500)
+    self.assertEqual(loadgen.Percentile(values, 90), 900)
+    self.assertEqual(loadgen.Percentile(values, 99), 990)
+
+
+class LatencyRecorderTest(unittest.TestCase):
+
+  def testSummarizesEveryKind(self):
+    recorder = loadgen.LatencyRecorder()
+    latencies = range(1, 101)
+    random.shuffle(latencies)
+    for latency in latencies:
+      recorder.Record("stats", latency)
+    recorder.Record("upload", 7)
+
+    self.assertEqual(recorder.Count("stats"), 100)
+    self.assertEqual(recorder.Count("upload"), 1)
+    self.assertEqual(recorder.Count("crash"), 0)
+
+    summary = recorder.Summary(duration=10)
+    self.assertEqual(
+        summary["stats"],
+        dict(
+            count=100,
+            per_second=10.0,
+            latency_p50=50,
+            latency_p90=90,
+            latency_p99=99,
+            latency_max=100))
+    self.assertEqual(
+        summary["upload"],
+        dict(
+            count=1,
+            per_second=0.1,
+            latency_p50=7,
+            latency_p90=7,
+            latency_p99=7,
+            latency_max=7))
+
+  def testNoThroughputWithoutDuration(self):
+    recorder = loadgen.LatencyRecorder()
+    recorder.Record("stats", 1)
+    self.assertIsNone(recorder.Summary(duration=0)["stats"]["per_second"])
+
+  def testKeepsAtMostMaxSamples(self):
+    recorder = loadgen.LatencyRecorder()
+    recorder.max_samples = 10
+    for latency in range(1000):
+      recorder.Record("stats", latency)
+
+    # All values are counted but only a sample of them is kept.
+    self.assertEqual(recorder.Count("stats"), 1000)
+    self.assertEqual(len(recorder._samples["stats"]), 10)
+
+    summary = recorder.Summary(duration=1)["stats"]
+    self.assertEqual(summary["count"], 1000)
+    self.assertLess(summary["latency_max"], 1000)
+
+
+class ParseComponentPidsTest(unittest.TestCase):
+
+  def testAddsTheLoadGenerator(self):
+    self.assertEqual(
+        loadgen._ParseComponentPids([]), {"load_generator": os.getpid()})
+
+  def testParsesNamePidPairs(self):
+    self.assertEqual(
+        loadgen._ParseComponentPids(["frontend=1234", "worker=2345"]), {
+            "load_generator": os.getpid(),
+            "frontend": 1234,
+            "worker": 2345
+        })
+
+  def testRejectsInvalidPids(self):
+    with self.assertRaises(ValueError):
+      loadgen._ParseComponentPids(["frontend=abc"])
+    with self.assertRaises(ValueError):
+      loadgen._ParseComponentPids(["frontend"])
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -69,19 +69,37 @@ class PoolGRRClient(threading.Thread):
     self.Run()
 
 
+def LoadPrivateKeys(cert_file):
+  """Returns the client private keys stored in cert_file.
+
+  Raises:
+    IOError: If the file can not be read.
+  """
+  keys = []
+  with open(cert_file, "rb") as fd:
+    # Certificates are base64-encoded, so that we can use new-lines as
+    # separators.
+    for l in fd:
+      keys.append(rdf_crypto.RSAPrivateKey(initializer=base64.b64decode(l)))
+
+  return keys
+
+
+def SavePrivateKeys(cert_file, keys):
+  """Stores client private keys in cert_file for LoadPrivateKeys()."""
+  with open(cert_file, "wb") as fd:
+    # We're base64-encoding ceritificates so that we can use new-lines
+    # as separators.
+    fd.write("\n".join(base64.b64encode(x.SerializeToString()) for x in keys))
+
+
 def CreateClientPool(n):
   """Create n clients to run in a pool."""
   clients = []
 
   # Load previously stored clients.
   try:
-    certificates = []
-    with open(flags.FLAGS.cert_file, "rb") as fd:
-      # Certificates are base64-encoded, so that we can use new-lines as
-      # separators.
-      for l in fd:
-        cert = rdf_crypto.RSAPrivateKey(initializer=base64.b64decode(l))
-        certificates.append(cert)
+    certificates = LoadPrivateKeys(flags.FLAGS.cert_file)
 
     for certificate in certificates[:n]:
       clients.append(
@@ -147,13 +165,7 @@ def CreateClientPool(n):
   # same data.
   if not clients_loaded:
     logging.info("Saving certificates.")
-    with open(flags.FLAGS.cert_file, "wb") as fd:
-      # We're base64-encoding ceritificates so that we can use new-lines
-      # as separators.
-      b64_certs = [
-          base64.b64encode(x.private_key.SerializeToString()) for x in clients
-      ]
-      fd.write("\n".join(b64_certs))
+    SavePrivateKeys(flags.FLAGS.cert_file, [x.private_key for x in clients])
 
 
 def CheckLocation():
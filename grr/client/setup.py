@@ -63,7 +63,9 @@ setup_args = dict(
             ("grr_fleetspeak_client = "
              "grr_response_client.distro_entry:FleetspeakClient"),
             "grr_client_build = grr_response_client.distro_entry:ClientBuild",
-            "grr_pool_client = grr_response_client.distro_entry:PoolClient"
+            "grr_pool_client = grr_response_client.distro_entry:PoolClient",
+            ("grr_load_generator = "
+             "grr_response_client.distro_entry:LoadGenerator"),
         ]
     },
     cmdclass={"sdist": Sdist},
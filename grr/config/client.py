@@ -67,6 +67,10 @@ config_lib.DEFINE_list("Client.control_urls", [],
 config_lib.DEFINE_integer("Client.http_timeout", 100,
                           "Timeout for HTTP requests.")
 
+config_lib.DEFINE_bool("Client.http_keep_alive", True,
+                       "If set, connections to the server are kept open and "
+                       "reused for subsequent requests.")
+
 config_lib.DEFINE_string("Client.plist_path",
                          "/Library/LaunchDaemons/com.google.code.grrd.plist",
                          "Location of our launchctl plist.")
@@ -98,9 +102,23 @@ config_lib.DEFINE_list(
 config_lib.DEFINE_integer("Client.max_post_size", 40000000,
                           "Maximum size of the post.")
 
+config_lib.DEFINE_integer("Client.compression_level", 6,
+                          "The zlib level (0-9) used to compress messages sent "
+                          "to the server. 0 disables compression.")
+
 config_lib.DEFINE_integer("Client.max_out_queue", 51200000,
                           "Maximum size of the output queue.")
 
+config_lib.DEFINE_string("Client.spool_directory", "",
+                         "If set, outgoing messages that do not fit into the "
+                         "output queue are encrypted and spooled to this "
+                         "directory instead of blocking the running action. "
+                         "Spooled messages survive client restarts.")
+
+config_lib.DEFINE_integer("Client.spool_max_size", 512 * 1024 * 1024,
+                          "The maximum disk space in bytes used by the spool "
+                          "in Client.spool_directory.")
+
 config_lib.DEFINE_integer("Client.foreman_check_frequency", 1800,
                           "The minimum number of seconds before checking with "
                           "the foreman for new work.")
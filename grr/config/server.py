@@ -37,6 +37,13 @@ config_lib.DEFINE_integer("Worker.queue_shards", 5,
                           "Queue notifications will be sharded across "
                           "this number of datastore subjects.")
 
+config_lib.DEFINE_integer("Worker.queued_replies_flush_threshold", 1000,
+                          "Flows write their replies to the results "
+                          "collections when they are flushed. If a flow "
+                          "queues more than this number of replies in the "
+                          "meantime, they are written out early in one batch. "
+                          "Set to 0 to disable early flushing.")
+
 config_lib.DEFINE_list("Frontend.well_known_flows", ["TransferStore", "Stats"],
                        "Allow these well known flows to run directly on the "
                        "frontend. Other flows are scheduled as normal.")
@@ -101,6 +108,121 @@ config_lib.DEFINE_integer("Frontend.port_max", None,
                           "use ports between Frontend.bind_port and "
                           "Frontend.port_max.")
 
+config_lib.DEFINE_choice(
+    name="Frontend.server_mode",
+    default="threading",
+    choices=["threading", "event_loop"],
+    help="How the frontend HTTP server handles client connections. "
+    "\"threading\" uses one thread per connection, \"event_loop\" "
+    "multiplexes all connections in a single event loop and processes "
+    "requests in a bounded worker pool.")
+
+config_lib.DEFINE_integer("Frontend.event_loop_worker_threads", 50,
+                          "The maximum number of threads processing requests "
+                          "when Frontend.server_mode is \"event_loop\".")
+
+config_lib.DEFINE_integer("Frontend.keep_alive_timeout", 60,
+                          "Idle keep-alive connections are closed after this "
+                          "many seconds when Frontend.server_mode is "
+                          "\"event_loop\".")
+
+config_lib.DEFINE_integer(
+    "Frontend.foreman_checked_clients_bits",
+    default=2**23,
+    help="Size in bits of the in-memory record of the clients that were "
+    "already checked against the latest foreman rule. Clients in this record "
+    "are not looked up in the data store when they ask the foreman for work.")
+
+config_lib.DEFINE_semantic_value(
+    rdfvalue.Duration,
+    "Frontend.foreman_checked_clients_max_age",
+    default="10m",
+    help="The record of clients checked against the latest foreman rule is "
+    "cleared at least this often.")
+
+config_lib.DEFINE_integer("Frontend.processes", 1,
+                          "If larger than 1, the frontend pre-forks this many "
+                          "processes serving clients on the same port. Every "
+                          "process has its own caches, monitoring port "
+                          "(Monitoring.http_port + process index) and stats "
+                          "process id (StatsStore.process_id + \"_\" + index)."
+                         )
+
+config_lib.DEFINE_bool("Frontend.process_affinity", False,
+                       "If set and Frontend.processes is larger than 1, "
+                       "connections from the same client address are always "
+                       "served by the same frontend process to increase cache "
+                       "hit rates. Otherwise the processes share the port "
+                       "using SO_REUSEPORT and the kernel balances "
+                       "connections.")
+
+config_lib.DEFINE_bool("Frontend.shared_cipher_cache", False,
+                       "If set, verified client ciphers are also cached in "
+                       "the data store so they are shared between frontend "
+                       "processes and survive restarts. This saves RSA "
+                       "operations when clients move between frontends.")
+
+config_lib.DEFINE_semantic_value(
+    rdfvalue.Duration,
+    "Frontend.shared_cipher_cache_ttl",
+    default="1d",
+    description="Entries in the shared cipher cache expire after this time.")
+
+config_lib.DEFINE_integer("Frontend.max_decompressed_message_size",
+                          512 * 1024 * 1024,
+                          "Message bundles from clients that decompress to "
+                          "more than this many bytes are rejected.")
+
+config_lib.DEFINE_integer("Frontend.receive_batch_size", 1000,
+                          "Messages received from a client are written to "
+                          "the data store in batches of this size.")
+
+config_lib.DEFINE_integer("Frontend.compression_level", 6,
+                          "The zlib level (0-9) used to compress messages sent "
+                          "to clients. 0 disables compression.")
+
+config_lib.DEFINE_integer("Frontend.client_metadata_flush_interval", 5,
+                          "Client pings, clocks and IP addresses are "
+                          "collected in memory and written to the data store "
+                          "in bulk every this many seconds. 0 writes them "
+                          "immediately.")
+
+config_lib.DEFINE_integer("Frontend.client_metadata_max_pending", 10000,
+                          "Pending client metadata is written early once "
+                          "this many clients have updates.")
+
+config_lib.DEFINE_bool("Frontend.load_shedding", False,
+                       "If set, the frontend measures how far the backend "
+                       "lags behind and sheds load when it does: clients get "
+                       "fewer messages, are asked to poll less often and "
+                       "bundles of low priority messages are rejected.")
+
+config_lib.DEFINE_float("Frontend.load_shedding_threshold", 0.5,
+                        "Load is shed once the backend pressure exceeds this "
+                        "fraction of the limits below, and shed fully once "
+                        "a limit is reached.")
+
+config_lib.DEFINE_semantic_value(
+    rdfvalue.Duration,
+    "Frontend.max_notification_age",
+    default="5m",
+    description="The backend pressure is 1 when the oldest pending worker "
+    "notification is this old.")
+
+config_lib.DEFINE_float("Frontend.max_data_store_latency", 2.0,
+                        "The backend pressure is 1 when data store queries "
+                        "made by the frontend take this many seconds on "
+                        "average.")
+
+config_lib.DEFINE_integer("Frontend.max_pending_messages", 100000,
+                          "The backend pressure is 1 when this many received "
+                          "messages are waiting to be written to the data "
+                          "store.")
+
+config_lib.DEFINE_integer("Frontend.max_poll_backoff", 600,
+                          "The longest poll interval in seconds the frontend "
+                          "asks clients to use while shedding load.")
+
 config_lib.DEFINE_integer("Frontend.max_queue_size", 500,
                           "Maximum number of messages to queue for the client.")
 
@@ -282,6 +404,90 @@ config_lib.DEFINE_integer(
     "If the average network usage per client becomes "
     "greater than this limit, the hunt gets stopped.")
 
+config_lib.DEFINE_integer(
+    "Hunt.results_processing_threads",
+    default=10,
+    help="Maximum number of threads the hunt results processing cron job "
+    "uses to run output plugins.")
+
+config_lib.DEFINE_integer(
+    "Hunt.results_processing_concurrent_hunts",
+    default=4,
+    help="Number of hunts the hunt results processing cron job processes "
+    "at the same time.")
+
+config_lib.DEFINE_integer(
+    "Hunt.output_plugin_max_concurrent_batches",
+    default=4,
+    help="Maximum number of batches of hunt results that output plugins of "
+    "the same type process at the same time, across all hunts. This keeps a "
+    "slow plugin from taking up all results processing threads.")
+
+config_lib.DEFINE_integer(
+    "Hunt.output_plugin_max_lead",
+    default=2,
+    help="Maximum number of batches an output plugin of a hunt may get ahead "
+    "of the slowest output plugin of the same hunt.")
+
+config_lib.DEFINE_integer(
+    "Hunt.output_plugin_retries",
+    default=0,
+    help="How often to retry processing a batch of hunt results when an "
+    "output plugin fails. Plugins may see some results of a retried batch "
+    "twice.")
+
+config_lib.DEFINE_semantic_value(
+    rdfvalue.Duration,
+    "Hunt.output_plugin_retry_delay",
+    default="10s",
+    help="Delay before the first retry of a failed output plugin batch. The "
+    "delay doubles with every retry.")
+
+config_lib.DEFINE_integer(
+    "Hunt.output_plugin_min_batch_size",
+    default=0,
+    help="If set, results of a running hunt are passed to its output plugins "
+    "once there are at least this many of them, so that plugins do not have "
+    "to write many tiny batches. This delays the results, see "
+    "Hunt.output_plugin_max_batch_delay. By default results are passed on "
+    "right away.")
+
+config_lib.DEFINE_semantic_value(
+    rdfvalue.Duration,
+    "Hunt.output_plugin_max_batch_delay",
+    default="30m",
+    help="Maximum time results of a running hunt wait for "
+    "Hunt.output_plugin_min_batch_size results to accumulate. Results of "
+    "paused or stopped hunts are processed right away.")
+
+config_lib.DEFINE_integer(
+    "Hunt.request_processing_shards",
+    default=16,
+    help="Number of shards a worker splits the completed requests of a hunt "
+    "into by client. Shards are processed in parallel, the requests of a "
+    "client in order.")
+
+config_lib.DEFINE_integer(
+    "Hunt.client_rate_batch_size",
+    default=20,
+    help="Maximum number of hunt client start times the foreman reserves "
+    "from the data store at once when enforcing a hunt's client rate.")
+
+config_lib.DEFINE_semantic_value(
+    rdfvalue.Duration,
+    "Hunt.client_rate_batch_window",
+    default="10s",
+    help="The foreman reserves at most as many hunt client start times at "
+    "once as the hunt's client rate allows in this time. Reserved start "
+    "times that are not used in time are dropped.")
+
+config_lib.DEFINE_semantic_value(
+    rdfvalue.Duration,
+    "Hunt.result_counts_reconciliation_interval",
+    default="1h",
+    help="How often a worker processing a hunt checks the hunt's result "
+    "counts against its results collections.")
+
 config_lib.DEFINE_bool("Rekall.enabled", False,
                        "If True then Rekall-based flows (AnalyzeClientMemory, "
                        "MemoryCollector, ListVADBinaries) will be enabled in "
@@ -6,8 +6,10 @@ import cStringIO
 import itertools
 import logging
 import os
+import Queue
 import re
 import sys
+import threading
 import zipfile
 
 
@@ -36,12 +38,16 @@ class CollectionArchiveGenerator(object):
 
   BATCH_SIZE = 1000
 
+  # How many chunks of file data may be read ahead of the archive output.
+  PREFETCH_CHUNKS = 32
+
   def __init__(self,
                archive_format=ZIP,
                prefix=None,
                description=None,
                predicate=None,
-               client_id=None):
+               client_id=None,
+               archive_time=None):
     """CollectionArchiveGenerator constructor.
 
     Args:
@@ -55,6 +61,9 @@ class CollectionArchiveGenerator(object):
       predicate: If not None, only the files matching the predicate will be
           archived, all others will be skipped.
       client_id: The client_id to use when exporting a flow results collection.
+      archive_time: RDFDatetime used as modification time of all files in the
+          archive. Defaults to now. Archives of the same collection generated
+          with the same archive_time are identical.
     Raises:
       ValueError: if prefix is None.
     """
@@ -82,6 +91,14 @@ class CollectionArchiveGenerator(object):
     self.predicate = predicate or (lambda _: True)
     self.client_id = client_id
 
+    archive_time = archive_time or rdfvalue.RDFDatetime.Now()
+    self.mtime = archive_time.AsSecondsFromEpoch()
+
+    # Maps the file objects being archived to their path in the archive and
+    # their stat entries.
+    self._files_to_write = {}
+    self._clients = set()
+
   @property
   def output_size(self):
     return self.archive_generator.output_size
@@ -107,7 +124,7 @@ class CollectionArchiveGenerator(object):
     if self.ignored_files:
       manifest["ignored_files_list"] = self.ignored_files
     if self.failed_files:
-      manifest["failed_files_list"] = self.failed_files
+      manifest["failed_files_list"] = sorted(self.failed_files)
 
     manifest_fd = cStringIO.StringIO()
     if self.total_files != self.archived_files:
@@ -115,8 +132,8 @@ class CollectionArchiveGenerator(object):
     manifest_fd.write(yaml.safe_dump(manifest))
 
     manifest_fd.seek(0)
-    st = os.stat_result((0644, 0, 0, 0, 0, 0, len(manifest_fd.getvalue()), 0, 0,
-                         0))
+    st = os.stat_result((0644, 0, 0, 0, 0, 0, len(manifest_fd.getvalue()), 0,
+                         self.mtime, 0))
 
     for chunk in self.archive_generator.WriteFromFD(
         manifest_fd, os.path.join(self.prefix, "MANIFEST"), st=st):
@@ -128,30 +145,33 @@ class CollectionArchiveGenerator(object):
     client_info_path = os.path.join(self.prefix,
                                     client_fd.urn.Basename(),
                                     "client_info.yaml")
-    st = os.stat_result((0644, 0, 0, 0, 0, 0, len(summary), 0, 0, 0))
+    st = os.stat_result((0644, 0, 0, 0, 0, 0, len(summary), 0, self.mtime, 0))
     yield self.archive_generator.WriteFileHeader(client_info_path, st=st)
     yield self.archive_generator.WriteFileChunk(summary)
     yield self.archive_generator.WriteFileFooter()
 
-  def Generate(self, collection, token=None):
-    """Generates archive from a given collection.
-
-    Iterates the collection and generates an archive by yielding contents
-    of every referenced AFF4Stream.
+  def _StreamFiles(self, collection, token=None):
+    """Reads all files referenced in the collection.
 
     Args:
       collection: Iterable with items that point to aff4 paths.
       token: User's ACLToken.
 
     Yields:
-      Binary chunks comprising the generated archive.
+      Tuples (fd, chunk, exception) as returned by AFF4Stream.MultiStream for
+      all files to be archived. self._files_to_write has an entry for every fd
+      before the fd is yielded.
     """
-    clients = set()
     for fd_urn_batch in utils.Grouper(
         self._ItemsToUrns(collection), self.BATCH_SIZE):
 
-      fds_to_write = {}
-      for fd in aff4.FACTORY.MultiOpen(fd_urn_batch, token=token):
+      # MultiOpen returns the files in no particular order.
+      fds = sorted(
+          aff4.FACTORY.MultiOpen(fd_urn_batch, token=token),
+          key=lambda fd: fd.urn)
+
+      fds_by_class = {}
+      for fd in fds:
         self.total_files += 1
 
         if not self.predicate(fd):
@@ -161,41 +181,97 @@ class CollectionArchiveGenerator(object):
         # Any file-like object with data in AFF4 should inherit AFF4Stream.
         if isinstance(fd, aff4.AFF4Stream):
           urn_components = fd.urn.Split()
-          clients.add(rdf_client.ClientURN(urn_components[0]))
+          self._clients.add(rdf_client.ClientURN(urn_components[0]))
 
           content_path = os.path.join(self.prefix, *urn_components)
           self.archived_files += 1
 
           # Make sure size of the original file is passed. It's required
           # when output_writer is StreamingTarWriter.
-          st = os.stat_result((0644, 0, 0, 0, 0, 0, fd.size, 0, 0, 0))
-          fds_to_write[fd] = (content_path, st)
-
-      if fds_to_write:
-        prev_fd = None
-        for fd, chunk, exception in aff4.AFF4Stream.MultiStream(fds_to_write):
+          st = os.stat_result((0644, 0, 0, 0, 0, 0, fd.size, 0, self.mtime, 0))
+          self._files_to_write[fd] = (content_path, st)
+          fds_by_class.setdefault(fd.__class__.__name__, []).append(fd)
+
+      # Files are streamed in a fixed order so that the archive can be
+      # generated again in exactly the same way.
+      for _, fds in sorted(fds_by_class.items()):
+        for fd, chunk, exception in aff4.AFF4Stream.MultiStream(fds):
           if exception:
             logging.exception(exception)
 
             self.archived_files -= 1
             self.failed_files.append(utils.SmartUnicode(fd.urn))
-            continue
 
-          if prev_fd != fd:
-            if prev_fd:
-              yield self.archive_generator.WriteFileFooter()
-            prev_fd = fd
+          yield fd, chunk, exception
+
+  def _Prefetch(self, items):
+    """Iterates over items in a separate thread, reading ahead."""
+    prefetched = Queue.Queue(maxsize=self.PREFETCH_CHUNKS)
+    stop = threading.Event()
+    # Marks the end of the items. On failure, it holds the exception raised.
+    end = []
+
+    def Put(item):
+      while not stop.is_set():
+        try:
+          prefetched.put(item, timeout=1)
+          return True
+        except Queue.Full:
+          pass
+      return False
+
+    def Produce():
+      try:
+        for item in items:
+          if not Put(item):
+            return
+      except Exception as e:  # pylint: disable=broad-except
+        end.append(e)
+      Put(end)
+
+    producer = threading.Thread(target=Produce, name="ArchivePrefetch")
+    producer.daemon = True
+    producer.start()
+    try:
+      while True:
+        item = prefetched.get()
+        if item is end:
+          if end:
+            raise end[0]
+          return
+
+        yield item
+    finally:
+      # Stops the producer if the consumer went away early.
+      stop.set()
+      producer.join()
+
+  def _Generate(self, collection, token=None):
+    """Generates the whole archive, see Generate."""
+    prev_fd = None
+    for fd, chunk, exception in self._Prefetch(
+        self._StreamFiles(collection, token=token)):
+      if exception:
+        continue
+
+      if prev_fd != fd:
+        if self.archive_generator.is_file_write_in_progress:
+          yield self.archive_generator.WriteFileFooter()
+        prev_fd = fd
 
-            content_path, st = fds_to_write[fd]
-            yield self.archive_generator.WriteFileHeader(content_path, st=st)
+        content_path, st = self._files_to_write.pop(fd)
+        yield self.archive_generator.WriteFileHeader(content_path, st=st)
 
-          yield self.archive_generator.WriteFileChunk(chunk)
+      yield self.archive_generator.WriteFileChunk(chunk)
 
-        if self.archive_generator.is_file_write_in_progress:
-          yield self.archive_generator.WriteFileFooter()
+    if self.archive_generator.is_file_write_in_progress:
+      yield self.archive_generator.WriteFileFooter()
 
-    if clients:
-      for client_urn_batch in utils.Grouper(clients, self.BATCH_SIZE):
+    # All files were read at this point, so the producer thread is done with
+    # self._clients.
+    if self._clients:
+      for client_urn_batch in utils.Grouper(
+          sorted(self._clients), self.BATCH_SIZE):
         for fd in aff4.FACTORY.MultiOpen(
             client_urn_batch, aff4_type=aff4_grr.VFSGRRClient, token=token):
           for chunk in self._GenerateClientInfo(fd):
@@ -206,6 +282,34 @@ class CollectionArchiveGenerator(object):
 
     yield self.archive_generator.Close()
 
+  def Generate(self, collection, token=None, offset=0):
+    """Generates archive from a given collection.
+
+    Iterates the collection and generates an archive by yielding contents
+    of every referenced AFF4Stream. File data is read in a separate thread
+    ahead of the archive output.
+
+    Args:
+      collection: Iterable with items that point to aff4 paths.
+      token: User's ACLToken.
+      offset: Number of bytes at the start of the archive to leave out. This
+          allows resuming an interrupted download, provided the collection has
+          not changed and the archive_time is the same.
+
+    Yields:
+      Binary chunks comprising the generated archive.
+    """
+    for chunk in self._Generate(collection, token=token):
+      if offset >= len(chunk):
+        offset -= len(chunk)
+        continue
+
+      if offset:
+        chunk = chunk[offset:]
+        offset = 0
+
+      yield chunk
+
 
 class ApiDataObjectKeyValuePair(rdf_structs.RDFProtoStruct):
   """Defines a proto for returning key value pairs of data objects."""
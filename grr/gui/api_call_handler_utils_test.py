@@ -184,6 +184,60 @@ class CollectionArchiveGeneratorTest(test_lib.GRRBaseTest):
       client_info = yaml.safe_load(tar_fd.extractfile(client_info_name).read())
       self.assertEqual(client_info["system_info"]["fqdn"], "Host-0.example.com")
 
+  def _GenerateArchiveBytes(self, archive_format, offset=0):
+    archive_generator = api_call_handler_utils.CollectionArchiveGenerator(
+        archive_format=archive_format,
+        prefix="test_prefix",
+        description="Test description",
+        client_id=self.client_id,
+        archive_time=rdfvalue.RDFDatetime.FromSecondsFromEpoch(42))
+    return "".join(
+        archive_generator.Generate(
+            self.stat_entries, token=self.token, offset=offset))
+
+  def testArchiveGeneratedAtOffsetIsRestOfArchive(self):
+    for archive_format in [
+        api_call_handler_utils.CollectionArchiveGenerator.ZIP,
+        api_call_handler_utils.CollectionArchiveGenerator.TAR_GZ
+    ]:
+      with test_lib.FakeTime(42):
+        archive = self._GenerateArchiveBytes(archive_format)
+        for offset in [1, 100, len(archive) - 1, len(archive)]:
+          self.assertEqual(
+              self._GenerateArchiveBytes(archive_format, offset=offset),
+              archive[offset:])
+
+  def testArchiveGeneratedAtOffsetDoesNotDependOnOpenOrder(self):
+    for i in range(5):
+      path = self.client_id.Add("fs/os/foo/bar/file%d.txt" % i)
+      with aff4.FACTORY.Create(
+          path, aff4.AFF4MemoryStream, token=self.token) as fd:
+        fd.Write("content%d" % i)
+      self.stat_entries.append(
+          rdf_client.StatEntry(
+              pathspec=rdf_paths.PathSpec(
+                  path="foo/bar/file%d.txt" % i,
+                  pathtype=rdf_paths.PathSpec.PathType.OS)))
+
+    multi_open = aff4.FACTORY.MultiOpen
+
+    def ReversedMultiOpen(*args, **kwargs):
+      return reversed(list(multi_open(*args, **kwargs)))
+
+    for archive_format in [
+        api_call_handler_utils.CollectionArchiveGenerator.ZIP,
+        api_call_handler_utils.CollectionArchiveGenerator.TAR_GZ
+    ]:
+      with test_lib.FakeTime(42):
+        archive = self._GenerateArchiveBytes(archive_format)
+        # All files are in a single batch, the resumed download must not
+        # depend on the order they are opened in.
+        with utils.Stubber(aff4.FACTORY, "MultiOpen", ReversedMultiOpen):
+          for offset in [100, len(archive) // 2]:
+            self.assertEqual(
+                self._GenerateArchiveBytes(archive_format, offset=offset),
+                archive[offset:])
+
   def testCorrectlyAccountsForFailedFiles(self):
     path2 = (u"aff4:/%s/fs/os/foo/bar/中国新闻网新闻中.txt" % self.client_id.Basename())
     with aff4.FACTORY.Create(path2, aff4.AFF4Image, token=self.token) as fd:
@@ -231,14 +231,12 @@ class ApiFlow(rdf_structs.RDFProtoStruct):
         except ValueError:
           pass
 
-        flow_state_dict = flow_obj.Get(flow_obj.Schema.FLOW_STATE_DICT)
-        if flow_state_dict is not None:
-          flow_state_data = flow_state_dict.ToDict()
-
-          if flow_state_data:
-            self.state_data = (
-                api_call_handler_utils.ApiDataObject()
-                .InitFromDataObject(flow_state_data))
+        # The flow object's state already has all the state deltas applied.
+        flow_state_data = dict(flow_obj.state or {})
+        if flow_state_data:
+          self.state_data = (
+              api_call_handler_utils.ApiDataObject()
+              .InitFromDataObject(flow_state_data))
     except Exception as e:  # pylint: disable=broad-except
       self.internal_error = "Error while opening flow: %s" % str(e)
 
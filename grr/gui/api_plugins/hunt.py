@@ -120,6 +120,10 @@ class ApiFlowLikeObjectReference(rdf_structs.RDFProtoStruct):
     return self
 
 
+class ApiHuntResultTypeCount(rdf_structs.RDFProtoStruct):
+  protobuf = hunt_pb2.ApiHuntResultTypeCount
+
+
 class ApiHunt(rdf_structs.RDFProtoStruct):
   """ApiHunt is used when rendering responses.
 
@@ -130,6 +134,7 @@ class ApiHunt(rdf_structs.RDFProtoStruct):
   protobuf = hunt_pb2.ApiHunt
   rdf_deps = [
       ApiHuntId,
+      ApiHuntResultTypeCount,
       ApiFlowLikeObjectReference,
       foreman.ForemanClientRuleSet,
       rdf_hunts.HuntRunnerArgs,
@@ -184,6 +189,10 @@ class ApiHunt(rdf_structs.RDFProtoStruct):
         self.remaining_clients_count = (
             all_clients_count - completed_clients_count)
 
+        for type_name, count in sorted(hunt.GetResultTypeCounts().items()):
+          self.result_type_counts.Append(
+              ApiHuntResultTypeCount(type_name=type_name, count=count))
+
         self.hunt_runner_args = hunt.runner_args
         self.client_rule_set = runner.runner_args.client_rule_set
 
@@ -468,14 +477,22 @@ class ApiListHuntResultsHandler(api_call_handler_base.ApiCallHandler):
   result_type = ApiListHuntResultsResult
 
   def Handle(self, args, token=None):
+    hunt_urn = args.hunt_id.ToURN()
     results_collection = implementation.GRRHunt.ResultCollectionForHID(
-        args.hunt_id.ToURN())
+        hunt_urn)
     items = api_call_handler_utils.FilterCollection(
         results_collection, args.offset, args.count, args.filter)
     wrapped_items = [ApiHuntResult().InitFromGrrMessage(item) for item in items]
 
+    try:
+      hunt = aff4.FACTORY.Open(
+          hunt_urn, aff4_type=implementation.GRRHunt, token=token)
+      total_count = hunt.GetResultsCount()
+    except aff4.InstantiationError:
+      total_count = len(results_collection)
+
     return ApiListHuntResultsResult(
-        items=wrapped_items, total_count=len(results_collection))
+        items=wrapped_items, total_count=total_count)
 
 
 class ApiListHuntCrashesArgs(rdf_structs.RDFProtoStruct):
@@ -796,12 +813,17 @@ class ApiGetHuntClientCompletionStatsHandler(
         mode="r",
         token=token)
 
-    clients_by_status = hunt.GetClientsByStatus()
-    started_clients = clients_by_status["STARTED"]
-    completed_clients = clients_by_status["COMPLETED"]
+    if hunt.completion_stats is not None:
+      start_stats, complete_stats = self._SampleCompletionStats(
+          hunt.completion_stats)
+    else:
+      # Hunts created before completion stats were maintained.
+      clients_by_status = hunt.GetClientsByStatus()
+      started_clients = clients_by_status["STARTED"]
+      completed_clients = clients_by_status["COMPLETED"]
 
-    (start_stats, complete_stats) = self._SampleClients(started_clients,
-                                                        completed_clients)
+      (start_stats, complete_stats) = self._SampleClients(
+          started_clients, completed_clients)
 
     if len(start_stats) > target_size:
       # start_stats and complete_stats are equally big, so resample both
@@ -811,6 +833,33 @@ class ApiGetHuntClientCompletionStatsHandler(
     return ApiGetHuntClientCompletionStatsResult().InitFromDataPoints(
         start_stats, complete_stats)
 
+  def _SampleCompletionStats(self, completion_stats):
+    """Turns the hunt's completion histogram into cumulative data points."""
+    buckets = [
+        b for b in completion_stats.buckets
+        if b.started_clients or b.completed_clients
+    ]
+    if not buckets:
+      return ([], [])
+
+    t0 = buckets[0].start_time - 1
+    times = [0]
+    cl = [0]
+    fi = [0]
+
+    cl_count = 0
+    fi_count = 0
+    for bucket in buckets:
+      cl_count += bucket.started_clients
+      fi_count += bucket.completed_clients
+
+      # Convert to hours, starting from 0.
+      times.append((bucket.start_time - t0) / 3600.0)
+      cl.append(cl_count)
+      fi.append(fi_count)
+
+    return (zip(times, cl), zip(times, fi))
+
   def _SampleClients(self, started_clients, completed_clients):
     # immediately return on empty client data
     if not started_clients and not completed_clients:
@@ -905,7 +954,8 @@ class ApiGetHuntFilesArchiveHandler(api_call_handler_base.ApiCallHandler):
         mode="rw",
         token=token)
     try:
-      for item in generator.Generate(collection, token=token):
+      for item in generator.Generate(
+          collection, token=token, offset=args.offset):
         yield item
 
       user.Notify("ArchiveGenerationFinished", None,
@@ -946,10 +996,13 @@ class ApiGetHuntFilesArchiveHandler(api_call_handler_base.ApiCallHandler):
     else:
       raise ValueError("Unknown archive format: %s" % args.archive_format)
 
+    # Using the hunt's creation time as the time of all files makes the
+    # archive reproducible, so that downloads can be resumed.
     generator = api_call_handler_utils.CollectionArchiveGenerator(
         prefix=target_file_prefix,
         description=description,
-        archive_format=archive_format)
+        archive_format=archive_format,
+        archive_time=hunt.context.create_time)
     content_generator = self._WrapContentGenerator(
         generator, collection, args, token=token)
     return api_call_handler_base.ApiBinaryStream(
@@ -1007,7 +1060,7 @@ class ApiGetHuntFileHandler(api_call_handler_base.ApiCallHandler):
 
     # If the entry corresponding to a given path is not found within
     # MAX_RECORDS_TO_CHECK from a given timestamp, we report a 404.
-    for _, item in results.Scan(
+    for _, item in results.ScanResolved(
         after_timestamp=timestamp.AsMicroSecondsFromEpoch(),
         max_records=self.MAX_RECORDS_TO_CHECK):
       try:
@@ -14,6 +14,7 @@ from grr.lib import utils
 
 from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import structs as rdf_structs
 
 
 class CommunicatorInit(registry.InitHook):
@@ -30,6 +31,11 @@ class CommunicatorInit(registry.InitHook):
 
     stats.STATS.RegisterCounterMetric(
         "grr_encrypted_cipher_cache", fields=[("type", str)])
+    # RSA decryptions and signature verifications skipped because a verified
+    # cipher was found in a cache.
+    stats.STATS.RegisterCounterMetric("grr_rsa_operations_avoided")
+    stats.STATS.RegisterCounterMetric(
+        "grr_message_list_compression", fields=[("result", str)])
 
 
 class Error(stats.CountingExceptionMixin, Exception):
@@ -160,6 +166,31 @@ class ReceivedCipher(Cipher):
     except (rdf_crypto.InvalidSignature, rdf_crypto.CipherError) as e:
       raise DecryptionError(e)
 
+  @classmethod
+  def FromVerifiedCipher(cls, serialized_cipher, serialized_metadata,
+                         private_key):
+    """Recreates a cipher whose signature was verified before.
+
+    Unlike the constructor, this does not need any RSA operations.
+
+    Args:
+      serialized_cipher: The decrypted, serialized CipherProperties.
+      serialized_metadata: The serialized CipherMetadata.
+      private_key: Our own private key.
+
+    Returns:
+      A ReceivedCipher.
+    """
+    result = cls.__new__(cls)
+    result.private_key = private_key
+    result.response_comms = None
+    result.serialized_cipher = serialized_cipher
+    result.cipher = rdf_flows.CipherProperties.FromSerializedString(
+        serialized_cipher)
+    result.cipher_metadata = rdf_flows.CipherMetadata.FromSerializedString(
+        serialized_metadata)
+    return result
+
   def GetSource(self):
     return self.cipher_metadata.source
 
@@ -260,6 +291,24 @@ class Communicator(object):
   """A class responsible for encoding and decoding comms."""
   server_name = None
 
+  # Messages are decompressed in chunks of at most this size.
+  DECOMPRESSION_CHUNK_SIZE = 1024 * 1024
+
+  # Message lists larger than this are only compressed if compressing a few
+  # samples of COMPRESSIBILITY_SAMPLE_SIZE bytes with zlib level 1 shrinks them
+  # to less than COMPRESSIBILITY_MAX_RATIO of their size.
+  COMPRESSIBILITY_CHECK_THRESHOLD = 64 * 1024
+  COMPRESSIBILITY_SAMPLES = 4
+  COMPRESSIBILITY_SAMPLE_SIZE = 4096
+  COMPRESSIBILITY_MAX_RATIO = 0.9
+
+  # The zlib level used to compress outgoing message lists.
+  compression_level = zlib.Z_DEFAULT_COMPRESSION
+
+  # The encoded tag of the MessageList.job field.
+  _MESSAGE_LIST_JOB_TAG = rdf_structs.VarintEncode(
+      (1 << rdf_structs.TAG_TYPE_BITS) | rdf_structs.WIRETYPE_LENGTH_DELIMITED)
+
   def __init__(self, certificate=None, private_key=None):
     """Creates a communicator.
 
@@ -274,20 +323,87 @@ class Communicator(object):
     # A cache for encrypted ciphers
     self.encrypted_cipher_cache = utils.FastStore(max_size=50000)
 
+    # An optional second cache tier shared with other processes. It needs to
+    # provide Get(encrypted_cipher, private_key), which returns a verified
+    # ReceivedCipher or raises KeyError, and Put(encrypted_cipher, cipher).
+    self.shared_cipher_cache = None
+
+  def _GetVerifiedCipher(self, encrypted_cipher):
+    """Returns a cached verified cipher or raises KeyError."""
+    try:
+      return self.encrypted_cipher_cache.Get(encrypted_cipher)
+    except KeyError:
+      if self.shared_cipher_cache is None:
+        raise
+
+    try:
+      cipher = self.shared_cipher_cache.Get(encrypted_cipher, self.private_key)
+    except KeyError:
+      stats.STATS.IncrementCounter(
+          "grr_encrypted_cipher_cache", fields=["shared_misses"])
+      raise
+
+    stats.STATS.IncrementCounter(
+        "grr_encrypted_cipher_cache", fields=["shared_hits"])
+    self.encrypted_cipher_cache.Put(encrypted_cipher, cipher)
+    return cipher
+
+  def _PutVerifiedCipher(self, encrypted_cipher, cipher):
+    self.encrypted_cipher_cache.Put(encrypted_cipher, cipher)
+    if self.shared_cipher_cache is not None:
+      self.shared_cipher_cache.Put(encrypted_cipher, cipher)
+
+  @classmethod
+  def _IsCompressible(cls, data):
+    """Estimates if data is worth compressing by compressing a few samples."""
+    if len(data) < cls.COMPRESSIBILITY_CHECK_THRESHOLD:
+      return True
+
+    step = len(data) // cls.COMPRESSIBILITY_SAMPLES
+    sample = "".join(
+        data[offset:offset + cls.COMPRESSIBILITY_SAMPLE_SIZE]
+        for offset in xrange(0, len(data), step))
+    return (len(zlib.compress(sample, 1)) <
+            len(sample) * cls.COMPRESSIBILITY_MAX_RATIO)
+
   @classmethod
-  def EncodeMessageList(cls, message_list, packed_message_list):
-    """Encode the MessageList into the packed_message_list rdfvalue."""
+  def EncodeMessageList(cls,
+                        message_list,
+                        packed_message_list,
+                        compression_level=zlib.Z_DEFAULT_COMPRESSION):
+    """Encode the MessageList into the packed_message_list rdfvalue.
+
+    Args:
+      message_list: The MessageList to encode.
+      packed_message_list: The PackedMessageList to fill in.
+      compression_level: The zlib compression level to use, 0 disables
+        compression.
+    """
     # By default uncompress
     uncompressed_data = message_list.SerializeToString()
     packed_message_list.message_list = uncompressed_data
 
-    compressed_data = zlib.compress(uncompressed_data)
+    if compression_level == 0:
+      return
+
+    # Don't spend CPU on data that is already compressed, e.g. file contents.
+    if not cls._IsCompressible(uncompressed_data):
+      stats.STATS.IncrementCounter(
+          "grr_message_list_compression", fields=["incompressible"])
+      return
+
+    compressed_data = zlib.compress(uncompressed_data, compression_level)
 
     # Only compress if it buys us something.
     if len(compressed_data) < len(uncompressed_data):
+      stats.STATS.IncrementCounter(
+          "grr_message_list_compression", fields=["compressed"])
       packed_message_list.compression = (
           rdf_flows.PackedMessageList.CompressionType.ZCOMPRESSION)
       packed_message_list.message_list = compressed_data
+    else:
+      stats.STATS.IncrementCounter(
+          "grr_message_list_compression", fields=["not_smaller"])
 
   def _ClearServerCipherCache(self):
     self.server_cipher = None
@@ -359,7 +475,10 @@ class Communicator(object):
       self.timestamp = timestamp = long(time.time() * 1000000)
 
     packed_message_list = rdf_flows.PackedMessageList(timestamp=timestamp)
-    self.EncodeMessageList(message_list, packed_message_list)
+    self.EncodeMessageList(
+        message_list,
+        packed_message_list,
+        compression_level=self.compression_level)
 
     result.encrypted_cipher_metadata = cipher.encrypted_cipher_metadata
 
@@ -400,40 +519,98 @@ class Communicator(object):
     Returns:
        a Packed_Message_List rdfvalue
     """
+    return self.DecryptCommunication(encrypted_response)[1:]
+
+  def DecryptCommunication(self, encrypted_response):
+    """Decrypt the serialized, encrypted string.
+
+    Args:
+       encrypted_response: A serialized and encrypted string.
+
+    Returns:
+       A tuple of the ClientCommunication rdfvalue, the list of messages, the
+       CN where they came from and their timestamp.
+    """
     try:
       response_comms = rdf_flows.ClientCommunication.FromSerializedString(
           encrypted_response)
-      return self.DecodeMessages(response_comms)
+      return (response_comms,) + self.DecodeMessages(response_comms)
     except (rdfvalue.DecodeError, type_info.TypeValueError, ValueError,
             AttributeError) as e:
       raise DecodingError("Error while decrypting messages: %s" % e)
 
   @classmethod
-  def DecompressMessageList(cls, packed_message_list):
-    """Decompress the message data from packed_message_list.
+  def _DecompressChunks(cls, packed_message_list, max_size=None):
+    """Yields the decompressed message data of packed_message_list in chunks.
 
     Args:
       packed_message_list: A PackedMessageList rdfvalue with some data in it.
+      max_size: If given, the maximum number of bytes the data may decompress
+        to.
 
-    Returns:
-      a MessageList rdfvalue.
+    Yields:
+      Strings of at most DECOMPRESSION_CHUNK_SIZE bytes for compressed data.
 
     Raises:
-      DecodingError: If decompression fails.
+      DecodingError: If decompression fails or the data is too large.
     """
+    data = packed_message_list.message_list
     compression = packed_message_list.compression
     if compression == rdf_flows.PackedMessageList.CompressionType.UNCOMPRESSED:
-      data = packed_message_list.message_list
+      if max_size and len(data) > max_size:
+        raise DecodingError("Message list exceeds %d bytes." % max_size)
+      yield data
 
     elif (compression ==
           rdf_flows.PackedMessageList.CompressionType.ZCOMPRESSION):
+      decompressor = zlib.decompressobj()
+      decompressed_size = 0
+      while data:
+        try:
+          chunk = decompressor.decompress(data, cls.DECOMPRESSION_CHUNK_SIZE)
+        except zlib.error as e:
+          raise DecodingError("Failed to decompress: %s" % e)
+
+        data = decompressor.unconsumed_tail
+        decompressed_size += len(chunk)
+        if max_size and decompressed_size > max_size:
+          raise DecodingError(
+              "Message list decompresses to more than %d bytes." % max_size)
+
+        yield chunk
+
       try:
-        data = zlib.decompress(packed_message_list.message_list)
+        chunk = decompressor.flush()
       except zlib.error as e:
         raise DecodingError("Failed to decompress: %s" % e)
+
+      decompressed_size += len(chunk)
+      if max_size and decompressed_size > max_size:
+        raise DecodingError(
+            "Message list decompresses to more than %d bytes." % max_size)
+
+      yield chunk
+
     else:
       raise DecodingError("Compression scheme not supported")
 
+  @classmethod
+  def DecompressMessageList(cls, packed_message_list, max_size=None):
+    """Decompress the message data from packed_message_list.
+
+    Args:
+      packed_message_list: A PackedMessageList rdfvalue with some data in it.
+      max_size: If given, the maximum number of bytes the data may decompress
+        to.
+
+    Returns:
+      a MessageList rdfvalue.
+
+    Raises:
+      DecodingError: If decompression fails.
+    """
+    data = "".join(cls._DecompressChunks(packed_message_list, max_size=max_size))
+
     try:
       result = rdf_flows.MessageList.FromSerializedString(data)
     except rdfvalue.DecodeError:
@@ -441,14 +618,77 @@ class Communicator(object):
 
     return result
 
-  def DecodeMessages(self, response_comms):
-    """Extract and verify server message.
+  @classmethod
+  def IterateMessageList(cls, packed_message_list, max_size=None):
+    """Decompresses and parses the messages in packed_message_list lazily.
+
+    Unlike DecompressMessageList, this never holds more than the current
+    decompressed chunk and the message being parsed in memory.
+
+    Args:
+      packed_message_list: A PackedMessageList rdfvalue with some data in it.
+      max_size: If given, the maximum number of bytes the data may decompress
+        to.
+
+    Yields:
+      The GrrMessages in the MessageList.
+
+    Raises:
+      DecodingError: If decompression or parsing fails.
+    """
+    pending = []
+    pending_size = 0
+    # The number of bytes needed to parse the next message.
+    required_size = 0
+
+    for chunk in cls._DecompressChunks(packed_message_list, max_size=max_size):
+      pending.append(chunk)
+      pending_size += len(chunk)
+      if pending_size < required_size:
+        continue
+
+      buf = "".join(pending)
+      pos = 0
+      required_size = 0
+      while pos < len(buf):
+        try:
+          encoded_tag, data_pos = rdf_structs.ReadTag(buf, pos)
+          length, start = rdf_structs.VarintReader(buf, data_pos)
+        except (IndexError, ValueError):
+          # The field header is not complete yet.
+          required_size = len(buf) - pos + 1
+          break
+
+        end = start + length
+        if end > len(buf):
+          required_size = end - pos
+          break
+
+        if encoded_tag != cls._MESSAGE_LIST_JOB_TAG:
+          raise DecodingError("Unexpected field in message list.")
+
+        try:
+          yield rdf_flows.GrrMessage.FromSerializedString(buf[start:end])
+        except rdfvalue.DecodeError:
+          raise DecodingError("RDFValue parsing failed.")
+
+        pos = end
+
+      pending = [buf[pos:]]
+      pending_size = len(pending[0])
+
+    if pending_size:
+      raise DecodingError("Truncated message list.")
+
+  def _DecryptPackedMessageList(self, response_comms):
+    """Verifies and decrypts the PackedMessageList in response_comms.
 
     Args:
         response_comms: A ClientCommunication rdfvalue
 
     Returns:
-       list of messages and the CN where they came from.
+       A tuple of the PackedMessageList, the cipher and the authorization state
+       of the messages.
 
     Raises:
        DecryptionError: If the message failed to decrypt properly.
@@ -456,9 +696,11 @@ class Communicator(object):
     # Have we seen this cipher before?
     cipher_verified = False
     try:
-      cipher = self.encrypted_cipher_cache.Get(response_comms.encrypted_cipher)
+      cipher = self._GetVerifiedCipher(response_comms.encrypted_cipher)
       stats.STATS.IncrementCounter(
           "grr_encrypted_cipher_cache", fields=["hits"])
+      # Decrypting the cipher and verifying its signature.
+      stats.STATS.IncrementCounter("grr_rsa_operations_avoided", delta=2)
 
       # Even though we have seen this encrypted cipher already, we should still
       # make sure that all the other fields are sane and verify the HMAC.
@@ -479,8 +721,7 @@ class Communicator(object):
         remote_public_key = self._GetRemotePublicKey(source)
         if cipher.VerifyCipherSignature(remote_public_key):
           # At this point we know this cipher is legit, we can cache it.
-          self.encrypted_cipher_cache.Put(response_comms.encrypted_cipher,
-                                          cipher)
+          self._PutVerifiedCipher(response_comms.encrypted_cipher, cipher)
           cipher_verified = True
 
       except UnknownClientCert:
@@ -495,8 +736,6 @@ class Communicator(object):
     except rdfvalue.DecodeError as e:
       raise DecryptionError(str(e))
 
-    message_list = self.DecompressMessageList(packed_message_list)
-
     # Are these messages authenticated?
     # pyformat: disable
     auth_state = self.VerifyMessageSignature(
@@ -508,6 +747,25 @@ class Communicator(object):
         remote_public_key)
     # pyformat: enable
 
+    return packed_message_list, cipher, auth_state
+
+  def DecodeMessages(self, response_comms):
+    """Extract and verify server message.
+
+    Args:
+        response_comms: A ClientCommunication rdfvalue
+
+    Returns:
+       list of messages and the CN where they came from.
+
+    Raises:
+       DecryptionError: If the message failed to decrypt properly.
+    """
+    packed_message_list, cipher, auth_state = self._DecryptPackedMessageList(
+        response_comms)
+
+    message_list = self.DecompressMessageList(packed_message_list)
+
     # Mark messages as authenticated and where they came from.
     for msg in message_list.job:
       msg.auth_state = auth_state
@@ -516,6 +774,39 @@ class Communicator(object):
     return (message_list.job, cipher.cipher_metadata.source,
             packed_message_list.timestamp)
 
+  def DecodeMessageStream(self, response_comms, max_size=None):
+    """Like DecodeMessages but decompresses and parses messages lazily.
+
+    Decryption and all authentication checks happen before this returns, only
+    decompressing and parsing the messages is deferred.
+
+    Args:
+        response_comms: A ClientCommunication rdfvalue
+        max_size: If given, the maximum number of bytes the messages may
+          decompress to.
+
+    Returns:
+       A generator of messages, the CN where they came from and the timestamp.
+       The generator raises DecodingError if the messages can not be parsed
+       or are too large.
+
+    Raises:
+       DecryptionError: If the message failed to decrypt properly.
+    """
+    packed_message_list, cipher, auth_state = self._DecryptPackedMessageList(
+        response_comms)
+    source = cipher.cipher_metadata.source
+
+    def Messages():
+      for msg in self.IterateMessageList(
+          packed_message_list, max_size=max_size):
+        # Mark messages as authenticated and where they came from.
+        msg.auth_state = auth_state
+        msg.source = source
+        yield msg
+
+    return Messages(), source, packed_message_list.timestamp
+
   def VerifyMessageSignature(self, unused_response_comms, packed_message_list,
                              cipher, cipher_verified, api_version,
                              remote_public_key):
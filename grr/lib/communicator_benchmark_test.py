@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Benchmarks for compressing client/server message lists."""
+
+import os
+import zlib
+
+import pytest
+
+from grr.lib import communicator
+from grr.lib import flags
+from grr.lib import utils
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.test_lib import benchmark_test_lib
+from grr.test_lib import test_lib
+
+
+def _TextMessageList(count=500):
+  """Messages similar to file listings and process lists."""
+  message_list = rdf_flows.MessageList()
+  for i in xrange(count):
+    message_list.job.Append(
+        session_id="aff4:/C.1000000000000000/flows/W:ABCDEF%d" % (i % 10),
+        request_id=1,
+        response_id=i,
+        name="ListDirectory",
+        args=("/usr/lib/python2.7/dist-packages/module_%d.py "
+              "st_mode=33188 st_size=%d st_uid=0 st_gid=0 " % (i, i * 137)) * 4)
+  return message_list
+
+
+def _BlobMessageList(count=100):
+  """Messages similar to TransferBuffer uploads of compressed blobs."""
+  message_list = rdf_flows.MessageList()
+  for i in xrange(count):
+    message_list.job.Append(
+        session_id="aff4:/flows/W:TransferStore",
+        response_id=i,
+        name="TransferBuffer",
+        args=zlib.compress(os.urandom(16 * 1024)))
+  return message_list
+
+
+@pytest.mark.benchmark
+class MessageListCompressionBenchmark(
+    benchmark_test_lib.AverageMicroBenchmarks):
+  """Compares CPU time and size of message lists for compression settings.
+
+  The value column is the size of the encoded message list in bytes.
+  """
+
+  REPEATS = 20
+  units = "ms"
+
+  def _Encode(self, message_list, compression_level):
+    packed_message_list = rdf_flows.PackedMessageList()
+    communicator.Communicator.EncodeMessageList(
+        message_list,
+        packed_message_list,
+        compression_level=compression_level)
+    return packed_message_list
+
+  def _BenchmarkEncoding(self, name, message_list):
+    for level in [0, 1, 6, 9]:
+      self.TimeIt(
+          lambda: len(self._Encode(message_list, level).message_list),
+          name="%s, encode level %d" % (name, level))
+
+      packed_message_list = self._Encode(message_list, level)
+      self.TimeIt(
+          lambda: len(communicator.Communicator.DecompressMessageList(
+              packed_message_list).job),
+          name="%s, decode level %d" % (name, level))
+
+  def testTextMessages(self):
+    """Compression of compressible messages."""
+    self._BenchmarkEncoding("text", _TextMessageList())
+
+  def testBlobMessages(self):
+    """Compression of already compressed messages."""
+    message_list = _BlobMessageList()
+    self._BenchmarkEncoding("blobs", message_list)
+
+    # The same without the compressibility check.
+    with utils.Stubber(communicator.Communicator, "_IsCompressible",
+                       classmethod(lambda cls, data: True)):
+      self.TimeIt(
+          lambda: len(self._Encode(message_list, 6).message_list),
+          name="blobs, encode level 6 unchecked")
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -3,6 +3,7 @@
 
 from grr.lib import flags
 from grr.lib import rdfvalue
+from grr.lib import utils
 from grr.lib.rdfvalues import test_base
 from grr.server import aff4
 from grr.server import data_store
@@ -608,6 +609,270 @@ class ForemanIntegerClientRuleTestRelational(
       r.Evaluate(info)
 
 
+class ForemanRuleIndexTest(test_lib.GRRBaseTest):
+  """Tests that the rule index matches like evaluating every rule set."""
+
+  def _GetClient(self, last_boot_time):
+    client_id = self.SetupClient(
+        0, system="Linux", last_boot_time=last_boot_time)
+    client_obj = aff4.FACTORY.Open(client_id, mode="rw", token=self.token)
+    client_obj.SetLabels(["hello", "world"], owner="GRR")
+    return client_obj
+
+  def _OsRule(self, **kwargs):
+    return rdf_foreman.ForemanClientRule(
+        rule_type=rdf_foreman.ForemanClientRule.Type.OS,
+        os=rdf_foreman.ForemanOsClientRule(**kwargs))
+
+  def _LabelRule(self, match_mode, label_names):
+    return rdf_foreman.ForemanClientRule(
+        rule_type=rdf_foreman.ForemanClientRule.Type.LABEL,
+        label=rdf_foreman.ForemanLabelClientRule(
+            match_mode=match_mode, label_names=label_names))
+
+  def _IntegerRule(self, operator, value):
+    return rdf_foreman.ForemanClientRule(
+        rule_type=rdf_foreman.ForemanClientRule.Type.INTEGER,
+        integer=rdf_foreman.ForemanIntegerClientRule(
+            field="LAST_BOOT_TIME", operator=operator, value=value))
+
+  def _RegexRule(self, field, regex):
+    return rdf_foreman.ForemanClientRule(
+        rule_type=rdf_foreman.ForemanClientRule.Type.REGEX,
+        regex=rdf_foreman.ForemanRegexClientRule(
+            field=field, attribute_regex=regex))
+
+  def _Rules(self, boot_time):
+    label_modes = rdf_foreman.ForemanLabelClientRule.MatchMode
+    operators = rdf_foreman.ForemanIntegerClientRule.Operator
+
+    client_rules = [
+        self._OsRule(os_linux=True),
+        self._OsRule(os_windows=True, os_darwin=True),
+        self._OsRule(),
+        self._RegexRule("SYSTEM", "^Linux$"),
+        self._RegexRule("SYSTEM", "foo"),
+        self._RegexRule("CLIENT_LABELS", "ell"),
+    ]
+    for labels in [[], ["hello"], ["hello", "world"], ["hello", "foo"],
+                   ["foo", "bar"]]:
+      for mode in label_modes.enum_dict.values():
+        client_rules.append(self._LabelRule(mode, labels))
+    for operator in operators.enum_dict.values():
+      for delta in [-1, 0, 1]:
+        client_rules.append(self._IntegerRule(operator, boot_time + delta))
+
+    rules = []
+    for match_mode in [
+        rdf_foreman.ForemanClientRuleSet.MatchMode.MATCH_ALL,
+        rdf_foreman.ForemanClientRuleSet.MatchMode.MATCH_ANY
+    ]:
+      # Every client rule on its own, pairs of neighbours and no rules at all.
+      for i in xrange(len(client_rules)):
+        for rule_set in [client_rules[i:i + 1], client_rules[i:i + 2], []]:
+          rules.append(
+              rdf_foreman.ForemanRule(
+                  created=len(rules),
+                  client_rule_set=rdf_foreman.ForemanClientRuleSet(
+                      match_mode=match_mode, rules=rule_set)))
+
+    return rules
+
+  def testMatchesLikeRuleSetEvaluation(self):
+    now = rdfvalue.RDFDatetime.Now()
+    client = self._GetClient(now)
+    rules = self._Rules(now.AsSecondsFromEpoch())
+
+    expected = [r for r in rules if r.client_rule_set.Evaluate(client)]
+    index = rdf_foreman.ForemanRuleIndex(rules)
+
+    self.assertTrue(expected)
+    self.assertLess(len(expected), len(rules))
+    self.assertEqual(index.MatchingRules(client), expected)
+
+  def testRuleFilter(self):
+    now = rdfvalue.RDFDatetime.Now()
+    client = self._GetClient(now)
+    rules = self._Rules(now.AsSecondsFromEpoch())
+
+    expected = [
+        r for r in rules
+        if r.created % 2 and r.client_rule_set.Evaluate(client)
+    ]
+    index = rdf_foreman.ForemanRuleIndex(rules)
+
+    self.assertEqual(
+        index.MatchingRules(client, rule_filter=lambda r: r.created % 2),
+        expected)
+
+  def testUnsetFieldRaises(self):
+    rule = rdf_foreman.ForemanRule(
+        client_rule_set=rdf_foreman.ForemanClientRuleSet(
+            rules=[
+                rdf_foreman.ForemanClientRule(
+                    rule_type=rdf_foreman.ForemanClientRule.Type.REGEX,
+                    regex=rdf_foreman.ForemanRegexClientRule(
+                        attribute_regex="foo"))
+            ]))
+
+    with self.assertRaises(ValueError):
+      rdf_foreman.ForemanRuleIndex([rule])
+
+
+class ForemanRuleIndexTestRelational(db_test_lib.RelationalDBEnabledMixin,
+                                     ForemanRuleIndexTest):
+
+  def _GetClient(self, last_boot_time):
+    client = self.SetupTestClientObject(
+        0, system="Linux", last_boot_time=last_boot_time)
+    data_store.REL_DB.AddClientLabels(client.client_id, "GRR",
+                                      ["hello", "world"])
+    return data_store.REL_DB.ReadClientFullInfo(client.client_id)
+
+
+class HuntClientRateLimiterTest(test_lib.GRRBaseTest):
+  """Tests the cluster-wide hunt client rate limiter."""
+
+  hunt_id = "aff4:/hunts/H:123456"
+
+  def _StartTimes(self, limiter, count, client_rate=60):
+    start_times = []
+    for _ in range(count):
+      start_time = limiter.GetClientStartTime(self.hunt_id, client_rate)
+      start_times.append(start_time.AsSecondsFromEpoch())
+    return start_times
+
+  def testSpacesOutClientsAccordingToClientRate(self):
+    limiter = rdf_foreman.HuntClientRateLimiter(
+        batch_size=5, batch_window=rdfvalue.Duration("10s"))
+    with test_lib.FakeTime(100):
+      self.assertEqual(
+          self._StartTimes(limiter, 7), [100, 101, 102, 103, 104, 105, 106])
+
+  def testLimitersShareTheRate(self):
+    limiters = [
+        rdf_foreman.HuntClientRateLimiter(
+            batch_size=2, batch_window=rdfvalue.Duration("10s"))
+        for _ in range(2)
+    ]
+    with test_lib.FakeTime(100):
+      start_times = []
+      for _ in range(3):
+        for limiter in limiters:
+          start_times.extend(self._StartTimes(limiter, 2))
+
+    self.assertEqual(sorted(start_times), range(100, 112))
+
+  def testUnusedTimeIsNotSavedUp(self):
+    limiter = rdf_foreman.HuntClientRateLimiter(
+        batch_size=1, batch_window=rdfvalue.Duration("10s"))
+    with test_lib.FakeTime(100):
+      self.assertEqual(self._StartTimes(limiter, 1), [100])
+
+    with test_lib.FakeTime(200):
+      self.assertEqual(self._StartTimes(limiter, 3), [200, 201, 202])
+
+  def testStaleReservedStartTimesAreDropped(self):
+    limiter = rdf_foreman.HuntClientRateLimiter(
+        batch_size=10, batch_window=rdfvalue.Duration("10s"))
+    with test_lib.FakeTime(100):
+      self.assertEqual(self._StartTimes(limiter, 1), [100])
+
+    # The remaining start times reserved at 100 are in the past now, so the
+    # clients have to wait for fresh ones instead of all starting at once.
+    with test_lib.FakeTime(200):
+      self.assertEqual(self._StartTimes(limiter, 2), [200, 201])
+
+  def testForgetsHuntsWithoutReservedStartTimes(self):
+    limiter = rdf_foreman.HuntClientRateLimiter(
+        batch_size=1, batch_window=rdfvalue.Duration("10s"))
+    with test_lib.FakeTime(100):
+      self._StartTimes(limiter, 1)
+
+    self.assertEqual(limiter._start_times, {})
+    self.assertEqual(limiter._hunt_locks, {})
+
+  def testForgetsHuntsThatStoppedGettingClients(self):
+    limiter = rdf_foreman.HuntClientRateLimiter(
+        batch_size=5, batch_window=rdfvalue.Duration("10s"))
+    with test_lib.FakeTime(100):
+      self._StartTimes(limiter, 1)
+    self.assertEqual(limiter._start_times.keys(), [self.hunt_id])
+
+    with test_lib.FakeTime(200):
+      limiter.GetClientStartTime("aff4:/hunts/H:654321", 60)
+
+    self.assertEqual(limiter._start_times.keys(), ["aff4:/hunts/H:654321"])
+    self.assertEqual(limiter._hunt_locks.keys(), ["aff4:/hunts/H:654321"])
+
+  def testReturnsNoStartTimeIfStateCanNotBeLocked(self):
+    limiter = rdf_foreman.HuntClientRateLimiter(
+        batch_size=1, batch_window=rdfvalue.Duration("10s"))
+
+    def LockRetryWrapper(subject, **unused_kwargs):
+      raise data_store.DBSubjectLockError("Subject %s is locked." % subject)
+
+    with test_lib.FakeTime(100):
+      with utils.Stubber(data_store.DB, "LockRetryWrapper", LockRetryWrapper):
+        self.assertIsNone(limiter.GetClientStartTime(self.hunt_id, 60))
+
+      # Nothing was reserved, the next client gets the first start time.
+      self.assertEqual(self._StartTimes(limiter, 1), [100])
+
+
+class ForemanCheckedClientsTest(test_lib.GRRBaseTest):
+  """Tests the record of clients checked against the latest foreman rule."""
+
+  client_ids = ["C.%016X" % i for i in range(100)]
+
+  def _CheckedClients(self):
+    return rdf_foreman.ForemanCheckedClients(
+        size=2**16, max_age=rdfvalue.Duration("10m"))
+
+  def testRemembersCheckedClients(self):
+    checked_clients = self._CheckedClients()
+    latest_rule = rdfvalue.RDFDatetime.FromSecondsFromEpoch(100)
+
+    with test_lib.FakeTime(1000):
+      for client_id in self.client_ids[:50]:
+        checked_clients.MarkChecked(client_id, latest_rule)
+
+      for client_id in self.client_ids[:50]:
+        self.assertTrue(checked_clients.WasChecked(client_id, latest_rule))
+      for client_id in self.client_ids[50:]:
+        self.assertFalse(checked_clients.WasChecked(client_id, latest_rule))
+
+  def testNewRuleClearsCheckedClients(self):
+    checked_clients = self._CheckedClients()
+    latest_rule = rdfvalue.RDFDatetime.FromSecondsFromEpoch(100)
+    new_rule = rdfvalue.RDFDatetime.FromSecondsFromEpoch(200)
+
+    with test_lib.FakeTime(1000):
+      checked_clients.MarkChecked(self.client_ids[0], latest_rule)
+      self.assertFalse(checked_clients.WasChecked(self.client_ids[0], new_rule))
+
+      checked_clients.MarkChecked(self.client_ids[1], new_rule)
+      self.assertTrue(checked_clients.WasChecked(self.client_ids[1], new_rule))
+      self.assertFalse(checked_clients.WasChecked(self.client_ids[0], new_rule))
+      self.assertFalse(
+          checked_clients.WasChecked(self.client_ids[1], latest_rule))
+
+  def testCheckedClientsExpire(self):
+    checked_clients = self._CheckedClients()
+    latest_rule = rdfvalue.RDFDatetime.FromSecondsFromEpoch(100)
+
+    with test_lib.FakeTime(1000):
+      checked_clients.MarkChecked(self.client_ids[0], latest_rule)
+
+    with test_lib.FakeTime(1000 + 9 * 60):
+      self.assertTrue(checked_clients.WasChecked(self.client_ids[0],
+                                                 latest_rule))
+
+    with test_lib.FakeTime(1000 + 10 * 60):
+      self.assertFalse(
+          checked_clients.WasChecked(self.client_ids[0], latest_rule))
+
+
 def main(argv):
   # Run the full test suite
   test_lib.main(argv)
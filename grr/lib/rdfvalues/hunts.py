@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 """RDFValue implementations for hunts."""
 
+import threading
 
 from grr import config
 from grr.lib import rdfvalue
+from grr.lib import utils
 from grr.lib.rdfvalues import client
 from grr.lib.rdfvalues import flows
 from grr.lib.rdfvalues import stats
@@ -22,16 +24,97 @@ class HuntNotification(rdf_structs.RDFProtoStruct):
   ]
 
 
+class HuntResultTypeCount(rdf_structs.RDFProtoStruct):
+  protobuf = flows_pb2.HuntResultTypeCount
+
+
 class HuntContext(rdf_structs.RDFProtoStruct):
   protobuf = flows_pb2.HuntContext
   rdf_deps = [
       client.ClientResources,
       stats.ClientResourcesStats,
+      HuntResultTypeCount,
       rdfvalue.RDFDatetime,
       rdfvalue.SessionID,
   ]
 
 
+class HuntClientCompletionBucket(rdf_structs.RDFProtoStruct):
+  protobuf = flows_pb2.HuntClientCompletionBucket
+
+
+class HuntClientCompletionStats(rdf_structs.RDFProtoStruct):
+  """Client counts and a completion histogram of a hunt.
+
+  The hunt updates these as clients get started and completed, so they don't
+  have to be computed from the clients collections.
+  """
+  protobuf = flows_pb2.HuntClientCompletionStats
+  rdf_deps = [
+      HuntClientCompletionBucket,
+  ]
+
+  MAX_BUCKETS = 1000
+
+  def __init__(self, initializer=None, **kwargs):
+    super(HuntClientCompletionStats, self).__init__(
+        initializer=initializer, **kwargs)
+    self.lock = threading.RLock()
+
+  def _GetBucket(self, timestamp):
+    """Returns the bucket for the timestamp, creating it if needed."""
+    seconds = int(timestamp.AsSecondsFromEpoch())
+    start_time = seconds - seconds % self.bucket_size
+
+    # Clients are almost always registered in order, so we look from the end.
+    for bucket in reversed(self.buckets):
+      if bucket.start_time == start_time:
+        return bucket
+      if bucket.start_time < start_time:
+        break
+
+    self.buckets = sorted(
+        list(self.buckets) + [HuntClientCompletionBucket(start_time=start_time)],
+        key=lambda b: b.start_time)
+
+    if len(self.buckets) > self.MAX_BUCKETS:
+      self._Compact()
+
+    return self._GetBucket(timestamp)
+
+  def _Compact(self):
+    """Doubles the bucket size and merges the buckets accordingly."""
+    self.bucket_size *= 2
+    merged = []
+    for bucket in self.buckets:
+      start_time = bucket.start_time - bucket.start_time % self.bucket_size
+      if merged and merged[-1].start_time == start_time:
+        merged[-1].started_clients += bucket.started_clients
+        merged[-1].completed_clients += bucket.completed_clients
+      else:
+        merged.append(
+            HuntClientCompletionBucket(
+                start_time=start_time,
+                started_clients=bucket.started_clients,
+                completed_clients=bucket.completed_clients))
+
+    self.buckets = merged
+
+  @utils.Synchronized
+  def RegisterStartedClient(self, timestamp):
+    self.started_clients_count += 1
+    self._GetBucket(timestamp).started_clients += 1
+
+  @utils.Synchronized
+  def RegisterCompletedClient(self, timestamp):
+    self.completed_clients_count += 1
+    self._GetBucket(timestamp).completed_clients += 1
+
+  @utils.Synchronized
+  def RegisterClientError(self):
+    self.clients_errors_count += 1
+
+
 class HuntReference(rdf_structs.RDFProtoStruct):
   protobuf = flows_pb2.HuntReference
 
@@ -228,6 +228,10 @@ class FastStore(object):
     self._limit = max_size
     self.lock = threading.RLock()
 
+  @property
+  def max_size(self):
+    return self._limit
+
   def KillObject(self, obj):
     """Perform cleanup on objects when they expire.
 
@@ -4,6 +4,7 @@
 import logging
 import re
 import StringIO
+import threading
 import time
 
 
@@ -408,6 +409,30 @@ class GRRForeman(aff4.AFF4Object):
         creates_new_object_version=False,
         default=rdf_foreman.ForemanRules())
 
+  # The rules are compiled into an index once and shared by all foreman
+  # objects until they change.
+  _rule_index_lock = threading.Lock()
+  _rule_index_cache = (None, None)
+  _client_rate_limiter = None
+
+  def _GetRuleIndex(self, rules):
+    """Returns a ForemanRuleIndex for the rules."""
+    serialized_rules = rules.SerializeToString()
+    with GRRForeman._rule_index_lock:
+      cached_rules, index = GRRForeman._rule_index_cache
+      if serialized_rules != cached_rules:
+        index = rdf_foreman.ForemanRuleIndex(rules)
+        GRRForeman._rule_index_cache = (serialized_rules, index)
+
+    return index
+
+  def _GetClientRateLimiter(self):
+    with GRRForeman._rule_index_lock:
+      if GRRForeman._client_rate_limiter is None:
+        GRRForeman._client_rate_limiter = rdf_foreman.HuntClientRateLimiter()
+
+    return GRRForeman._client_rate_limiter
+
   def ExpireRules(self):
     """Removes any rules with an expiration date in the past."""
     rules = self.Get(self.Schema.RULES)
@@ -448,10 +473,6 @@ class GRRForeman(aff4.AFF4Object):
 
     return False
 
-  def _EvaluateRules(self, rule, client):
-    """Evaluates the rules."""
-    return rule.client_rule_set.Evaluate(client)
-
   def _RunActions(self, rule, client_id):
     """Run all the actions specified in the rule.
 
@@ -478,8 +499,14 @@ class GRRForeman(aff4.AFF4Object):
             logging.info("Foreman: Starting hunt %s on client %s.",
                          action.hunt_id, client_id)
 
+            start_time = None
+            if action.client_rate > 0:
+              start_time = self._GetClientRateLimiter().GetClientStartTime(
+                  action.hunt_id, action.client_rate)
+
             flow_cls = flow.GRRFlow.classes[action.hunt_name]
-            flow_cls.StartClients(action.hunt_id, [client_id])
+            flow_cls.StartClients(
+                action.hunt_id, [client_id], start_time=start_time)
             actions_count += 1
         else:
           flow.GRRFlow.StartFlow(
@@ -520,11 +547,13 @@ class GRRForeman(aff4.AFF4Object):
   def _SetLastForemanRunRelational(self, client_id, latest_rule):
     data_store.REL_DB.WriteClientMetadata(client_id, last_foreman=latest_rule)
 
-  def AssignTasksToClient(self, client_id):
+  def AssignTasksToClient(self, client_id, checked_clients=None):
     """Examines our rules and starts up flows based on the client.
 
     Args:
       client_id: Client id of the client for tasks to be assigned.
+      checked_clients: An optional rdf_foreman.ForemanCheckedClients. Clients
+        in it are not checked again, clients checked here are added to it.
 
     Returns:
       Number of assigned tasks.
@@ -533,14 +562,20 @@ class GRRForeman(aff4.AFF4Object):
     if not rules:
       return 0
 
+    latest_rule = max(rule.created for rule in rules)
+
+    if checked_clients is not None:
+      if checked_clients.WasChecked(client_id, latest_rule):
+        return 0
+
     if data_store.RelationalDBReadEnabled():
       last_foreman_run = self._GetLastForemanRunRelational(client_id)
     else:
       last_foreman_run = self._GetLastForemanRun(client_id)
 
-    latest_rule = max(rule.created for rule in rules)
-
     if latest_rule <= last_foreman_run:
+      if checked_clients is not None:
+        checked_clients.MarkChecked(client_id, latest_rule)
       return 0
 
     # Update the latest checked rule on the client.
@@ -555,19 +590,14 @@ class GRRForeman(aff4.AFF4Object):
     if not data_store.RelationalDBReadEnabled():
       self._SetLastForemanRun(client_id, latest_rule)
 
-    relevant_rules = []
-    expired_rules = False
+    if checked_clients is not None:
+      checked_clients.MarkChecked(client_id, latest_rule)
 
     now = time.time() * 1e6
+    expired_rules = any(rule.expires < now for rule in rules)
 
-    for rule in rules:
-      if rule.expires < now:
-        expired_rules = True
-        continue
-      if rule.created <= int(last_foreman_run):
-        continue
-
-      relevant_rules.append(rule)
+    def _IsRelevant(rule):
+      return rule.expires >= now and rule.created > int(last_foreman_run)
 
     if data_store.RelationalDBReadEnabled():
       client_data = data_store.REL_DB.ReadClientFullInfo(client_id)
@@ -575,9 +605,9 @@ class GRRForeman(aff4.AFF4Object):
       client_data = aff4.FACTORY.Open(client_id, mode="rw", token=self.token)
 
     actions_count = 0
-    for rule in relevant_rules:
-      if self._EvaluateRules(rule, client_data):
-        actions_count += self._RunActions(rule, client_id)
+    index = self._GetRuleIndex(rules)
+    for rule in index.MatchingRules(client_data, rule_filter=_IsRelevant):
+      actions_count += self._RunActions(rule, client_id)
 
     if expired_rules:
       self.ExpireRules()
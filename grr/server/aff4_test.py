@@ -2171,6 +2171,39 @@ class ForemanTests(aff4_test_lib.AFF4ObjectTest):
       self.assertEqual(len(notifications), 1)
       self.assertEqual(notifications[0].session_id, hunt_id)
 
+  def testCheckedClientsAreNotLookedUpAgain(self):
+    client_id = "C.0000000000000021"
+    with aff4.FACTORY.Create(
+        client_id, aff4_grr.VFSGRRClient, token=self.token) as fd:
+      fd.Set(fd.Schema.SYSTEM, rdfvalue.RDFString("Linux"))
+
+    with aff4.FACTORY.Open(
+        "aff4:/foreman", mode="rw", token=self.token) as foreman:
+      now = time.time() * 1e6
+      rule = rdf_foreman.ForemanRule(
+          created=int(now),
+          expires=int(now + 3600 * 1e6),
+          description="Test rule")
+      rule_set = foreman.Schema.RULES()
+      rule_set.Append(rule)
+      foreman.Set(foreman.Schema.RULES, rule_set)
+
+    lookups = []
+    get_last_foreman_run = aff4_grr.GRRForeman._GetLastForemanRun
+
+    def GetLastForemanRun(foreman, client_id):
+      lookups.append(client_id)
+      return get_last_foreman_run(foreman, client_id)
+
+    checked_clients = rdf_foreman.ForemanCheckedClients()
+    with utils.Stubber(aff4_grr.GRRForeman, "_GetLastForemanRun",
+                       GetLastForemanRun):
+      foreman = aff4.FACTORY.Open("aff4:/foreman", mode="rw", token=self.token)
+      for _ in range(3):
+        foreman.AssignTasksToClient(client_id, checked_clients=checked_clients)
+
+    self.assertEqual(lookups, [client_id])
+
 
 def main(argv):
   # Run the full test suite
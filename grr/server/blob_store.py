@@ -29,6 +29,22 @@ class Blobstore(object):
       A list of identifiers, one for each stored blob.
     """
 
+  def StoreHashedBlobs(self, contents_by_digest, token=None):
+    """Creates or overwrites blobs whose digests are already known.
+
+    Callers that computed the sha256 digests of the blobs anyway (e.g. while
+    decompressing them) can use this to avoid hashing the data again.
+
+    Args:
+      contents_by_digest: A dict mapping hex encoded sha256 digests to the data
+        of the blob.
+      token: Data store token.
+
+    Returns:
+      A list of identifiers, one for each stored blob.
+    """
+    return self.StoreBlobs(contents_by_digest.values(), token=token)
+
   def ReadBlobs(self, identifiers, token=None):
     """Reads blobs.
 
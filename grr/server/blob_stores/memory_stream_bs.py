@@ -24,6 +24,10 @@ class MemoryStreamBlobstore(blob_store.Blobstore):
         for content in contents
     }
 
+    return self.StoreHashedBlobs(contents_by_digest, token=token)
+
+  def StoreHashedBlobs(self, contents_by_digest, token=None):
+    """Creates or overwrites blobs whose digests are already known."""
     urns = {self._BlobUrn(digest): digest for digest in contents_by_digest}
 
     mutation_pool = data_store.DB.GetMutationPool()
@@ -949,6 +949,9 @@ class DataStore(object):
   def StoreBlobs(self, contents, token=None):
     return self.blobstore.StoreBlobs(contents, token=token)
 
+  def StoreHashedBlobs(self, contents_by_digest, token=None):
+    return self.blobstore.StoreHashedBlobs(contents_by_digest, token=token)
+
   def BlobExists(self, identifier, token=None):
     return self.BlobsExist([identifier], token=token).values()[0]
 
@@ -1350,6 +1353,9 @@ class DataStore(object):
   QUEUE_TASK_PREDICATE_PREFIX = "task:"
   QUEUE_TASK_PREDICATE_TEMPLATE = QUEUE_TASK_PREDICATE_PREFIX + "%s"
 
+  # The number of tasks left in a client queue when it was last compacted.
+  QUEUE_BACKLOG_ATTRIBUTE = "aff4:backlog_size"
+
   STATS_STORE_PREFIX = "aff4:stats_store/"
 
   @classmethod
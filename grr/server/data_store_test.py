@@ -1373,6 +1373,7 @@ class DataStoreTestMixin(object):
         "Set",
         "StoreBlob",
         "StoreBlobs",
+        "StoreHashedBlobs",
         "StoreRequestsAndResponses",
     ]
 
@@ -93,6 +93,47 @@ class MysqlDB(object):
                           last_ip=None,
                           last_foreman=None):
     """Write metadata about the client."""
+    self.WriteClientsMetadata({
+        client_id:
+            dict(
+                certificate=certificate,
+                fleetspeak_enabled=fleetspeak_enabled,
+                first_seen=first_seen,
+                last_ping=last_ping,
+                last_clock=last_clock,
+                last_ip=last_ip,
+                last_foreman=last_foreman)
+    })
+
+  def WriteClientsMetadata(self, metadatas):
+    """Write metadata about several clients in one transaction."""
+    queries = [
+        self._ClientMetadataQuery(client_id, **kwargs)
+        for client_id, kwargs in metadatas.iteritems()
+    ]
+    if not queries:
+      return
+
+    con = self.pool.get()
+    cursor = con.cursor()
+    try:
+      for query, values in queries:
+        cursor.execute(query, values)
+      con.commit()
+    finally:
+      cursor.close()
+      con.close()
+
+  def _ClientMetadataQuery(self,
+                           client_id,
+                           certificate=None,
+                           fleetspeak_enabled=None,
+                           first_seen=None,
+                           last_ping=None,
+                           last_clock=None,
+                           last_ip=None,
+                           last_foreman=None):
+    """Returns the query and values writing metadata about the client."""
 
     columns = ["client_id"]
     values = [_ClientIDToInt(client_id)]
@@ -131,14 +172,7 @@ class MysqlDB(object):
             vals=", ".join(["%s"] * len(columns)),
             updates=", ".join(
                 ["%s = VALUES (%s)" % (col, col) for col in columns[1:]]))
-    con = self.pool.get()
-    cursor = con.cursor()
-    try:
-      cursor.execute(query, values)
-      con.commit()
-    finally:
-      cursor.close()
-      con.close()
+    return query, values
 
   def ReadClientsMetadata(self, client_ids):
     """Reads ClientMetadata records for a list of clients."""
@@ -73,6 +73,22 @@ class Database(object):
       UnknownClientError: The client_id is not known yet.
     """
 
+  def WriteClientsMetadata(self, metadatas):
+    """Write metadata about several clients.
+
+    Implementations may write all updates at once, which is much cheaper than
+    separate WriteClientMetadata calls for frequent updates like pings.
+
+    Args:
+      metadatas: A dict mapping GRR client id strings to dicts of keyword
+        arguments for WriteClientMetadata.
+
+    Raises:
+      UnknownClientError: One of the clients is not known yet.
+    """
+    for client_id, kwargs in metadatas.iteritems():
+      self.WriteClientMetadata(client_id, **kwargs)
+
   @abc.abstractmethod
   def ReadClientsMetadata(self, client_ids):
     """Reads ClientMetadata records for a list of clients.
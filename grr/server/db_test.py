@@ -180,6 +180,35 @@ class DatabaseTestMixin(object):
         m1.ip, rdf_client.NetworkAddress(human_readable_address="8.8.8.8"))
     self.assertEqual(m1.last_foreman_time, rdfvalue.RDFDatetime(220000000000))
 
+  def testClientsMetadataPing(self):
+    d = self.db
+
+    client_id_1 = "C.fc413187fefa1dcf"
+    client_id_2 = "C.00413187fefa1dcf"
+    self._InitializeClient(client_id_1)
+    self._InitializeClient(client_id_2)
+
+    d.WriteClientsMetadata({
+        client_id_1: {
+            "last_ping": rdfvalue.RDFDatetime(200000000000),
+            "last_clock": rdfvalue.RDFDatetime(210000000000)
+        },
+        client_id_2: {
+            "last_ping": rdfvalue.RDFDatetime(300000000000),
+            "last_ip": rdf_client.NetworkAddress(
+                human_readable_address="8.8.8.8")
+        }
+    })
+
+    res = d.ReadClientsMetadata([client_id_1, client_id_2])
+    self.assertEqual(res[client_id_1].ping, rdfvalue.RDFDatetime(200000000000))
+    self.assertEqual(res[client_id_1].clock,
+                     rdfvalue.RDFDatetime(210000000000))
+    self.assertEqual(res[client_id_2].ping, rdfvalue.RDFDatetime(300000000000))
+    self.assertEqual(
+        res[client_id_2].ip,
+        rdf_client.NetworkAddress(human_readable_address="8.8.8.8"))
+
   def testClientMetadataValidatesIP(self):
     d = self.db
     client_id = "C.fc413187fefa1dcf"
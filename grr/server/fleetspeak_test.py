@@ -112,6 +112,7 @@ class FleetspeakGRRFEServerTest(front_end_test.GRRFEServerTestBase):
 
     for msg in fs_messages:
       fsd.Process(msg, None)
+    fsd.frontend.Stop()
 
     # Make sure the task is still on the client queue
     manager = queue_manager.QueueManager(token=self.token)
@@ -178,6 +179,7 @@ class FleetspeakGRRFEServerTest(front_end_test.GRRFEServerTestBase):
             client_id=fs_client_id, service_name=service_name))
     fs_message.data.Pack(message_list.AsPrimitiveProto())
     fsd.Process(fs_message, None)
+    fsd.frontend.Stop()
 
     # Make sure the task is still on the client queue
     manager = queue_manager.QueueManager(token=self.token)
@@ -43,6 +43,7 @@ self.runner_args: The flow runners args. This is an instance of
 """
 
 import functools
+import hashlib
 import logging
 import operator
 
@@ -748,6 +749,15 @@ class GRRFlow(FlowBase):
         versioned=False,
         creates_new_object_version=False)
 
+    FLOW_STATE_DELTA = aff4.Attribute(
+        "aff4:flow_state_delta",
+        rdf_protodict.AttributedDict,
+        "Changes to the flow state made after FLOW_STATE_DICT was written. "
+        "Every version of this attribute holds the state items that changed "
+        "in one state transition.",
+        "FlowStateDelta",
+        creates_new_object_version=False)
+
     FLOW_ARGS = aff4.Attribute(
         "aff4:flow_args",
         rdf_protodict.EmbeddedRDFValue,
@@ -805,10 +815,34 @@ class GRRFlow(FlowBase):
   # is killed when the client crashes.
   handles_crashes = False
 
+  # If True, only the state items that changed since the flow was last saved
+  # are written on every state transition (as a new FLOW_STATE_DELTA
+  # version). This is useful for flows keeping large, rarely changing data
+  # structures in their state.
+  persist_state_deltas = False
+
+  # When persisting state deltas, the whole state is written again and all
+  # the deltas are dropped once this many deltas have accumulated.
+  state_compaction_interval = 20
+
+  # State delta key holding the names of the deleted state items.
+  DELETED_STATE_ITEMS_KEY = "__deleted_state_items__"
+  # State delta keys holding the changed and the deleted entries of state items
+  # that are dicts or lists, by state item name.
+  UPDATED_STATE_ENTRIES_KEY = "__updated_state_entries__"
+  DELETED_STATE_ENTRIES_KEY = "__deleted_state_entries__"
+
   def Initialize(self):
     """The initialization method."""
     super(GRRFlow, self).Initialize()
 
+    # Digests of the serialized state items as they were last written and the
+    # number of state deltas written since the whole state was last written.
+    # Used when persist_state_deltas is set.
+    self._state_item_digests = None
+    self._state_deltas_count = 0
+    self._last_state_delta_age = 0
+
     if "r" in self.mode:
       state = self.Get(self.Schema.FLOW_STATE_DICT)
       self.context = self.Get(self.Schema.FLOW_CONTEXT)
@@ -822,11 +856,83 @@ class GRRFlow(FlowBase):
       else:
         self.state = AttributedDict()
 
+      self._ApplyStateDeltas()
+
+      if self.persist_state_deltas:
+        self._state_item_digests = self._GetStateItemDigests()
+
       self.Load()
 
     if self.state is None:
       self.state = AttributedDict()
 
+  def _ApplyStateDeltas(self):
+    """Applies the state deltas written after the whole state to the state."""
+    # Only the newest version of the attribute is read when the object is
+    # opened, use it to find out if there are any deltas to be read.
+    if self.Get(self.Schema.FLOW_STATE_DELTA) is None:
+      return
+
+    deltas = data_store.DB.ResolvePrefix(
+        self.urn,
+        self.Schema.FLOW_STATE_DELTA.predicate,
+        timestamp=data_store.DB.ALL_TIMESTAMPS)
+
+    for _, serialized_delta, timestamp in sorted(
+        deltas, key=operator.itemgetter(2)):
+      delta = rdf_protodict.AttributedDict.FromSerializedString(
+          serialized_delta).ToDict()
+
+      for key in delta.pop(self.DELETED_STATE_ITEMS_KEY, []):
+        self.state.pop(key, None)
+      updated_entries = delta.pop(self.UPDATED_STATE_ENTRIES_KEY, {})
+      deleted_entries = delta.pop(self.DELETED_STATE_ENTRIES_KEY, {})
+      self.state.update(delta)
+
+      for key, entry_keys in deleted_entries.iteritems():
+        for entry_key in entry_keys:
+          self.state[key].pop(entry_key, None)
+
+      for key, entries in updated_entries.iteritems():
+        container = self.state[key]
+        # Entries appended to lists are written in order.
+        for entry_key, value in sorted(entries.iteritems()):
+          if isinstance(container, list) and entry_key == len(container):
+            container.append(value)
+          else:
+            container[entry_key] = value
+
+      self._state_deltas_count += 1
+      self._last_state_delta_age = max(self._last_state_delta_age, timestamp)
+
+  def _GetStateItemDigests(self):
+    """Returns a dict mapping state keys to digests of their values.
+
+    Dicts and lists are digested entry by entry, so that changing a few
+    entries of a large container only writes those entries.
+
+    Returns:
+      A dict mapping state keys to (type, digests) tuples. type is dict or list
+      for containers, with digests a dict or list of entry digests, and None
+      for other values, with digests the digest of the whole value.
+    """
+    result = {}
+    for key, value in self.state.iteritems():
+      if isinstance(value, dict):
+        result[key] = (dict, dict((entry_key, self._StateValueDigest(entry))
+                                  for entry_key, entry in value.iteritems()))
+      elif isinstance(value, list):
+        result[key] = (list, [self._StateValueDigest(entry) for entry in value])
+      else:
+        result[key] = (None, self._StateValueDigest(value))
+
+    return result
+
+  def _StateValueDigest(self, value):
+    serialized_value = rdf_protodict.DataBlob().SetValue(
+        value).SerializeToString()
+    return hashlib.sha1(serialized_value).digest()
+
   def CreateRunner(self, **kw):
     """Make a new runner."""
     self.runner = flow_runner.FlowRunner(self, token=self.token, **kw)
@@ -867,8 +973,88 @@ class GRRFlow(FlowBase):
       self.Set(self.Schema.FLOW_ARGS(self.args))
       self.Set(self.Schema.FLOW_CONTEXT(self.context))
       self.Set(self.Schema.FLOW_RUNNER_ARGS(self.runner_args))
-      protodict = rdf_protodict.AttributedDict().FromDict(self.state)
-      self.Set(self.Schema.FLOW_STATE_DICT(protodict))
+
+      if (self.persist_state_deltas and self._state_item_digests is not None
+          and self._state_deltas_count < self.state_compaction_interval):
+        state_bytes = self._WriteStateDelta()
+      else:
+        state_bytes = self._WriteFullState()
+
+      stats.STATS.RecordEvent(
+          "flow_state_bytes_written", state_bytes, fields=[self.Name()])
+
+  def _WriteFullState(self):
+    """Writes the whole state and drops all the state deltas."""
+    protodict = rdf_protodict.AttributedDict().FromDict(self.state)
+    self.Set(self.Schema.FLOW_STATE_DICT(protodict))
+
+    if self._state_deltas_count:
+      self.DeleteAttribute(self.Schema.FLOW_STATE_DELTA)
+      self._state_deltas_count = 0
+
+    if self.persist_state_deltas:
+      self._state_item_digests = self._GetStateItemDigests()
+
+    return len(protodict.SerializeToString())
+
+  def _WriteStateDelta(self):
+    """Writes the state items changed since the last write as a delta."""
+    digests = self._GetStateItemDigests()
+
+    delta = {}
+    updated_entries = {}
+    deleted_entries = {}
+    for key, (value_type, value_digests) in digests.iteritems():
+      old_type, old_digests = self._state_item_digests.get(key, (None, None))
+      if old_digests == value_digests and old_type == value_type:
+        continue
+
+      value = self.state[key]
+      if value_type is dict and old_type is dict:
+        updated = dict((entry_key, value[entry_key])
+                       for entry_key, digest in value_digests.iteritems()
+                       if old_digests.get(entry_key) != digest)
+        if updated:
+          updated_entries[key] = updated
+        deleted = sorted(set(old_digests) - set(value_digests))
+        if deleted:
+          deleted_entries[key] = deleted
+      elif (value_type is list and old_type is list and
+            len(value_digests) >= len(old_digests)):
+        updated = dict((index, value[index])
+                       for index, digest in enumerate(value_digests)
+                       if index >= len(old_digests) or
+                       old_digests[index] != digest)
+        if updated:
+          updated_entries[key] = updated
+      else:
+        delta[key] = value
+
+    deleted_keys = set(self._state_item_digests) - set(digests)
+    if deleted_keys:
+      delta[self.DELETED_STATE_ITEMS_KEY] = sorted(deleted_keys)
+    if updated_entries:
+      delta[self.UPDATED_STATE_ENTRIES_KEY] = updated_entries
+    if deleted_entries:
+      delta[self.DELETED_STATE_ENTRIES_KEY] = deleted_entries
+
+    self._state_item_digests = digests
+    if not delta:
+      return 0
+
+    # Deltas are ordered by their age, make sure that they never share one.
+    age = max(rdfvalue.RDFDatetime.Now().AsMicroSecondsFromEpoch(),
+              self._last_state_delta_age + 1)
+    self._last_state_delta_age = age
+
+    protodict = rdf_protodict.AttributedDict().FromDict(delta)
+    self.AddAttribute(
+        self.Schema.FLOW_STATE_DELTA,
+        protodict,
+        age=rdfvalue.RDFDatetime(age))
+    self._state_deltas_count += 1
+
+    return len(protodict.SerializeToString())
 
   def Status(self, format_str, *args):
     """Flows can call this method to set a status message visible to users."""
@@ -1291,6 +1477,13 @@ class FlowInit(registry.InitHook):
     stats.STATS.RegisterCounterMetric("grr_unique_clients")
     stats.STATS.RegisterCounterMetric("grr_worker_states_run")
     stats.STATS.RegisterCounterMetric("grr_well_known_flow_requests")
+    stats.STATS.RegisterEventMetric(
+        "flow_replies_flush_size",
+        bins=[1, 10, 100, 1000, 10000, 100000])
+    stats.STATS.RegisterEventMetric(
+        "flow_state_bytes_written",
+        bins=[0, 1024, 10240, 102400, 1048576, 10485760],
+        fields=[("flow", str)])
 
     # Flow-aware counters
     stats.STATS.RegisterCounterMetric("flow_starts", fields=[("flow", str)])
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Benchmarks for writing flow results."""
+
+
+import pytest
+
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.server import flow
+from grr.test_lib import action_mocks
+from grr.test_lib import benchmark_test_lib
+from grr.test_lib import flow_test_lib
+from grr.test_lib import test_lib
+
+
+class ManyRepliesFlow(flow.GRRFlow):
+  """A flow that sends a lot of replies of different types from one state."""
+
+  replies_count = 1000
+
+  @flow.StateHandler()
+  def Start(self):
+    self.CallState(next_state="End")
+
+  @flow.StateHandler()
+  def End(self, responses):
+    for i in xrange(self.replies_count):
+      if i % 2:
+        self.SendReply(rdfvalue.RDFInteger(i))
+      else:
+        self.SendReply(rdfvalue.RDFString("reply %d" % i))
+
+
+@pytest.mark.benchmark
+class FlowRepliesBenchmark(benchmark_test_lib.AverageMicroBenchmarks):
+  """Measures the cost of writing flow replies to the results collections."""
+
+  REPEATS = 10
+
+  def _RunFlow(self):
+    for _ in flow_test_lib.TestFlowHelper(
+        ManyRepliesFlow.__name__,
+        action_mocks.ActionMock(),
+        token=self.token,
+        client_id=test_lib.TEST_CLIENT_ID):
+      pass
+
+  def testSendReplyWithDifferentFlushThresholds(self):
+    """Time a flow sending 1000 replies with different flush thresholds."""
+    for threshold in [0, 10, 100, 1000]:
+      with test_lib.ConfigOverrider({
+          "Worker.queued_replies_flush_threshold": threshold
+      }):
+        self.TimeIt(
+            self._RunFlow,
+            name="1000 replies, flush threshold %d" % threshold)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
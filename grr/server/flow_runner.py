@@ -59,6 +59,7 @@ import threading
 import traceback
 
 
+from grr import config
 from grr.lib import rdfvalue
 from grr.lib import stats
 from grr.lib import utils
@@ -870,15 +871,34 @@ class FlowRunner(object):
       # Only write the reply to the collection if we are the parent flow.
       self.QueueReplyForResultCollection(response)
 
-  def FlushQueuedReplies(self):
-    if self.queued_replies:
+  def FlushQueuedReplies(self, mutation_pool=None):
+    """Writes all queued replies to the flow's result collections.
+
+    The replies are written to the results collection and to the per-type
+    results collection in a single batch.
+
+    Args:
+      mutation_pool: A MutationPool object to write to. If not given, a new
+        pool is created and flushed before returning.
+    """
+    if not self.queued_replies:
+      return
+
+    if mutation_pool is None:
       with data_store.DB.GetMutationPool() as pool:
-        for response in self.queued_replies:
-          sequential_collection.GeneralIndexedCollection.StaticAdd(
-              self.flow_obj.output_urn, response, mutation_pool=pool)
-          multi_type_collection.MultiTypeCollection.StaticAdd(
-              self.flow_obj.multi_type_output_urn, response, mutation_pool=pool)
-      self.queued_replies = []
+        self.FlushQueuedReplies(mutation_pool=pool)
+      return
+
+    replies, self.queued_replies = self.queued_replies, []
+    for response in replies:
+      sequential_collection.GeneralIndexedCollection.StaticAdd(
+          self.flow_obj.output_urn, response, mutation_pool=mutation_pool)
+    multi_type_collection.MultiTypeCollection.StaticAddMultiple(
+        self.flow_obj.multi_type_output_urn,
+        replies,
+        mutation_pool=mutation_pool)
+
+    stats.STATS.RecordEvent("flow_replies_flush_size", len(replies))
 
   def FlushMessages(self):
     """Flushes the messages that were queued."""
@@ -1075,6 +1095,16 @@ class FlowRunner(object):
   def QueueReplyForResultCollection(self, response):
     self.queued_replies.append(response)
 
+    # Flows sending a lot of replies from a single state write them in several
+    # batches instead of one huge batch when the flow is flushed. The replies
+    # are still kept in sent_replies for the output plugins until the state
+    # method returns. A flow that lost its lease does not write results early,
+    # they are left for the lease checked flush.
+    flush_threshold = config.CONFIG["Worker.queued_replies_flush_threshold"]
+    if flush_threshold and len(self.queued_replies) >= flush_threshold:
+      if not self.flow_obj.locked or self.flow_obj.CheckLease():
+        self.FlushQueuedReplies()
+
     if self.runner_args.client_id:
       # While wrapping the response in GrrMessage is not strictly necessary for
       # output plugins, GrrMessage.source may be used by these plugins to fetch
@@ -20,6 +20,7 @@ from grr.server import access_control
 from grr.server import aff4
 from grr.server import data_store
 from grr.server import flow
+from grr.server import flow_runner
 from grr.server import output_plugin
 from grr.server import queue_manager
 from grr.server import server_stubs
@@ -138,6 +139,31 @@ class MultiEndedFlow(flow.GRRFlow):
       self.CallState(next_state="End")
 
 
+class DeltaStateFlow(flow.GRRFlow):
+  """This flow only writes the changes to its state."""
+
+  persist_state_deltas = True
+
+  @flow.StateHandler()
+  def Start(self):
+    self.state.unchanged = "X" * 1024
+    self.state.to_delete = 42
+    self.state.counter = 0
+    self.state.entries_by_index = dict((i, "X" * 100) for i in range(10))
+    self.state.entries = ["X" * 100] * 10
+    self.CallState(next_state="Count")
+
+  @flow.StateHandler()
+  def Count(self, unused_responses):
+    self.state.entries_by_index.pop(self.state.counter)
+    self.state.entries[self.state.counter] = None
+    self.state.entries.append(self.state.counter)
+    self.state.counter += 1
+    self.state.pop("to_delete", None)
+    if self.state.counter < 5:
+      self.CallState(next_state="Count")
+
+
 class FlowCreationTest(BasicFlowTest):
   """Test flow creation."""
 
@@ -472,6 +498,130 @@ class FlowCreationTest(BasicFlowTest):
             rdfvalue.RDFURN("foo2/bar2")
         ])
 
+  def testQueuedRepliesAreFlushedEarlyWhenThresholdIsReached(self):
+    with test_lib.ConfigOverrider({
+        "Worker.queued_replies_flush_threshold": 2
+    }):
+      with utils.Stubber(flow_runner.FlowRunner, "FlushQueuedReplies",
+                         self._CountingFlushQueuedReplies()):
+        for session_id in flow_test_lib.TestFlowHelper(
+            FlowWithMultipleResultTypes.__name__,
+            action_mocks.ActionMock(),
+            token=self.token,
+            client_id=self.client_id):
+          flow_urn = session_id
+
+    # 6 replies with a threshold of 2 trigger 3 early flushes and leave nothing
+    # to be written when the flow itself is flushed.
+    self.assertEqual(self.flush_calls, 3)
+
+    c = flow.GRRFlow.ResultCollectionForFID(flow_urn)
+    self.assertEqual(len(c), 6)
+
+  def testQueuedRepliesAreNotFlushedEarlyAfterLeaseExpired(self):
+    session_id = flow.GRRFlow.StartFlow(
+        client_id=self.client_id,
+        flow_name=FlowWithMultipleResultTypes.__name__,
+        token=self.token)
+
+    with test_lib.ConfigOverrider({
+        "Worker.queued_replies_flush_threshold": 2
+    }):
+      with aff4.FACTORY.OpenWithLock(
+          session_id, lease_time=100, blocking=False,
+          token=self.token) as flow_obj:
+        runner = flow_obj.GetRunner()
+        with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() +
+                               rdfvalue.Duration("200s")):
+          runner.QueueReplyForResultCollection(rdfvalue.RDFInteger(1))
+          runner.QueueReplyForResultCollection(rdfvalue.RDFInteger(2))
+
+        self.assertEqual(len(runner.queued_replies), 2)
+        self.assertEqual(len(flow.GRRFlow.ResultCollectionForFID(session_id)),
+                         0)
+
+    # The replies are written when the flow is flushed with a valid lease.
+    self.assertEqual(len(flow.GRRFlow.ResultCollectionForFID(session_id)), 2)
+
+  def _CountingFlushQueuedReplies(self):
+    self.flush_calls = 0
+    original = flow_runner.FlowRunner.FlushQueuedReplies
+
+    def CountingFlushQueuedReplies(runner, mutation_pool=None):
+      if runner.queued_replies:
+        self.flush_calls += 1
+      return original(runner, mutation_pool=mutation_pool)
+
+    return CountingFlushQueuedReplies
+
+
+class FlowStateDeltaTest(BasicFlowTest):
+  """Tests persisting flow state deltas."""
+
+  def _RunDeltaStateFlow(self):
+    for session_id in flow_test_lib.TestFlowHelper(
+        DeltaStateFlow.__name__,
+        action_mocks.ActionMock(),
+        token=self.token,
+        client_id=self.client_id):
+      flow_urn = session_id
+
+    return flow_urn
+
+  def _ReadStateDeltas(self, flow_urn):
+    deltas = data_store.DB.ResolvePrefix(
+        flow_urn,
+        flow.GRRFlow.SchemaCls.FLOW_STATE_DELTA.predicate,
+        timestamp=data_store.DB.ALL_TIMESTAMPS)
+    return [
+        rdf_protodict.AttributedDict.FromSerializedString(value).ToDict()
+        for _, value, _ in deltas
+    ]
+
+  def testStateIsRestoredFromDeltas(self):
+    flow_urn = self._RunDeltaStateFlow()
+
+    self.assertTrue(self._ReadStateDeltas(flow_urn))
+
+    flow_obj = aff4.FACTORY.Open(flow_urn, token=self.token)
+    self.assertEqual(flow_obj.state.counter, 5)
+    self.assertEqual(flow_obj.state.unchanged, "X" * 1024)
+    self.assertNotIn("to_delete", flow_obj.state)
+
+  def testDeltasOnlyContainChangedItems(self):
+    flow_urn = self._RunDeltaStateFlow()
+
+    for delta in self._ReadStateDeltas(flow_urn):
+      self.assertNotIn("unchanged", delta)
+
+  def testDeltasOnlyContainChangedContainerEntries(self):
+    flow_urn = self._RunDeltaStateFlow()
+
+    deltas = self._ReadStateDeltas(flow_urn)
+    self.assertTrue(deltas)
+    for delta in deltas:
+      self.assertNotIn("entries_by_index", delta)
+      self.assertNotIn("entries", delta)
+      self.assertLessEqual(
+          len(delta[flow.GRRFlow.UPDATED_STATE_ENTRIES_KEY]["entries"]), 2)
+
+    flow_obj = aff4.FACTORY.Open(flow_urn, token=self.token)
+    self.assertEqual(flow_obj.state.entries_by_index,
+                     dict((i, "X" * 100) for i in range(5, 10)))
+    self.assertEqual(flow_obj.state.entries,
+                     [None] * 5 + ["X" * 100] * 5 + range(5))
+
+  def testStateIsCompacted(self):
+    with utils.Stubber(DeltaStateFlow, "state_compaction_interval", 2):
+      flow_urn = self._RunDeltaStateFlow()
+
+    self.assertLessEqual(len(self._ReadStateDeltas(flow_urn)), 2)
+
+    flow_obj = aff4.FACTORY.Open(flow_urn, token=self.token)
+    self.assertEqual(flow_obj.state.counter, 5)
+    self.assertEqual(flow_obj.state.unchanged, "X" * 1024)
+    self.assertNotIn("to_delete", flow_obj.state)
+
 
 class FlowTest(BasicFlowTest):
   """Tests the Flow."""
@@ -2,10 +2,12 @@
 """These flows are system-specific GRR cron flows."""
 
 import bisect
+import heapq
 import logging
 import time
 
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import stats as rdf_stats
@@ -13,6 +15,7 @@ from grr.server import aff4
 from grr.server import data_store
 from grr.server import export_utils
 from grr.server import flow
+from grr.server import queue_manager
 from grr.server.aff4_objects import aff4_grr
 from grr.server.aff4_objects import cronjobs
 from grr.server.aff4_objects import stats as aff4_stats
@@ -375,3 +378,56 @@ class PurgeClientStats(cronjobs.SystemCronFlow):
               start=self.start,
               end=self.end)
       self.HeartBeat()
+
+
+class CompactClientQueues(cronjobs.SystemCronFlow):
+  """Removes expired and duplicate tasks from all client queues.
+
+  Clients that are offline for a long time can build up large backlogs of
+  queued tasks. This cron job compacts the client queues, records the backlog
+  left for every client and logs the largest ones.
+  """
+
+  frequency = rdfvalue.Duration("1d")
+  lifetime = rdfvalue.Duration("20h")
+
+  # The number of largest client backlogs that are logged.
+  LARGEST_BACKLOGS_COUNT = 20
+
+  @flow.StateHandler()
+  def Start(self):
+    """Calls "Process" state to avoid spending too much time in Start."""
+    self.CallState(next_state="ProcessClients")
+
+  @flow.StateHandler()
+  def ProcessClients(self, unused_responses):
+    """Does the work."""
+    manager = queue_manager.QueueManager(token=self.token)
+    client_urns = export_utils.GetAllClients(token=self.token)
+
+    largest_backlogs = []
+    total_removed = 0
+    for batch in utils.Grouper(client_urns, 1000):
+      with data_store.DB.GetMutationPool() as mutation_pool:
+        for client_urn in batch:
+          remaining, removed = manager.CompactClientQueue(
+              client_urn, mutation_pool)
+          total_removed += removed
+
+          stats.STATS.RecordEvent("grr_client_queue_backlog", remaining)
+          if remaining:
+            item = (remaining, utils.SmartStr(client_urn))
+            if len(largest_backlogs) < self.LARGEST_BACKLOGS_COUNT:
+              heapq.heappush(largest_backlogs, item)
+            else:
+              heapq.heappushpop(largest_backlogs, item)
+      self.HeartBeat()
+
+    largest_backlogs.sort(reverse=True)
+    stats.STATS.SetGaugeValue("grr_client_queue_max_backlog",
+                              largest_backlogs[0][0] if largest_backlogs else 0)
+
+    self.Log("Removed %d expired or duplicate tasks from client queues.",
+             total_removed)
+    for remaining, client_urn in largest_backlogs:
+      self.Log("%s has %d queued tasks.", client_urn, remaining)
@@ -4,8 +4,10 @@
 from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import flows as rdf_flows
 from grr.server import aff4
 from grr.server import data_store
+from grr.server import queue_manager
 from grr.server.aff4_objects import aff4_grr
 from grr.server.aff4_objects import stats as aff4_stats
 from grr.server.flows.cron import system
@@ -204,6 +206,28 @@ class SystemCronFlowTest(flow_test_lib.FlowTestsBaseclass):
     self.assertEqual(len(stat_entries), 1)
     self.assertTrue(max_age not in [e.RSS_size for e in stat_entries])
 
+  def testCompactClientQueues(self):
+    client_id = rdf_client.ClientURN("C.1%015x" % 0)
+    session_id = rdfvalue.SessionID(flow_name="compact")
+
+    manager = queue_manager.QueueManager(token=self.token)
+    with data_store.DB.GetMutationPool() as pool:
+      manager.Schedule([
+          rdf_flows.GrrMessage(
+              queue=client_id.Queue(),
+              session_id=session_id,
+              request_id=1,
+              generate_task_id=True) for _ in range(3)
+      ], pool)
+
+    for _ in flow_test_lib.TestFlowHelper(
+        system.CompactClientQueues.__name__, token=self.token):
+      pass
+
+    self.assertEqual(len(manager.Query(client_id, limit=100)), 1)
+    self.assertEqual(
+        manager.GetClientQueueBacklogs([client_id]), {client_id: 1})
+
   def _SetSummaries(self, client_id):
     client = aff4.FACTORY.Create(
         client_id, aff4_grr.VFSGRRClient, mode="rw", token=self.token)
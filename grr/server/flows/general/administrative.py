@@ -27,6 +27,7 @@ from grr.server import db
 from grr.server import email_alerts
 from grr.server import events
 from grr.server import flow
+from grr.server import foreman as rdf_foreman
 from grr.server import grr_collections
 from grr.server import server_stubs
 from grr.server.aff4_objects import aff4_grr
@@ -379,6 +380,8 @@ class Foreman(flow.WellKnownFlow):
   """
   well_known_session_id = rdfvalue.SessionID(flow_name="Foreman")
   foreman_cache = None
+  # Clients already checked against the latest rule, shared by all instances.
+  checked_clients = None
 
   # How often we refresh the rule set from the data store.
   cache_refresh_time = 60
@@ -402,8 +405,12 @@ class Foreman(flow.WellKnownFlow):
             "aff4:/foreman", mode="rw", token=self.token)
         self.foreman_cache.age = now
 
+      if Foreman.checked_clients is None:
+        Foreman.checked_clients = rdf_foreman.ForemanCheckedClients()
+
     if message.source:
-      self.foreman_cache.AssignTasksToClient(message.source.Basename())
+      self.foreman_cache.AssignTasksToClient(
+          message.source.Basename(), checked_clients=Foreman.checked_clients)
 
 
 class OnlineNotificationArgs(rdf_structs.RDFProtoStruct):
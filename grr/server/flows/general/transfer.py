@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 """These flows are designed for high performance transfers."""
 
+import hashlib
 import logging
 import zlib
 
@@ -196,6 +197,10 @@ class MultiGetFileMixin(object):
 
   CHUNK_SIZE = 512 * 1024
 
+  # The pending hashes and files trackers can get big while most of the state
+  # stays the same between transitions, so only state deltas are written.
+  persist_state_deltas = True
+
   # Batch calls to the filestore to at least to group this many items. This
   # allows us to amortize file store round trips and increases throughput.
   MIN_CALL_TO_FILE_STORE = 200
@@ -835,8 +840,36 @@ class TransferStore(flow.WellKnownFlow):
   """Store a buffer into a determined location."""
   well_known_session_id = rdfvalue.SessionID(flow_name="TransferStore")
 
+  # Blobs are handed to the blob store in batches of at most this many bytes
+  # of uncompressed data.
+  max_batch_size = 64 * 1024 * 1024
+
+  def _DecompressAndHash(self, data, compression):
+    """Decompresses the data and computes its sha256 digest.
+
+    Args:
+      data: The (possibly compressed) blob data as sent by the client.
+      compression: The rdf_protodict.DataBlob.CompressionType of the data.
+
+    Returns:
+      A tuple (digest, content) where digest is the hex encoded sha256 of the
+      uncompressed content.
+
+    Raises:
+      RuntimeError: The compression type is not supported.
+    """
+    if compression == rdf_protodict.DataBlob.CompressionType.ZCOMPRESSION:
+      content = zlib.decompress(data)
+    elif compression == rdf_protodict.DataBlob.CompressionType.UNCOMPRESSED:
+      content = data
+    else:
+      raise RuntimeError("Unsupported compression")
+
+    return hashlib.sha256(content).hexdigest(), content
+
   def ProcessMessages(self, msg_list):
-    blobs = []
+    blobs = {}
+    batch_size = 0
     for message in msg_list:
       if (message.auth_state !=
           rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED):
@@ -849,18 +882,20 @@ class TransferStore(flow.WellKnownFlow):
       if not data:
         continue
 
-      if (read_buffer.compression ==
-          rdf_protodict.DataBlob.CompressionType.ZCOMPRESSION):
-        data = zlib.decompress(data)
-      elif (read_buffer.compression ==
-            rdf_protodict.DataBlob.CompressionType.UNCOMPRESSED):
-        pass
-      else:
-        raise RuntimeError("Unsupported compression")
+      digest, content = self._DecompressAndHash(data, read_buffer.compression)
+      if digest in blobs:
+        continue
+
+      blobs[digest] = content
+      batch_size += len(content)
 
-      blobs.append(data)
+      if batch_size >= self.max_batch_size:
+        data_store.DB.StoreHashedBlobs(blobs, token=self.token)
+        blobs = {}
+        batch_size = 0
 
-    data_store.DB.StoreBlobs(blobs, token=self.token)
+    if blobs:
+      data_store.DB.StoreHashedBlobs(blobs, token=self.token)
 
   def ProcessMessage(self, message):
     """Write the blob into the AFF4 blob storage area."""
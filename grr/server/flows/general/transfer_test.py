@@ -5,13 +5,17 @@ import hashlib
 import os
 import platform
 import unittest
+import zlib
 
 from grr.lib import constants
 from grr.lib import flags
 from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import paths as rdf_paths
+from grr.lib.rdfvalues import protodict as rdf_protodict
 from grr.server import aff4
+from grr.server import data_store
 from grr.server import flow
 from grr.server.aff4_objects import aff4_grr
 from grr.server.flows.general import transfer
@@ -325,6 +329,56 @@ class TestTransfer(flow_test_lib.FlowTestsBaseclass):
       fd = aff4.FACTORY.Open(urn, token=self.token)
       self.assertEqual("Hello", fd.read())
 
+  def testMultiGetFileStateDeltasAreSmallerThanState(self):
+    client_mock = action_mocks.MultiGetFileClientMock()
+
+    pathspecs = []
+    for i in xrange(30):
+      path = os.path.join(self.temp_dir, "test_%s.txt" % i)
+      with open(path, "wb") as fd:
+        fd.write("Hello")
+
+      pathspecs.append(
+          rdf_paths.PathSpec(
+              pathtype=rdf_paths.PathSpec.PathType.OS, path=path))
+
+    full_state_sizes = []
+    delta_sizes = []
+    write_full_state = flow.GRRFlow._WriteFullState
+    write_state_delta = flow.GRRFlow._WriteStateDelta
+
+    def RecordingWriteFullState(flow_obj):
+      size = write_full_state(flow_obj)
+      if isinstance(flow_obj, transfer.MultiGetFile):
+        full_state_sizes.append(size)
+      return size
+
+    def RecordingWriteStateDelta(flow_obj):
+      size = write_state_delta(flow_obj)
+      if isinstance(flow_obj, transfer.MultiGetFile) and size:
+        delta_sizes.append(size)
+      return size
+
+    args = transfer.MultiGetFileArgs(
+        pathspecs=pathspecs, maximum_pending_files=10)
+    with utils.MultiStubber(
+        (flow.GRRFlow, "_WriteFullState", RecordingWriteFullState),
+        (flow.GRRFlow, "_WriteStateDelta", RecordingWriteStateDelta)):
+      for _ in flow_test_lib.TestFlowHelper(
+          transfer.MultiGetFile.__name__,
+          client_mock,
+          token=self.token,
+          client_id=self.client_id,
+          args=args):
+        pass
+
+    self.assertTrue(full_state_sizes)
+    self.assertTrue(delta_sizes)
+    # Every transition changes only a few files' entries of the containers
+    # holding the state of all 30 files.
+    average_delta_size = sum(delta_sizes) / len(delta_sizes)
+    self.assertLess(average_delta_size * 4, max(full_state_sizes))
+
   def testMultiGetFileDeduplication(self):
     client_mock = action_mocks.MultiGetFileClientMock()
 
@@ -422,6 +476,73 @@ class TestTransfer(flow_test_lib.FlowTestsBaseclass):
     self.assertEqual(hash_obj.sha1, expected_hash)
 
 
+class TransferStoreTest(test_lib.GRRBaseTest):
+  """Tests the TransferStore well known flow."""
+
+  def setUp(self):
+    super(TransferStoreTest, self).setUp()
+    self.transfer_store = aff4.FACTORY.Create(
+        transfer.TransferStore.well_known_session_id,
+        transfer.TransferStore,
+        mode="rw",
+        token=self.token)
+
+  def _BlobMessage(self, data, compress=False):
+    if compress:
+      blob = rdf_protodict.DataBlob(
+          data=zlib.compress(data),
+          compression=rdf_protodict.DataBlob.CompressionType.ZCOMPRESSION)
+    else:
+      blob = rdf_protodict.DataBlob(data=data)
+
+    return rdf_flows.GrrMessage(
+        source=test_lib.TEST_CLIENT_ID,
+        session_id=transfer.TransferStore.well_known_session_id,
+        auth_state=rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED,
+        payload=blob)
+
+  def testStoresCompressedAndUncompressedBlobs(self):
+    data = ["uncompressed blob", "compressed blob" * 10000]
+    self.transfer_store.ProcessMessages([
+        self._BlobMessage(data[0]),
+        self._BlobMessage(data[1], compress=True)
+    ])
+
+    for blob in data:
+      digest = hashlib.sha256(blob).hexdigest()
+      self.assertEqual(data_store.DB.ReadBlob(digest, token=self.token), blob)
+
+  def testIgnoresUnauthenticatedMessages(self):
+    message = self._BlobMessage("unauthenticated")
+    message.auth_state = (
+        rdf_flows.GrrMessage.AuthorizationState.UNAUTHENTICATED)
+    self.transfer_store.ProcessMessages([message])
+
+    digest = hashlib.sha256("unauthenticated").hexdigest()
+    self.assertFalse(data_store.DB.BlobExists(digest, token=self.token))
+
+  def testStoresBlobsInBatches(self):
+    data = ["blob %d" % i for i in range(10)]
+
+    batches = []
+    store_hashed_blobs = data_store.DB.StoreHashedBlobs
+
+    def RecordingStoreHashedBlobs(contents_by_digest, token=None):
+      batches.append(len(contents_by_digest))
+      return store_hashed_blobs(contents_by_digest, token=token)
+
+    with utils.MultiStubber(
+        (transfer.TransferStore, "max_batch_size", 3 * len(data[0])),
+        (data_store.DB, "StoreHashedBlobs", RecordingStoreHashedBlobs)):
+      self.transfer_store.ProcessMessages(
+          [self._BlobMessage(blob, compress=True) for blob in data])
+
+    self.assertEqual(batches, [3, 3, 3, 1])
+    for blob in data:
+      digest = hashlib.sha256(blob).hexdigest()
+      self.assertEqual(data_store.DB.ReadBlob(digest, token=self.token), blob)
+
+
 def main(argv):
   # Run the full test suite
   test_lib.main(argv)
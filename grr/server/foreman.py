@@ -1,8 +1,16 @@
 #!/usr/bin/env python
 """RDFValue instances related to the foreman implementation."""
 
+import bisect
+import collections
+import hashlib
 import itertools
+import logging
+import struct
+import threading
+import time
 
+from grr import config
 from grr.lib import rdfvalue
 from grr.lib import utils
 from grr.lib.rdfvalues import protodict as rdf_protodict
@@ -349,3 +357,507 @@ class ForemanRule(rdf_structs.RDFProtoStruct):
 class ForemanRules(rdf_protodict.RDFValueArray):
   """A list of rules that the foreman will apply."""
   rdf_type = ForemanRule
+
+
+class ForemanClientFeatures(object):
+  """The properties of a client that foreman rules look at.
+
+  Every property is resolved at most once, the first time a rule needs it, so
+  a client can be matched against many rules without reading the same
+  attributes over and over again.
+  """
+
+  def __init__(self, client_obj):
+    """Constructor.
+
+    Args:
+      client_obj: Either an aff4 client object or a `db.ClientFullInfo` instance
+                  if the relational db is used for reading.
+    """
+    self.client_obj = client_obj
+    self.relational = data_store.RelationalDBReadEnabled()
+    self._os = None
+    self._labels = None
+    self._strings = {}
+    self._integers = {}
+
+  @property
+  def os(self):
+    """The client's operating system, as used by ForemanOsClientRule."""
+    if self._os is None:
+      if self.relational:
+        value = self.client_obj.last_snapshot.knowledge_base.os
+      else:
+        value = self.client_obj.Get(self.client_obj.Schema.SYSTEM)
+      self._os = utils.SmartStr(value) if value else ""
+
+    return self._os
+
+  @property
+  def labels(self):
+    """The set of the client's label names."""
+    if self._labels is None:
+      if self.relational:
+        self._labels = set(label.name for label in self.client_obj.labels)
+      else:
+        self._labels = set(self.client_obj.GetLabelsNames())
+
+    return self._labels
+
+  def String(self, field):
+    """Returns a ForemanRegexClientRule.ForemanStringField value."""
+    try:
+      return self._strings[field]
+    except KeyError:
+      resolver = ForemanRegexClientRule()
+      if self.relational:
+        value = resolver._ResolveField(field, self.client_obj)  # pylint: disable=protected-access
+      else:
+        value = resolver._ResolveFieldAFF4(field, self.client_obj)  # pylint: disable=protected-access
+      self._strings[field] = value
+      return value
+
+  def Integer(self, field):
+    """Returns a ForemanIntegerClientRule.ForemanIntegerField value."""
+    try:
+      return self._integers[field]
+    except KeyError:
+      resolver = ForemanIntegerClientRule()
+      if self.relational:
+        value = resolver._ResolveField(field, self.client_obj)  # pylint: disable=protected-access
+      else:
+        value = resolver._ResolveFieldAFF4(field, self.client_obj)  # pylint: disable=protected-access
+      self._integers[field] = value
+      return value
+
+
+class ForemanRuleIndex(object):
+  """A compiled form of ForemanRules for matching many rules at once.
+
+  Every client rule of every rule set is a numbered condition. The conditions
+  are indexed by what they look at: OS and label conditions by value, integer
+  conditions by field and operator in sorted lists and regex conditions by
+  field. Matching a client first computes the set of satisfied OS, label and
+  integer conditions with a few lookups. Rule sets are then decided with set
+  operations and only the regexes of still undecided rule sets are run.
+
+  The result is the same as calling ForemanClientRuleSet.Evaluate on every
+  rule.
+  """
+
+  OS_PREFIXES = {
+      "os_windows": "Windows",
+      "os_linux": "Linux",
+      "os_darwin": "Darwin",
+  }
+
+  def __init__(self, rules):
+    """Constructor.
+
+    Args:
+      rules: A ForemanRules object or a list of ForemanRule objects.
+
+    Raises:
+      ValueError: A rule has an unknown match mode, operator or an unset field.
+    """
+    self.rules = list(rules)
+
+    # For every rule set, whether all conditions have to match, the ids of its
+    # OS, label and integer conditions and the ids of its regex conditions.
+    self._rule_match_all = []
+    self._rule_conditions = []
+    self._rule_regex_conditions = []
+    self._condition_count = 0
+
+    # OS prefix -> condition ids.
+    self._os_conditions = collections.defaultdict(set)
+    # Label -> condition ids. MATCH_ALL style conditions are satisfied if the
+    # client has as many of their labels as they have distinct labels.
+    self._label_conditions = collections.defaultdict(set)
+    self._any_label_conditions = set()
+    self._all_label_conditions = {}
+    self._negated_label_conditions = set()
+    # Field -> sorted lists of (value, condition id) for every operator.
+    self._less_than = collections.defaultdict(list)
+    self._greater_than = collections.defaultdict(list)
+    self._equal = collections.defaultdict(lambda: collections.defaultdict(set))
+    # Condition id -> (field, regex).
+    self._regex_conditions = {}
+
+    for rule in self.rules:
+      self._AddRuleSet(rule.client_rule_set)
+
+    for conditions in self._less_than.itervalues():
+      conditions.sort()
+    for conditions in self._greater_than.itervalues():
+      conditions.sort()
+
+  def _AddRuleSet(self, rule_set):
+    """Compiles the conditions of a ForemanClientRuleSet."""
+    if rule_set.match_mode == ForemanClientRuleSet.MatchMode.MATCH_ALL:
+      self._rule_match_all.append(True)
+    elif rule_set.match_mode == ForemanClientRuleSet.MatchMode.MATCH_ANY:
+      self._rule_match_all.append(False)
+    else:
+      raise ValueError("Unexpected match mode value: %s" % rule_set.match_mode)
+
+    conditions = set()
+    regex_conditions = []
+    for client_rule in rule_set.rules:
+      condition_id = self._condition_count
+      self._condition_count += 1
+      self._AddCondition(condition_id, client_rule.UnionCast())
+      if condition_id in self._regex_conditions:
+        regex_conditions.append(condition_id)
+      else:
+        conditions.add(condition_id)
+
+    self._rule_conditions.append(conditions)
+    self._rule_regex_conditions.append(regex_conditions)
+
+  def _AddCondition(self, condition_id, rule):
+    """Compiles a single client rule."""
+    if isinstance(rule, ForemanOsClientRule):
+      for attribute, prefix in self.OS_PREFIXES.iteritems():
+        if getattr(rule, attribute):
+          self._os_conditions[prefix].add(condition_id)
+
+    elif isinstance(rule, ForemanLabelClientRule):
+      mode = rule.match_mode
+      modes = ForemanLabelClientRule.MatchMode
+      label_names = set(rule.label_names)
+      for name in label_names:
+        self._label_conditions[name].add(condition_id)
+
+      if mode in (modes.MATCH_ANY, modes.DOES_NOT_MATCH_ANY):
+        self._any_label_conditions.add(condition_id)
+      elif mode in (modes.MATCH_ALL, modes.DOES_NOT_MATCH_ALL):
+        self._all_label_conditions[condition_id] = len(label_names)
+      else:
+        raise ValueError("Unexpected match mode value: %s" % mode)
+
+      if mode in (modes.DOES_NOT_MATCH_ANY, modes.DOES_NOT_MATCH_ALL):
+        self._negated_label_conditions.add(condition_id)
+
+    elif isinstance(rule, ForemanIntegerClientRule):
+      rule.Validate()
+      operators = ForemanIntegerClientRule.Operator
+      if rule.operator == operators.LESS_THAN:
+        self._less_than[rule.field].append((rule.value, condition_id))
+      elif rule.operator == operators.GREATER_THAN:
+        self._greater_than[rule.field].append((rule.value, condition_id))
+      elif rule.operator == operators.EQUAL:
+        self._equal[rule.field][rule.value].add(condition_id)
+      else:
+        raise ValueError("Unknown operator: %d" % rule.operator)
+
+    elif isinstance(rule, ForemanRegexClientRule):
+      rule.Validate()
+      self._regex_conditions[condition_id] = (rule.field, rule.attribute_regex)
+
+    else:
+      raise ValueError("Unexpected client rule: %s" % rule)
+
+  def _SatisfiedConditions(self, features):
+    """Returns the ids of all satisfied OS, label and integer conditions."""
+    satisfied = set()
+
+    client_os = features.os
+    for prefix, conditions in self._os_conditions.iteritems():
+      if client_os.startswith(prefix):
+        satisfied.update(conditions)
+
+    label_hits = collections.Counter()
+    for label in features.labels:
+      label_hits.update(self._label_conditions.get(label, ()))
+
+    for condition_id in self._any_label_conditions:
+      negated = condition_id in self._negated_label_conditions
+      if (label_hits[condition_id] > 0) != negated:
+        satisfied.add(condition_id)
+
+    for condition_id, required in self._all_label_conditions.iteritems():
+      negated = condition_id in self._negated_label_conditions
+      if (label_hits[condition_id] == required) != negated:
+        satisfied.add(condition_id)
+
+    fields = set(self._less_than)
+    fields.update(self._greater_than)
+    fields.update(self._equal)
+    for field in fields:
+      value = features.Integer(field)
+      if value is None:
+        continue
+
+      # Conditions are sorted by their value, so the satisfied ones are a
+      # slice of each list.
+      less_than = self._less_than.get(field, [])
+      start = bisect.bisect_right(less_than, (value, float("inf")))
+      satisfied.update(condition_id for _, condition_id in less_than[start:])
+
+      greater_than = self._greater_than.get(field, [])
+      end = bisect.bisect_left(greater_than, (value, -1))
+      satisfied.update(condition_id for _, condition_id in greater_than[:end])
+
+      if field in self._equal:
+        satisfied.update(self._equal[field].get(value, ()))
+
+    return satisfied
+
+  def _SearchRegex(self, features, condition_id):
+    field, regex = self._regex_conditions[condition_id]
+    return regex.Search(features.String(field))
+
+  def MatchingRules(self, client_obj, rule_filter=None):
+    """Returns the rules whose client rule set matches the client.
+
+    Args:
+      client_obj: An aff4 client object, a `db.ClientFullInfo` instance if the
+                  relational db is used for reading or a ForemanClientFeatures
+                  instance.
+      rule_filter: If given, only rules for which this function returns True
+                   are evaluated.
+
+    Returns:
+      A list of ForemanRule objects.
+    """
+    if isinstance(client_obj, ForemanClientFeatures):
+      features = client_obj
+    else:
+      features = ForemanClientFeatures(client_obj)
+
+    satisfied = self._SatisfiedConditions(features)
+
+    result = []
+    for rule, match_all, conditions, regex_conditions in itertools.izip(
+        self.rules, self._rule_match_all, self._rule_conditions,
+        self._rule_regex_conditions):
+      if rule_filter is not None and not rule_filter(rule):
+        continue
+
+      if match_all:
+        matches = conditions <= satisfied and all(
+            self._SearchRegex(features, c) for c in regex_conditions)
+      else:
+        matches = not conditions.isdisjoint(satisfied) or any(
+            self._SearchRegex(features, c) for c in regex_conditions)
+
+      if matches:
+        result.append(rule)
+
+    return result
+
+
+class HuntClientRateLimiter(object):
+  """Spaces out the clients a hunt is started on according to its client rate.
+
+  This is a token bucket shared by all foreman processes. Its state is the
+  time at which the next client of the hunt may start, which is kept in the
+  data store and advanced by 60 / client_rate seconds for every client.
+  Clients arriving faster than that are not turned away but get a later start
+  time, so the hunt fans out at the configured rate no matter how many
+  frontends see how many clients at once.
+
+  To avoid a locked data store round trip per client, start times are
+  reserved in batches and handed out from memory.
+  """
+
+  NEXT_CLIENT_DUE_ATTRIBUTE = "metadata:next_client_due"
+  LOCK_LEASE_TIME = 10
+
+  def __init__(self, batch_size=None, batch_window=None):
+    if batch_size is None:
+      batch_size = config.CONFIG["Hunt.client_rate_batch_size"]
+    if batch_window is None:
+      batch_window = config.CONFIG["Hunt.client_rate_batch_window"]
+
+    self.batch_size = batch_size
+    self.batch_window = batch_window
+    self.lock = threading.RLock()
+    # Maps hunt ids to deques of reserved start times in microseconds.
+    self._start_times = {}
+    # Maps hunt ids to [lock, number of callers using the lock] pairs. The
+    # lock guards the start times of the hunt.
+    self._hunt_locks = {}
+    self._next_stale_check = 0
+
+  def _BatchSize(self, client_rate):
+    clients_per_window = client_rate * self.batch_window.seconds / 60.0
+    return max(1, min(self.batch_size, int(clients_per_window)))
+
+  def _ReserveStartTimes(self, hunt_id, interval, count):
+    """Reserves count consecutive start times for clients of the hunt."""
+    subject = rdfvalue.RDFURN(hunt_id).Add("ClientRate")
+    now = rdfvalue.RDFDatetime.Now().AsMicroSecondsFromEpoch()
+
+    with data_store.DB.LockRetryWrapper(
+        subject, lease_time=self.LOCK_LEASE_TIME):
+      next_client_due, _ = data_store.DB.Resolve(subject,
+                                                 self.NEXT_CLIENT_DUE_ATTRIBUTE)
+      # Time the hunt did not use is not saved up for later.
+      next_client_due = max(int(next_client_due or 0), now)
+      data_store.DB.Set(subject, self.NEXT_CLIENT_DUE_ATTRIBUTE,
+                        next_client_due + count * interval)
+
+    return collections.deque(
+        next_client_due + i * interval for i in xrange(count))
+
+  @utils.Synchronized
+  def _AcquireHuntLock(self, hunt_id):
+    entry = self._hunt_locks.setdefault(hunt_id, [threading.Lock(), 0])
+    entry[1] += 1
+    return entry[0]
+
+  @utils.Synchronized
+  def _ReleaseHuntLock(self, hunt_id):
+    entry = self._hunt_locks[hunt_id]
+    entry[1] -= 1
+    if not entry[1] and hunt_id not in self._start_times:
+      del self._hunt_locks[hunt_id]
+
+  @utils.Synchronized
+  def _DropStaleStartTimes(self, now):
+    """Forgets start times reserved more than a batch window ago.
+
+    Otherwise hunts that stopped getting clients, e.g. because their rule
+    expired, would be kept for the life of the process.
+
+    Args:
+      now: The current time in microseconds.
+    """
+    if now < self._next_stale_check:
+      return
+
+    window = self.batch_window.microseconds
+    self._next_stale_check = now + window
+    for hunt_id, start_times in self._start_times.items():
+      if start_times[-1] < now - window:
+        del self._start_times[hunt_id]
+        if not self._hunt_locks[hunt_id][1]:
+          del self._hunt_locks[hunt_id]
+
+  def GetClientStartTime(self, hunt_id, client_rate):
+    """Returns when the next client of the hunt may be started.
+
+    Only callers asking for the same hunt wait for each other while start
+    times are reserved in the data store.
+
+    Args:
+      hunt_id: The id of the hunt.
+      client_rate: The maximum number of clients to start per minute.
+
+    Returns:
+      An RDFDatetime, which is now or lies in the future, or None if the hunt's
+      rate limiter state could not be locked. The hunt then schedules the
+      client itself.
+    """
+    interval = int(60.0 / client_rate * 1e6)
+    hunt_id = utils.SmartStr(hunt_id)
+
+    self._DropStaleStartTimes(
+        rdfvalue.RDFDatetime.Now().AsMicroSecondsFromEpoch())
+
+    lock = self._AcquireHuntLock(hunt_id)
+    try:
+      with lock:
+        now = rdfvalue.RDFDatetime.Now().AsMicroSecondsFromEpoch()
+        start_times = self._start_times.pop(hunt_id, None)
+
+        # Start times that were reserved but left unused for too long are
+        # dropped, otherwise they would let a burst of clients start at once.
+        while start_times and start_times[0] < now - interval:
+          start_times.popleft()
+
+        if not start_times:
+          try:
+            start_times = self._ReserveStartTimes(hunt_id, interval,
+                                                  self._BatchSize(client_rate))
+          except data_store.DBSubjectLockError as e:
+            logging.warning("Unable to reserve start times for hunt %s: %s",
+                            hunt_id, e)
+            return None
+
+        start_time = start_times.popleft()
+        if start_times:
+          self._start_times[hunt_id] = start_times
+    finally:
+      self._ReleaseHuntLock(hunt_id)
+
+    return rdfvalue.RDFDatetime(max(start_time, now))
+
+
+class ForemanCheckedClients(object):
+  """Remembers which clients were checked against the latest foreman rule.
+
+  Clients ask the foreman for work on every poll, while its rules rarely
+  change. Clients in this record were already checked against the current
+  rules, so they can be turned away without reading the time of their last
+  foreman check from the data store.
+
+  The record is a Bloom filter, so it takes the same small amount of memory no
+  matter how many clients there are. A false positive delays a client's check
+  until the record is cleared, which happens whenever the latest rule changes
+  and at the latest after max_age.
+  """
+
+  NUM_HASHES = 4
+
+  def __init__(self, size=None, max_age=None):
+    """Constructor.
+
+    Args:
+      size: The size of the Bloom filter in bits.
+      max_age: An rdfvalue.Duration after which the record is cleared.
+    """
+    if size is None:
+      size = config.CONFIG["Frontend.foreman_checked_clients_bits"]
+    if max_age is None:
+      max_age = config.CONFIG["Frontend.foreman_checked_clients_max_age"]
+
+    self.size = max(8, size)
+    self.max_age = max_age
+    self.lock = threading.Lock()
+    self._Clear(None)
+
+  def _Clear(self, latest_rule):
+    self.latest_rule = latest_rule
+    self.cleared_at = time.time()
+    self.bits = bytearray((self.size + 7) // 8)
+
+  def _IsCurrent(self, latest_rule):
+    return (latest_rule == self.latest_rule and
+            time.time() < self.cleared_at + self.max_age.seconds)
+
+  def _BitPositions(self, client_id):
+    # A sha256 digest has enough bytes for four 64 bit hashes.
+    digest = hashlib.sha256(utils.SmartStr(client_id)).digest()
+    for i in xrange(self.NUM_HASHES):
+      yield struct.unpack_from("<Q", digest, i * 8)[0] % self.size
+
+  @utils.Synchronized
+  def WasChecked(self, client_id, latest_rule):
+    """Returns True if the client was checked against the latest rule.
+
+    Args:
+      client_id: The id of the client.
+      latest_rule: The creation time of the latest foreman rule.
+    """
+    if not self._IsCurrent(latest_rule):
+      return False
+
+    return all(self.bits[position >> 3] & (1 << (position & 7))
+               for position in self._BitPositions(client_id))
+
+  @utils.Synchronized
+  def MarkChecked(self, client_id, latest_rule):
+    """Records that the client was checked against the latest rule.
+
+    Args:
+      client_id: The id of the client.
+      latest_rule: The creation time of the latest foreman rule.
+    """
+    if not self._IsCurrent(latest_rule):
+      self._Clear(latest_rule)
+
+    for position in self._BitPositions(client_id):
+      self.bits[position >> 3] |= 1 << (position & 7)
@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 """The GRR frontend server."""
 
+import hashlib
+import itertools
 import logging
 import operator
+import struct
+import threading
 import time
 
 from grr import config
@@ -13,6 +17,7 @@ from grr.lib import registry
 from grr.lib import stats
 from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.server import access_control
 from grr.server import aff4
@@ -27,6 +32,14 @@ from grr.server import threadpool
 from grr.server.aff4_objects import aff4_grr
 
 
+def _WriteClientMetadata(client_metadata_buffer, client_id, **kwargs):
+  """Writes relational client metadata, through the buffer if there is one."""
+  if client_metadata_buffer is None:
+    data_store.REL_DB.WriteClientMetadata(client_id, **kwargs)
+  else:
+    client_metadata_buffer.UpdateRelational(client_id, **kwargs)
+
+
 class ServerCommunicator(communicator.Communicator):
   """A communicator which stores certificates using AFF4."""
 
@@ -36,6 +49,9 @@ class ServerCommunicator(communicator.Communicator):
     super(ServerCommunicator, self).__init__(
         certificate=certificate, private_key=private_key)
     self.pub_key_cache = utils.FastStore(max_size=50000)
+    self.compression_level = config.CONFIG["Frontend.compression_level"]
+    # If set, client metadata is written through this ClientMetadataBuffer.
+    self.client_metadata_buffer = None
     # Our common name as an RDFURN.
     self.common_name = rdfvalue.RDFURN(self.certificate.GetCN())
 
@@ -110,6 +126,8 @@ class ServerCommunicator(communicator.Communicator):
 
       ip = response_comms.orig_request.source_ip
       client.Set(client.Schema.CLIENT_IP(ip))
+      clock = None
+      ping = None
 
       # The very first packet we see from the client we do not have its clock
       remote_time = client.Get(client.Schema.CLOCK) or rdfvalue.RDFDatetime(0)
@@ -146,12 +164,17 @@ class ServerCommunicator(communicator.Communicator):
           stats.STATS.IncrementCounter(
               "client_pings_by_label", fields=[label.name])
       else:
-        clock = None
-        ping = None
         logging.warning("Out of order message for %s: %s >= %s", client_id,
                         long(remote_time), int(client_time))
 
-      client.Flush()
+      if self.client_metadata_buffer is None:
+        client.Flush()
+      else:
+        # The cached client object keeps the new values for the replay check
+        # above, the buffer writes them out.
+        self.client_metadata_buffer.UpdateAFF4(
+            client_id, ping=ping, clock=clock, ip=ip)
+
       if data_store.RelationalDBWriteEnabled():
         source_ip = response_comms.orig_request.source_ip
         if source_ip:
@@ -161,7 +184,8 @@ class ServerCommunicator(communicator.Communicator):
           last_ip = None
 
         if ping or clock or last_ip:
-          data_store.REL_DB.WriteClientMetadata(
+          _WriteClientMetadata(
+              self.client_metadata_buffer,
               client_id.Basename(),
               last_ip=last_ip,
               last_clock=clock,
@@ -181,6 +205,9 @@ class RelationalServerCommunicator(communicator.Communicator):
     super(RelationalServerCommunicator, self).__init__(
         certificate=certificate, private_key=private_key)
     self.pub_key_cache = utils.FastStore(max_size=50000)
+    self.compression_level = config.CONFIG["Frontend.compression_level"]
+    # If set, client metadata is written through this ClientMetadataBuffer.
+    self.client_metadata_buffer = None
     self.common_name = self.certificate.GetCN()
 
   def _GetRemotePublicKey(self, common_name):
@@ -275,7 +302,8 @@ class RelationalServerCommunicator(communicator.Communicator):
       else:
         last_ip = None
 
-      data_store.REL_DB.WriteClientMetadata(
+      _WriteClientMetadata(
+          self.client_metadata_buffer,
           client_id,
           last_ip=last_ip,
           last_clock=client_time,
@@ -288,6 +316,319 @@ class RelationalServerCommunicator(communicator.Communicator):
     return rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED
 
 
+class DataStoreCipherCache(object):
+  """A cache of verified client ciphers in the data store.
+
+  The cache is shared by all frontend processes and survives restarts, so a
+  client only needs a full RSA handshake once per cipher and not once per
+  frontend process. Entries are encrypted and authenticated with keys derived
+  from the server's private key and expire after a TTL.
+  """
+
+  CACHE_ROOT = rdfvalue.RDFURN("aff4:/cipher_cache")
+  ATTRIBUTE_PREFIX = "cipher:"
+
+  # Expired entries of a shard are deleted every this many writes.
+  purge_interval = 1000
+
+  def __init__(self, private_key, ttl):
+    key_material = hashlib.sha512(private_key.AsPEM()).digest()
+    self._encryption_key = rdf_crypto.EncryptionKey(key_material[:16])
+    self._hmac = rdf_crypto.HMAC(key_material[32:])
+    self.ttl = ttl
+    self._writes = 0
+
+  def _Locate(self, encrypted_cipher):
+    digest = hashlib.sha256(encrypted_cipher).hexdigest()
+    return self.CACHE_ROOT.Add(digest[:2]), self.ATTRIBUTE_PREFIX + digest
+
+  def _ValidTimeRange(self):
+    now = rdfvalue.RDFDatetime.Now()
+    return ((now - self.ttl).AsMicroSecondsFromEpoch(),
+            now.AsMicroSecondsFromEpoch())
+
+  def _Encode(self, encrypted_cipher, cipher):
+    plain = "".join(
+        struct.pack("<I", len(x)) + x
+        for x in (encrypted_cipher, cipher.serialized_cipher,
+                  cipher.cipher_metadata.SerializeToString()))
+
+    iv = rdf_crypto.EncryptionKey.GenerateRandomIV()
+    data = iv.RawBytes() + rdf_crypto.AES128CBCCipher(
+        self._encryption_key, iv).Encrypt(plain)
+    return data + self._hmac.HMAC(data, use_sha256=True)
+
+  def _Decode(self, value, private_key):
+    """Returns the encrypted cipher and the ReceivedCipher stored in value."""
+    data, digest = value[:-32], value[-32:]
+    self._hmac.Verify(data, digest)
+
+    iv = rdf_crypto.EncryptionKey(data[:16])
+    plain = rdf_crypto.AES128CBCCipher(self._encryption_key,
+                                       iv).Decrypt(data[16:])
+
+    fields = []
+    offset = 0
+    while offset < len(plain):
+      (length,) = struct.unpack_from("<I", plain, offset)
+      offset += 4
+      fields.append(plain[offset:offset + length])
+      offset += length
+
+    encrypted_cipher, serialized_cipher, serialized_metadata = fields
+    return encrypted_cipher, communicator.ReceivedCipher.FromVerifiedCipher(
+        serialized_cipher, serialized_metadata, private_key)
+
+  def Get(self, encrypted_cipher, private_key):
+    """Returns the cached ReceivedCipher or raises KeyError."""
+    subject, attribute = self._Locate(encrypted_cipher)
+    for _, value, _ in data_store.DB.ResolveMulti(
+        subject, [attribute], timestamp=self._ValidTimeRange()):
+      try:
+        stored_cipher, cipher = self._Decode(value, private_key)
+      except (ValueError, struct.error, rdf_crypto.Error,
+              rdf_crypto.CipherError) as e:
+        logging.warning("Invalid cipher cache entry %s: %s", attribute, e)
+        continue
+
+      if stored_cipher == encrypted_cipher:
+        return cipher
+
+    raise KeyError(attribute)
+
+  def Put(self, encrypted_cipher, cipher):
+    subject, attribute = self._Locate(encrypted_cipher)
+    with data_store.DB.GetMutationPool() as mutation_pool:
+      mutation_pool.Set(subject, attribute,
+                        self._Encode(encrypted_cipher, cipher))
+
+      self._writes += 1
+      if self._writes % self.purge_interval == 0:
+        self._PurgeExpired(subject, mutation_pool)
+
+  def _PurgeExpired(self, subject, mutation_pool):
+    start, _ = self._ValidTimeRange()
+    expired = [
+        attribute
+        for attribute, _, _ in data_store.DB.ResolvePrefix(
+            subject, self.ATTRIBUTE_PREFIX, timestamp=(0, start - 1))
+    ]
+    if expired:
+      mutation_pool.DeleteAttributes(subject, expired, end=start - 1)
+
+  def Load(self, private_key, limit=None):
+    """Yields (encrypted_cipher, cipher) for all entries that did not expire.
+
+    Args:
+      private_key: Our own private key.
+      limit: The maximum number of entries to read.
+    """
+    shards = [self.CACHE_ROOT.Add("%02x" % i) for i in xrange(256)]
+    count = 0
+    for _, values in data_store.DB.MultiResolvePrefix(
+        shards, self.ATTRIBUTE_PREFIX, timestamp=self._ValidTimeRange()):
+      for _, value, _ in values:
+        try:
+          yield self._Decode(value, private_key)
+        except (ValueError, struct.error, rdf_crypto.Error,
+                rdf_crypto.CipherError):
+          continue
+
+        count += 1
+        if limit and count >= limit:
+          return
+
+
+class ClientMetadataBuffer(object):
+  """Collects client metadata updates and writes them in bulk.
+
+  Frontends update the ping, clock and IP address of a client on every poll.
+  The buffer keeps the latest values of each client in memory and writes the
+  updates of all clients at once every flush_interval seconds, or earlier once
+  max_pending clients have updates. If the frontend dies, at most
+  flush_interval seconds worth of updates are lost.
+  """
+
+  def __init__(self, flush_interval, max_pending):
+    self.flush_interval = flush_interval
+    self.max_pending = max_pending
+    self._aff4_updates = {}
+    self._relational_updates = {}
+    self._lock = threading.Lock()
+    # Serializes writes so newer values never get overwritten by older ones.
+    self._flush_lock = threading.Lock()
+    self._flusher = None
+
+  def Start(self):
+    """Starts a thread flushing the buffer every flush_interval seconds."""
+    self._flusher = utils.InterruptableThread(
+        name="ClientMetadataFlusher",
+        target=self._PeriodicFlush,
+        sleep_time=self.flush_interval)
+    self._flusher.start()
+
+  def Stop(self):
+    """Stops the flusher thread and writes all pending updates."""
+    if self._flusher is not None:
+      self._flusher.Stop()
+      self._flusher = None
+    self.Flush()
+
+  def _PeriodicFlush(self):
+    try:
+      self.Flush()
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Unable to write client metadata: %s", e)
+
+  def UpdateAFF4(self, client_id, ping=None, clock=None, ip=None):
+    """Queues new PING, CLOCK and CLIENT_IP attribute values for a client."""
+    schema = aff4_grr.VFSGRRClient.SchemaCls
+    attributes = {}
+    if ping is not None:
+      attributes[schema.PING] = schema.PING(ping)
+    if clock is not None:
+      attributes[schema.CLOCK] = schema.CLOCK(clock)
+    if ip is not None:
+      attributes[schema.CLIENT_IP] = schema.CLIENT_IP(ip)
+
+    self._Update(self._aff4_updates, rdf_client.ClientURN(client_id),
+                 attributes)
+
+  def UpdateRelational(self, client_id, **kwargs):
+    """Queues a REL_DB.WriteClientMetadata(client_id, **kwargs) call."""
+    self._Update(self._relational_updates, client_id, kwargs)
+
+  def _Update(self, updates, client_id, values):
+    with self._lock:
+      # The latest value of every field wins.
+      updates.setdefault(client_id, {}).update(values)
+      pending = len(self._aff4_updates) + len(self._relational_updates)
+
+    if pending >= self.max_pending:
+      self.Flush()
+
+  def Flush(self):
+    """Writes all pending updates."""
+    with self._flush_lock:
+      with self._lock:
+        aff4_updates, self._aff4_updates = self._aff4_updates, {}
+        relational_updates, self._relational_updates = (
+            self._relational_updates, {})
+
+      if aff4_updates:
+        with data_store.DB.GetMutationPool() as pool:
+          for client_urn, attributes in aff4_updates.iteritems():
+            # These attributes are not versioned, new values replace the old
+            # ones at timestamp 0 just like in AFF4Object.Flush().
+            aff4.FACTORY.SetAttributes(
+                client_urn, {
+                    attribute: [(value.SerializeToDataStore(), 0)]
+                    for attribute, value in attributes.iteritems()
+                },
+                set(attributes),
+                add_child_index=False,
+                mutation_pool=pool)
+
+      if relational_updates:
+        data_store.REL_DB.WriteClientsMetadata(relational_updates)
+
+      stats.STATS.IncrementCounter("frontend_client_metadata_writes",
+                                   len(aff4_updates) + len(relational_updates))
+
+
+class BackendPressure(object):
+  """Estimates how far the backend lags behind the frontend.
+
+  The pressure is the largest of three signals, each relative to its limit:
+
+  - the age of the oldest worker notification that is due,
+  - the average latency of the frontend's data store queries and
+  - the number of received messages not yet written to the data store.
+
+  A pressure of 1 means one of the limits has been reached. Notification
+  shards are sampled one at a time, at most every refresh_interval seconds.
+  """
+
+  # Weight of a new latency sample in the moving average.
+  latency_weight = 0.2
+
+  # The maximum number of notifications read from a shard per refresh.
+  notification_sample_size = 1000
+
+  def __init__(self, token=None, queue=queues.FLOWS, refresh_interval=10):
+    self.token = token
+    self.refresh_interval = refresh_interval
+    self.max_notification_age = config.CONFIG[
+        "Frontend.max_notification_age"].seconds
+    self.max_latency = config.CONFIG["Frontend.max_data_store_latency"]
+    self.max_pending_messages = config.CONFIG["Frontend.max_pending_messages"]
+
+    self._shards = itertools.cycle(
+        queue_manager.QueueManager(token=token).GetAllNotificationShards(queue))
+    self._notification_ages = {}
+    self._latency = 0.0
+    self._pending_messages = 0
+    self._last_refresh = 0
+    self._lock = threading.Lock()
+
+  def RecordLatency(self, seconds):
+    """Adds the duration of a data store query to the average latency."""
+    with self._lock:
+      self._latency += self.latency_weight * (seconds - self._latency)
+
+  def AddPendingMessages(self, count):
+    """Adjusts the number of messages waiting to be written by count."""
+    with self._lock:
+      self._pending_messages += count
+
+  def _SampleNotificationShard(self):
+    """Updates the notification age of the next shard."""
+    with self._lock:
+      shard = next(self._shards)
+
+    now = rdfvalue.RDFDatetime.Now()
+    start = time.time()
+    oldest = now
+    for notification in data_store.DB.GetNotifications(
+        shard,
+        now.AsMicroSecondsFromEpoch(),
+        limit=self.notification_sample_size):
+      if notification.first_queued:
+        oldest = min(oldest, notification.first_queued)
+
+    self.RecordLatency(time.time() - start)
+    with self._lock:
+      self._notification_ages[shard] = (now - oldest).seconds
+
+  def Get(self):
+    """Returns the current backend pressure."""
+    now = time.time()
+    with self._lock:
+      refresh = now - self._last_refresh >= self.refresh_interval
+      if refresh:
+        self._last_refresh = now
+
+    if refresh:
+      try:
+        self._SampleNotificationShard()
+      except Exception as e:  # pylint: disable=broad-except
+        logging.warning("Unable to sample worker notifications: %s", e)
+
+    with self._lock:
+      pressure = max(
+          float(max(self._notification_ages.values() or [0])) /
+          self.max_notification_age,
+          self._latency / self.max_latency,
+          float(self._pending_messages) / self.max_pending_messages)
+
+    stats.STATS.SetGaugeValue("frontend_backend_pressure", pressure)
+    return pressure
+
+
+class OverloadedError(Exception):
+  """Raised when a request is rejected because the backend is overloaded."""
+
+
 class FrontEndServer(object):
   """This is the front end server.
 
@@ -321,10 +662,26 @@ class FrontEndServer(object):
       self._communicator = ServerCommunicator(
           certificate=certificate, private_key=private_key, token=self.token)
 
+    if config.CONFIG["Frontend.shared_cipher_cache"]:
+      self._communicator.shared_cipher_cache = DataStoreCipherCache(
+          private_key, config.CONFIG["Frontend.shared_cipher_cache_ttl"])
+      self._WarmUpCipherCache()
+
+    self.client_metadata_buffer = None
+    if config.CONFIG["Frontend.client_metadata_flush_interval"]:
+      self.client_metadata_buffer = ClientMetadataBuffer(
+          config.CONFIG["Frontend.client_metadata_flush_interval"],
+          config.CONFIG["Frontend.client_metadata_max_pending"])
+      self.client_metadata_buffer.Start()
+      self._communicator.client_metadata_buffer = self.client_metadata_buffer
+
     self.receive_thread_pool = {}
     self.message_expiry_time = message_expiry_time
     self.max_retransmission_time = max_retransmission_time
     self.max_queue_size = max_queue_size
+    self.backend_pressure = None
+    if config.CONFIG["Frontend.load_shedding"]:
+      self.backend_pressure = BackendPressure(token=self.token)
     self.thread_pool = threadpool.ThreadPool.Factory(
         threadpool_prefix,
         min_threads=2,
@@ -342,6 +699,36 @@ class FrontEndServer(object):
     self.well_known_flows_blacklist = set(
         config.CONFIG["Frontend.DEBUG_well_known_flows_blacklist"])
 
+  def Stop(self):
+    """Writes buffered client metadata, must be called on shutdown."""
+    if self.client_metadata_buffer is not None:
+      self.client_metadata_buffer.Stop()
+
+  def _WarmUpCipherCache(self):
+    """Fills the in-memory cipher cache from the shared cipher cache."""
+    cipher_cache = self._communicator.encrypted_cipher_cache
+    entries = self._communicator.shared_cipher_cache.Load(
+        self._communicator.private_key, limit=cipher_cache.max_size)
+
+    count = 0
+    for encrypted_cipher, cipher in entries:
+      cipher_cache.Put(encrypted_cipher, cipher)
+      count += 1
+
+    logging.info("Loaded %d verified ciphers from the shared cache.", count)
+
+  def _LoadSheddingFraction(self):
+    """Returns how much load to shed, between 0 (none) and 1 (all)."""
+    if self.backend_pressure is None:
+      return 0.0
+
+    threshold = config.CONFIG["Frontend.load_shedding_threshold"]
+    pressure = self.backend_pressure.Get()
+    if pressure <= threshold:
+      return 0.0
+
+    return min(1.0, (pressure - threshold) / (1.0 - threshold))
+
   @stats.Counted("grr_frontendserver_handle_num")
   @stats.Timed("grr_frontendserver_handle_time")
   def HandleMessageBundles(self, request_comms, response_comms):
@@ -361,19 +748,41 @@ class FrontEndServer(object):
     Returns:
        tuple of (source, message_count) where message_count is the number of
        messages received from the client with common name source.
+
+    Raises:
+       OverloadedError: If the backend is overloaded and the bundle only holds
+       low priority messages.
     """
-    messages, source, timestamp = self._communicator.DecodeMessages(
-        request_comms)
+    shed_fraction = self._LoadSheddingFraction()
+    if (shed_fraction >= 1 and request_comms.HasField("message_priority") and
+        request_comms.message_priority ==
+        rdf_flows.GrrMessage.Priority.LOW_PRIORITY):
+      # Rejecting the bundle before decrypting it saves the most work. The
+      # client will retry the messages later.
+      stats.STATS.IncrementCounter(
+          "frontend_load_shedding", fields=["rejected_bundles"])
+      raise OverloadedError("Backend overloaded.")
+
+    messages, source, timestamp = self._communicator.DecodeMessageStream(
+        request_comms,
+        max_size=config.CONFIG["Frontend.max_decompressed_message_size"])
 
     now = time.time()
-    if messages:
-      # Receive messages in line.
-      self.ReceiveMessages(source, messages)
+    # Receive messages in line.
+    message_count = self.ReceiveMessages(source, messages)
 
-    # We send the client a maximum of self.max_queue_size messages
-    required_count = max(0, self.max_queue_size - request_comms.queue_size)
+    # We send the client a maximum of self.max_queue_size messages, fewer if
+    # the backend can not keep up with the results.
+    max_queue_size = int(self.max_queue_size * (1.0 - shed_fraction))
+    required_count = max(0, max_queue_size - request_comms.queue_size)
     tasks = []
 
+    if shed_fraction > 0:
+      stats.STATS.IncrementCounter(
+          "frontend_load_shedding", fields=["reduced_queue_size"])
+      response_comms.min_poll_interval = int(
+          shed_fraction * config.CONFIG["Frontend.max_poll_backoff"])
+
     message_list = rdf_flows.MessageList()
     # Only give the client messages if we are able to receive them in a
     # reasonable time.
@@ -397,7 +806,7 @@ class FrontEndServer(object):
         queue_manager.QueueManager(token=self.token).Schedule(tasks, pool)
       raise
 
-    return source, len(messages)
+    return source, message_count
 
   def DrainTaskSchedulerQueueForClient(self, client, max_count=None):
     """Drains the client's Task Scheduler queue.
@@ -432,6 +841,8 @@ class FrontEndServer(object):
         queue=client.Queue(),
         limit=max_count,
         lease_seconds=self.message_expiry_time)
+    if self.backend_pressure is not None:
+      self.backend_pressure.RecordLatency(time.time() - start_time)
 
     initial_ttl = rdf_flows.GrrMessage().task_ttl
     check_before_sending = []
@@ -513,6 +924,11 @@ class FrontEndServer(object):
 
   def RecordFleetspeakClientPing(self, client_id):
     """Records the last client contact in the datastore."""
+    if self.client_metadata_buffer is not None:
+      self.client_metadata_buffer.UpdateAFF4(
+          client_id, ping=rdfvalue.RDFDatetime.Now())
+      return
+
     with aff4.FACTORY.Create(
         client_id,
         aff4_type=aff4_grr.VFSGRRClient,
@@ -528,66 +944,92 @@ class FrontEndServer(object):
     response in that request's queue. If the request is complete, we
     send a message to the worker.
 
+    Messages are processed and written in batches of
+    Frontend.receive_batch_size so large message bundles can be passed as a
+    generator without holding all messages in memory.
+
     Args:
       client_id: The client which sent the messages.
-      messages: A list of GrrMessage RDFValues.
+      messages: A list or iterable of GrrMessage RDFValues.
+
+    Returns:
+      The number of messages received.
     """
     now = time.time()
-    with queue_manager.QueueManager(token=self.token) as manager:
-      for session_id, msgs in utils.GroupBy(
-          messages, operator.attrgetter("session_id")).iteritems():
+    message_count = 0
+    try:
+      with queue_manager.QueueManager(token=self.token) as manager:
+        for batch in utils.Grouper(
+            messages, config.CONFIG["Frontend.receive_batch_size"]):
+          if message_count:
+            manager.Flush()
+
+          message_count += len(batch)
+          if self.backend_pressure is not None:
+            self.backend_pressure.AddPendingMessages(len(batch))
+          self._ReceiveMessageBatch(client_id, batch, manager)
+    finally:
+      if self.backend_pressure is not None:
+        self.backend_pressure.AddPendingMessages(-message_count)
+
+    logging.debug("Received %s messages from %s in %s sec", message_count,
+                  client_id,
+                  time.time() - now)
 
-        # Remove and handle messages to WellKnownFlows
-        unprocessed_msgs = self.HandleWellKnownFlows(msgs)
+    return message_count
 
-        if not unprocessed_msgs:
-          continue
+  def _ReceiveMessageBatch(self, client_id, messages, manager):
+    """Queues a batch of messages received from client_id in manager."""
+    for session_id, msgs in utils.GroupBy(
+        messages, operator.attrgetter("session_id")).iteritems():
 
-        for msg in unprocessed_msgs:
-          manager.QueueResponse(msg)
-
-        for msg in unprocessed_msgs:
-          # Messages for well known flows should notify even though they don't
-          # have a status.
-          if msg.request_id == 0:
-            manager.QueueNotification(
-                session_id=msg.session_id, priority=msg.priority)
-            # Those messages are all the same, one notification is enough.
-            break
-          elif msg.type == rdf_flows.GrrMessage.Type.STATUS:
-            # If we receive a status message from the client it means the client
-            # has finished processing this request. We therefore can de-queue it
-            # from the client queue. msg.task_id will raise if the task id is
-            # not set (message originated at the client, there was no request on
-            # the server), so we have to check .HasTaskID() first.
-            if msg.HasTaskID():
-              manager.DeQueueClientRequest(client_id, msg.task_id)
-
-            manager.QueueNotification(
-                session_id=msg.session_id,
-                priority=msg.priority,
-                last_status=msg.request_id)
-
-            stat = rdf_flows.GrrStatus(msg.payload)
-            if stat.status == rdf_flows.GrrStatus.ReturnedStatus.CLIENT_KILLED:
-              # A client crashed while performing an action, fire an event.
-              crash_details = rdf_client.ClientCrash(
-                  client_id=client_id,
-                  session_id=session_id,
-                  backtrace=stat.backtrace,
-                  crash_message=stat.error_message,
-                  nanny_status=stat.nanny_status,
-                  timestamp=rdfvalue.RDFDatetime.Now())
-              msg = rdf_flows.GrrMessage(
-                  source=client_id,
-                  payload=crash_details,
-                  auth_state=(
-                      rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED))
-              events.Events.PublishEvent("ClientCrash", msg, token=self.token)
-
-    logging.debug("Received %s messages from %s in %s sec", len(messages),
-                  client_id,
-                  time.time() - now)
+      # Remove and handle messages to WellKnownFlows
+      unprocessed_msgs = self.HandleWellKnownFlows(msgs)
+
+      if not unprocessed_msgs:
+        continue
+
+      for msg in unprocessed_msgs:
+        manager.QueueResponse(msg)
+
+      for msg in unprocessed_msgs:
+        # Messages for well known flows should notify even though they don't
+        # have a status.
+        if msg.request_id == 0:
+          manager.QueueNotification(
+              session_id=msg.session_id, priority=msg.priority)
+          # Those messages are all the same, one notification is enough.
+          break
+        elif msg.type == rdf_flows.GrrMessage.Type.STATUS:
+          # If we receive a status message from the client it means the client
+          # has finished processing this request. We therefore can de-queue it
+          # from the client queue. msg.task_id will raise if the task id is
+          # not set (message originated at the client, there was no request on
+          # the server), so we have to check .HasTaskID() first.
+          if msg.HasTaskID():
+            manager.DeQueueClientRequest(client_id, msg.task_id)
+
+          manager.QueueNotification(
+              session_id=msg.session_id,
+              priority=msg.priority,
+              last_status=msg.request_id)
+
+          stat = rdf_flows.GrrStatus(msg.payload)
+          if stat.status == rdf_flows.GrrStatus.ReturnedStatus.CLIENT_KILLED:
+            # A client crashed while performing an action, fire an event.
+            crash_details = rdf_client.ClientCrash(
+                client_id=client_id,
+                session_id=session_id,
+                backtrace=stat.backtrace,
+                crash_message=stat.error_message,
+                nanny_status=stat.nanny_status,
+                timestamp=rdfvalue.RDFDatetime.Now())
+            msg = rdf_flows.GrrMessage(
+                source=client_id,
+                payload=crash_details,
+                auth_state=(
+                    rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED))
+            events.Events.PublishEvent("ClientCrash", msg, token=self.token)
 
   def HandleWellKnownFlows(self, messages):
     """Hands off messages to well known flows."""
@@ -680,10 +1122,17 @@ class FrontendInit(registry.InitHook):
         "frontend_inactive_request_count", fields=[("source", str)])
     stats.STATS.RegisterEventMetric(
         "frontend_request_latency", fields=[("source", str)])
+    # Requests rejected because all frontend workers were busy.
+    stats.STATS.RegisterCounterMetric("frontend_overload_count")
+    # Load shed because the backend could not keep up.
+    stats.STATS.RegisterGaugeMetric("frontend_backend_pressure", float)
+    stats.STATS.RegisterCounterMetric(
+        "frontend_load_shedding", fields=[("action", str)])
 
     stats.STATS.RegisterEventMetric("grr_frontendserver_handle_time")
     stats.STATS.RegisterCounterMetric("grr_frontendserver_handle_num")
     stats.STATS.RegisterGaugeMetric("grr_frontendserver_client_cache_size", int)
+    stats.STATS.RegisterCounterMetric("frontend_client_metadata_writes")
     stats.STATS.RegisterCounterMetric("grr_messages_sent")
 
     stats.STATS.RegisterCounterMetric(
@@ -3,8 +3,10 @@
 
 import array
 import logging
+import os
 import pdb
 import time
+import zlib
 
 import requests
 
@@ -55,7 +57,11 @@ class GRRFEServerTestBase(flow_test_lib.FlowTestsBaseclass):
 
   message_expiry_time = 100
 
+  server = None
+
   def InitTestServer(self):
+    if self.server is not None:
+      self.server.Stop()
     prefix = "pool-%s" % self._testMethodName
     self.server = front_end.FrontEndServer(
         certificate=config.CONFIG["Frontend.certificate"],
@@ -81,6 +87,7 @@ class GRRFEServerTestBase(flow_test_lib.FlowTestsBaseclass):
     self.InitTestServer()
 
   def tearDown(self):
+    self.server.Stop()
     super(GRRFEServerTestBase, self).tearDown()
     self.config_overrider.Stop()
 
@@ -121,6 +128,29 @@ class GRRFEServerTest(GRRFEServerTestBase):
       stored_message.timestamp = None
       self.assertRDFValuesEqual(stored_message, message)
 
+  def testReceiveMessagesInBatches(self):
+    client_id = test_lib.TEST_CLIENT_ID
+    flow_obj = self.FlowSetup(
+        flow_test_lib.FlowOrderTest.__name__, client_id=client_id)
+
+    session_id = flow_obj.session_id
+    messages = [
+        rdf_flows.GrrMessage(
+            request_id=1,
+            response_id=i,
+            session_id=session_id,
+            payload=rdfvalue.RDFInteger(i)) for i in range(1, 10)
+    ]
+
+    with test_lib.ConfigOverrider({"Frontend.receive_batch_size": 4}):
+      message_count = self.server.ReceiveMessages(client_id, iter(messages))
+
+    self.assertEqual(message_count, len(messages))
+
+    stored_messages = data_store.DB.ReadResponsesForRequestId(session_id, 1)
+    self.assertEqual(
+        sorted(m.response_id for m in stored_messages), range(1, 10))
+
   def testReceiveMessagesWithStatus(self):
     """Receiving a sequence of messages with a status."""
     client_id = test_lib.TEST_CLIENT_ID
@@ -384,9 +414,9 @@ class GRRFEServerTest(GRRFEServerTestBase):
     class MockCommunicator(object):
       """A fake that simulates an unenrolled client."""
 
-      def DecodeMessages(self, *unused_args):
+      def DecodeMessageStream(self, *unused_args, **unused_kw):
         """For simplicity client sends an empty request."""
-        return ([], client_id, 100)
+        return (iter([]), client_id, 100)
 
       def EncodeMessages(self, *unused_args, **unused_kw):
         """Raise because the server has no certificates for this client."""
@@ -425,6 +455,108 @@ class GRRFEServerTest(GRRFEServerTestBase):
     # Since the server tried to send it, the ttl must be decremented
     self.assertEqual(tasks[0].task_ttl - new_tasks[0].task_ttl, 1)
 
+  def _HandleOverloadedBundle(self, pressure, message_priority=None):
+    """Handles an empty bundle while the backend has the given pressure."""
+    client_id = self.SetupClient(0)
+    sent = []
+
+    class MockCommunicator(object):
+      """A fake that records the messages sent to the client."""
+
+      def DecodeMessageStream(self, *unused_args, **unused_kw):
+        return (iter([]), client_id, 100)
+
+      def EncodeMessages(self, message_list, *unused_args, **unused_kw):
+        sent.extend(message_list.job)
+
+    flow.GRRFlow.StartFlow(
+        client_id=client_id,
+        flow_name=flow_test_lib.SendingFlow.__name__,
+        message_count=10,
+        token=self.token)
+
+    request_comms = rdf_flows.ClientCommunication()
+    if message_priority is not None:
+      request_comms.message_priority = message_priority
+    response_comms = rdf_flows.ClientCommunication()
+
+    with test_lib.ConfigOverrider({
+        "Frontend.load_shedding": True,
+        "Frontend.load_shedding_threshold": 0.5,
+        "Frontend.max_poll_backoff": 600
+    }):
+      self.InitTestServer()
+      self.server.max_queue_size = 10
+      self.server._communicator = MockCommunicator()
+
+      # Simulate the backend lagging behind.
+      with utils.Stubber(self.server.backend_pressure, "Get",
+                         lambda: pressure):
+        self.server.HandleMessageBundles(request_comms, response_comms)
+
+    return sent, response_comms
+
+  def testLoadSheddingWithoutPressure(self):
+    sent, response_comms = self._HandleOverloadedBundle(0.2)
+
+    self.assertEqual(len(sent), 10)
+    self.assertFalse(response_comms.HasField("min_poll_interval"))
+
+  def testLoadSheddingUnderPressure(self):
+    sent, response_comms = self._HandleOverloadedBundle(0.75)
+
+    # Half way between the threshold and overload, half of the messages are
+    # sent and clients are asked to back off half of the maximum time.
+    self.assertEqual(len(sent), 5)
+    self.assertEqual(response_comms.min_poll_interval, 300)
+
+  def testLoadSheddingUnderOverload(self):
+    sent, response_comms = self._HandleOverloadedBundle(
+        2.0, message_priority=rdf_flows.GrrMessage.Priority.MEDIUM_PRIORITY)
+
+    self.assertEqual(sent, [])
+    self.assertEqual(response_comms.min_poll_interval, 600)
+
+  def testLoadSheddingRejectsLowPriorityBundles(self):
+    self.assertRaises(
+        front_end.OverloadedError,
+        self._HandleOverloadedBundle,
+        2.0,
+        message_priority=rdf_flows.GrrMessage.Priority.LOW_PRIORITY)
+
+  def testBackendPressure(self):
+    with test_lib.ConfigOverrider({
+        "Worker.queue_shards": 1,
+        "Frontend.max_notification_age": "100s",
+        "Frontend.max_data_store_latency": 1.0,
+        "Frontend.max_pending_messages": 100
+    }):
+      pressure = front_end.BackendPressure(token=self.token)
+
+    self.assertLess(pressure.Get(), 0.1)
+
+    pressure.AddPendingMessages(50)
+    self.assertAlmostEqual(pressure.Get(), 0.5)
+    pressure.AddPendingMessages(-50)
+
+    for _ in range(100):
+      pressure.RecordLatency(3.0)
+    self.assertAlmostEqual(pressure.Get(), 3.0, places=3)
+
+  def testBackendPressureNotificationAge(self):
+    with queue_manager.QueueManager(token=self.token) as manager:
+      manager.QueueNotification(
+          session_id=rdfvalue.SessionID(queue=queues.FLOWS, flow_name="Test"),
+          first_queued=rdfvalue.RDFDatetime.Now() - rdfvalue.Duration("200s"))
+
+    with test_lib.ConfigOverrider({
+        "Worker.queue_shards": 1,
+        "Frontend.max_notification_age": "100s"
+    }):
+      pressure = front_end.BackendPressure(token=self.token)
+
+    self.assertAlmostEqual(pressure.Get(), 2.0, places=1)
+
   def _ScheduleResponseAndStatus(self, client_id, flow_id):
     with queue_manager.QueueManager(token=self.token) as flow_manager:
       # Schedule a response.
@@ -643,6 +775,35 @@ class ClientCommsTest(test_lib.GRRBaseTest):
       self.assertEqual(now, client_obj.Get(client_obj.Schema.PING))
       self.assertEqual(client_now, client_obj.Get(client_obj.Schema.CLOCK))
 
+  def _GetPing(self):
+    client_obj = aff4.FACTORY.Open(self.client_id, token=self.token)
+    return client_obj.Get(client_obj.Schema.PING)
+
+  def testClientPingIsBuffered(self):
+    self._MakeClientRecord()
+    buf = front_end.ClientMetadataBuffer(flush_interval=60, max_pending=100)
+    self.server_communicator.client_metadata_buffer = buf
+
+    now = rdfvalue.RDFDatetime.Now()
+    with test_lib.FakeTime(now):
+      self.ClientServerCommunicate()
+
+    self.assertNotEqual(now, self._GetPing())
+
+    buf.Flush()
+    self.assertEqual(now, self._GetPing())
+
+  def testClientPingBufferFlushesWhenFull(self):
+    self._MakeClientRecord()
+    self.server_communicator.client_metadata_buffer = (
+        front_end.ClientMetadataBuffer(flush_interval=60, max_pending=1))
+
+    now = rdfvalue.RDFDatetime.Now()
+    with test_lib.FakeTime(now):
+      self.ClientServerCommunicate()
+
+    self.assertEqual(now, self._GetPing())
+
   def testClientPingStatsUpdated(self):
     """Check client ping stats are updated."""
     self._MakeClientRecord()
@@ -802,6 +963,162 @@ class ClientCommsTest(test_lib.GRRBaseTest):
         ca_certificate=config.CONFIG["CA.certificate"])
     self.assertEqual(len(list(self.ClientServerCommunicate())), 10)
 
+  def _EncodeMessages(self, message_list):
+    result = rdf_flows.ClientCommunication()
+    self.client_communicator.EncodeMessages(message_list, result)
+    return result
+
+  def testEncodeMessageListCompression(self):
+    compression_type = rdf_flows.PackedMessageList.CompressionType
+
+    def Encode(args, **kwargs):
+      message_list = rdf_flows.MessageList()
+      for _ in range(20):
+        message_list.job.Append(name="Test", args=args)
+
+      packed_message_list = rdf_flows.PackedMessageList()
+      communicator.Communicator.EncodeMessageList(message_list,
+                                                  packed_message_list, **kwargs)
+      return packed_message_list.compression
+
+    self.assertEqual(Encode("A" * 10000), compression_type.ZCOMPRESSION)
+    self.assertEqual(
+        Encode("A" * 10000, compression_level=1), compression_type.ZCOMPRESSION)
+    self.assertEqual(
+        Encode("A" * 10000, compression_level=0), compression_type.UNCOMPRESSED)
+
+    # Random data is not compressible, this is detected by sampling.
+    original_compress = zlib.compress
+    compressed_sizes = []
+
+    def Compress(data, *args):
+      compressed_sizes.append(len(data))
+      return original_compress(data, *args)
+
+    with utils.Stubber(zlib, "compress", Compress):
+      self.assertEqual(Encode(os.urandom(10000)), compression_type.UNCOMPRESSED)
+
+    # Only the samples were compressed.
+    self.assertEqual(len(compressed_sizes), 1)
+    self.assertLess(compressed_sizes[0], 20 * 10000 / 10)
+
+  def testDecodeMessageStream(self):
+    message_list = rdf_flows.MessageList()
+    for i in range(1, 101):
+      message_list.job.Append(
+          session_id=rdfvalue.SessionID(
+              base="aff4:/flows", queue=queues.FLOWS, flow_name=i),
+          name="OMG it's a string",
+          args="x" * 1000)
+
+    request_comms = self._EncodeMessages(message_list)
+
+    # Decompress in small chunks so that messages span several chunks.
+    with utils.Stubber(communicator.Communicator, "DECOMPRESSION_CHUNK_SIZE",
+                       100):
+      messages, source, _ = self.server_communicator.DecodeMessageStream(
+          request_comms)
+      decoded_messages = list(messages)
+
+    self.assertEqual(source, self.client_communicator.common_name)
+    self.assertEqual(len(decoded_messages), 100)
+    for i, message in enumerate(decoded_messages):
+      self.assertEqual(message.session_id, message_list.job[i].session_id)
+      self.assertEqual(message.args, "x" * 1000)
+      self.assertEqual(message.source, self.client_communicator.common_name)
+
+  def testDecodeMessageStreamSizeLimit(self):
+    message_list = rdf_flows.MessageList()
+    for _ in range(10):
+      message_list.job.Append(name="Compressible", args="\x00" * 100000)
+
+    request_comms = self._EncodeMessages(message_list)
+    self.assertLess(len(request_comms.encrypted), 100000)
+
+    messages, _, _ = self.server_communicator.DecodeMessageStream(
+        request_comms, max_size=500000)
+    with self.assertRaises(communicator.DecodingError):
+      list(messages)
+
+  def _CreateSharedCipherCache(self, ttl="1h"):
+    return front_end.DataStoreCipherCache(self.server_private_key,
+                                          rdfvalue.Duration(ttl))
+
+  def testSharedCipherCache(self):
+    self._MakeClientRecord()
+    self.server_communicator.shared_cipher_cache = (
+        self._CreateSharedCipherCache())
+    self.ClientServerCommunicate()
+
+    # A second frontend does not know the cipher yet but finds it in the
+    # shared cache, so it does not need to verify the signature again.
+    self._SetupCommunicator()
+    self.server_communicator.shared_cipher_cache = (
+        self._CreateSharedCipherCache())
+
+    def VerifyCipherSignature(*_):
+      raise AssertionError("Cipher signature verified again.")
+
+    avoided = stats.STATS.GetMetricValue("grr_rsa_operations_avoided")
+    with utils.Stubber(communicator.ReceivedCipher, "VerifyCipherSignature",
+                       VerifyCipherSignature):
+      decoded_messages = self.ClientServerCommunicate()
+
+    for message in decoded_messages:
+      self.assertEqual(message.auth_state,
+                       rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
+    self.assertEqual(
+        stats.STATS.GetMetricValue("grr_rsa_operations_avoided"), avoided + 2)
+
+  def testSharedCipherCacheWarmUp(self):
+    self._MakeClientRecord()
+    self.server_communicator.shared_cipher_cache = (
+        self._CreateSharedCipherCache())
+    self.ClientServerCommunicate()
+
+    loaded = list(self._CreateSharedCipherCache().Load(
+        self.server_private_key))
+    self.assertEqual(len(loaded), 1)
+    encrypted_cipher, cipher = loaded[0]
+    self.assertEqual(cipher.GetSource(), self.client_communicator.common_name)
+
+    self._SetupCommunicator()
+    self.server_communicator.encrypted_cipher_cache.Put(
+        encrypted_cipher, cipher)
+    decoded_messages = self.ClientServerCommunicate()
+    self.assertEqual(len(decoded_messages), 10)
+
+  def testSharedCipherCacheExpiry(self):
+    self._MakeClientRecord()
+    now = rdfvalue.RDFDatetime.Now()
+    with test_lib.FakeTime(now):
+      self.server_communicator.shared_cipher_cache = (
+          self._CreateSharedCipherCache())
+      self.ClientServerCommunicate()
+
+    encrypted_cipher = self.client_communicator.server_cipher.encrypted_cipher
+    shared_cache = self._CreateSharedCipherCache()
+    with test_lib.FakeTime(now + rdfvalue.Duration("2h")):
+      self.assertEqual(list(shared_cache.Load(self.server_private_key)), [])
+
+      with self.assertRaises(KeyError):
+        shared_cache.Get(encrypted_cipher, self.server_private_key)
+
+  def testSharedCipherCacheRejectsTamperedEntries(self):
+    self._MakeClientRecord()
+    shared_cache = self._CreateSharedCipherCache()
+    self.server_communicator.shared_cipher_cache = shared_cache
+    self.ClientServerCommunicate()
+
+    encrypted_cipher = self.client_communicator.server_cipher.encrypted_cipher
+    subject, attribute = shared_cache._Locate(encrypted_cipher)
+    value = data_store.DB.ResolveMulti(subject, [attribute]).next()[1]
+    tampered = value[:20] + chr(ord(value[20]) ^ 1) + value[21:]
+    data_store.DB.Set(subject, attribute, tampered)
+
+    with self.assertRaises(KeyError):
+      shared_cache.Get(encrypted_cipher, self.server_private_key)
+
 
 class HTTPClientTests(test_lib.GRRBaseTest):
   """Test the http communicator."""
@@ -831,7 +1148,8 @@ class HTTPClientTests(test_lib.GRRBaseTest):
     # And cache it in the server
     self.CreateNewServerCommunicator()
 
-    self.requests_stubber = utils.Stubber(requests, "request", self.UrlMock)
+    self.requests_stubber = utils.Stubber(requests.Session, "request",
+                                         self.UrlMock)
     self.requests_stubber.Start()
     self.sleep_stubber = utils.Stubber(time, "sleep", lambda x: None)
     self.sleep_stubber.Start()
@@ -843,6 +1161,7 @@ class HTTPClientTests(test_lib.GRRBaseTest):
     # Response to send back to clients.
     self.server_response = dict(
         session_id="aff4:/W:session", name="Echo", response_id=2)
+    self.server_min_poll_interval = 0
 
   def _MakeClient(self):
     self.client_certificate = self.ClientCertFromPrivateKey(
@@ -922,6 +1241,8 @@ class HTTPClientTests(test_lib.GRRBaseTest):
 
       # Now prepare a response
       response_comms = rdf_flows.ClientCommunication()
+      if self.server_min_poll_interval:
+        response_comms.min_poll_interval = self.server_min_poll_interval
       message_list = rdf_flows.MessageList()
       for i in range(0, num_messages):
         message_list.job.Append(request_id=i, **self.server_response)
@@ -1101,12 +1422,28 @@ class HTTPClientTests(test_lib.GRRBaseTest):
     """
     self._CheckFastPoll(True, config.CONFIG["Client.poll_min"])
 
+  def testServerRequestsBackoff(self):
+    """A loaded server can override fast poll mode."""
+    self.server_response = dict(
+        session_id="aff4:/W:session",
+        name="Echo",
+        response_id=2,
+        require_fastpoll=True)
+    self.server_min_poll_interval = 120
+    self.SendToServer()
+
+    self.client_communicator.RunOnce()
+    self.assertEqual(self.client_communicator.timer.sleep_time, 120)
+    self.assertEqual(self.client_communication.message_priority,
+                     rdf_flows.GrrMessage.Priority.MEDIUM_PRIORITY)
+    self.CheckClientQueue()
+
   def testCorruption(self):
     """Simulate corruption of the http payload."""
 
     self.corruptor_field = None
 
-    def Corruptor(url="", data=None, **kwargs):
+    def Corruptor(unused_session, url="", data=None, **kwargs):
       """Futz with some of the fields."""
       comm_cls = rdf_flows.ClientCommunication
       if data is not None:
@@ -1140,7 +1477,7 @@ class HTTPClientTests(test_lib.GRRBaseTest):
       data = self.client_communication.SerializeToString()
       return self.UrlMock(url=url, data=data, **kwargs)
 
-    with utils.Stubber(requests, "request", Corruptor):
+    with utils.Stubber(requests.Session, "request", Corruptor):
       self.SendToServer()
       status = self.client_communicator.RunOnce()
       self.assertEqual(status.code, 200)
@@ -1173,13 +1510,13 @@ class HTTPClientTests(test_lib.GRRBaseTest):
     fail = True
     num_messages = 10
 
-    def FlakyServer(url=None, **kwargs):
+    def FlakyServer(unused_session, url=None, **kwargs):
       if not fail or "server.pem" in url:
         return self.UrlMock(num_messages=num_messages, url=url, **kwargs)
 
       raise MakeHTTPException(500)
 
-    with utils.Stubber(requests, "request", FlakyServer):
+    with utils.Stubber(requests.Session, "request", FlakyServer):
       self.SendToServer()
       status = self.client_communicator.RunOnce()
       self.assertEqual(status.code, 500)
@@ -1319,7 +1656,7 @@ class HTTPClientTests(test_lib.GRRBaseTest):
         worker_cls=worker_mocks.DisabledNannyClientWorker)
     # Make the connection unavailable and skip the retry interval.
     with utils.MultiStubber(
-        (requests, "request", self.RaiseError),
+        (requests.Session, "request", self.RaiseError),
         (client_obj.http_manager, "connection_error_limit", 8)):
       # Simulate a client run. The client will retry the connection limit by
       # itself. The Run() method will quit when connection_error_limit is
@@ -1346,6 +1683,9 @@ class RelationalClientCommsTest(ClientCommsTest):
   def _LabelClient(self, client_id, label):
     data_store.REL_DB.AddClientLabels(client_id, "Test", [label])
 
+  def _GetPing(self):
+    return data_store.REL_DB.ReadClientMetadata(self.client_id).ping
+
   def testClientPingAndClockIsUpdated(self):
     """Check PING and CLOCK are updated."""
 
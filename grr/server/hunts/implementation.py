@@ -9,6 +9,7 @@ import logging
 import threading
 import traceback
 
+from grr import config
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import stats
@@ -27,7 +28,6 @@ from grr.server import flow
 from grr.server import flow_runner
 from grr.server import foreman as rdf_foreman
 from grr.server import grr_collections
-from grr.server import multi_type_collection
 from grr.server import output_plugin as output_plugin_lib
 from grr.server import queue_manager
 from grr.server.aff4_objects import aff4_grr
@@ -65,6 +65,18 @@ class HuntResultsMetadata(aff4.AFF4Object):
         versioned=False)
 
 
+class _RequestShard(object):
+  """Completed requests of some of the hunt's clients.
+
+  The requests of a shard are processed in order, different shards are
+  processed in parallel.
+  """
+
+  def __init__(self):
+    self.requests = []
+    self.processed_requests = 0
+
+
 class HuntRunner(object):
   """The runner for hunts.
 
@@ -105,6 +117,7 @@ class HuntRunner(object):
       self.context = self.InitializeContext(runner_args)
       self.hunt_obj.context = self.context
       self.context.session_id = self.session_id
+      self.hunt_obj.completion_stats = rdf_hunts.HuntClientCompletionStats()
 
     else:
       # Retrieve args from the hunts object's context. The hunt object is
@@ -141,57 +154,133 @@ class HuntRunner(object):
           manager.DeQueueClientRequest(request.client_id,
                                        request.request.task_id)
 
-    processing = []
+    num_shards = config.CONFIG["Hunt.request_processing_shards"]
+    # Clients with incomplete responses are skipped for the rest of this run so
+    # that the requests of every client are still processed in order.
+    blocked_clients = set()
     while True:
+      # The first shard takes the requests that are processed right away.
+      shards = [_RequestShard() for _ in xrange(num_shards + 1)]
       try:
-        # Here we only care about completed requests - i.e. those requests with
-        # responses followed by a status message.
-        for request, responses in self.queue_manager.FetchCompletedResponses(
-            self.session_id, timestamp=(0, notification.timestamp)):
-
-          if request.id == 0 or not responses:
-            continue
-
-          # Do we have all the responses here? This can happen if some of the
-          # responses were lost.
-          if len(responses) != responses[-1].response_id:
-            # If we can retransmit do so. Note, this is different from the
-            # automatic retransmission facilitated by the task scheduler (the
-            # Task.task_ttl field) which would happen regardless of these.
-            if request.transmission_count < 5:
-              stats.STATS.IncrementCounter("grr_request_retransmission_count")
-              request.transmission_count += 1
-              self.QueueRequest(request)
-            break
-
-          # If we get here its all good - run the hunt.
-          self.hunt_obj.HeartBeat()
-          self._Process(
-              request, responses, thread_pool=thread_pool, events=processing)
-
-          # At this point we have processed this request - we can remove it and
-          # its responses from the queue.
-          self.queue_manager.DeleteRequest(request)
-          self.context.next_processed_request += 1
-
-        # We are done here.
-        return
-
+        self._ShardCompletedRequests(notification, shards, blocked_clients)
+        more_data = False
       except queue_manager.MoreDataException:
-        # Join any threads.
-        for event in processing:
-          event.wait()
-
         # We did not read all the requests/responses in this run in order to
         # keep a low memory footprint and have to make another pass.
-        self.FlushMessages()
-        self.hunt_obj.Flush()
+        more_data = True
+
+      processed = self._ProcessShards(shards, thread_pool)
+      # If nothing could be processed, another pass would read the same
+      # requests again.
+      if not more_data or not processed:
+        self._ReconcileResultCountsIfDue()
+        return
+
+      self.FlushMessages()
+      self.hunt_obj.Flush()
+
+  def _ReconcileResultCountsIfDue(self):
+    """Reconciles the hunt's result counts every once in a while."""
+    reconciled_at = self.context.result_counts_reconciled_at
+    interval = config.CONFIG["Hunt.result_counts_reconciliation_interval"]
+    if reconciled_at and reconciled_at + interval > rdfvalue.RDFDatetime.Now():
+      return
+
+    self.hunt_obj.ReconcileResultCounts()
+
+  def _ShardCompletedRequests(self, notification, shards, blocked_clients):
+    """Reads completed requests and distributes them over shards by client.
+
+    Requests that change the state of the whole hunt are processed right away
+    and counted in the first shard.
+
+    Args:
+      notification: The notification object that triggered this processing.
+      shards: A list of _RequestShard objects to fill.
+      blocked_clients: A set of clients whose requests are not to be read. This
+        is updated with clients that have incomplete responses.
+
+    Raises:
+      queue_manager.MoreDataException: If there are more completed requests
+        than read in one go. The requests read so far are in the shards.
+    """
+    # Here we only care about completed requests - i.e. those requests with
+    # responses followed by a status message.
+    for request, responses in self.queue_manager.FetchCompletedResponses(
+        self.session_id, timestamp=(0, notification.timestamp)):
+
+      if request.id == 0 or not responses:
         continue
 
-      finally:
-        # Join any threads.
-        for event in processing:
-          event.wait()
+      if request.client_id in blocked_clients:
+        continue
+
+      # Do we have all the responses here? This can happen if some of the
+      # responses were lost.
+      if len(responses) != responses[-1].response_id:
+        # If we can retransmit do so. Note, this is different from the
+        # automatic retransmission facilitated by the task scheduler (the
+        # Task.task_ttl field) which would happen regardless of these.
+        if request.transmission_count < 5:
+          stats.STATS.IncrementCounter("grr_request_retransmission_count")
+          request.transmission_count += 1
+          self.QueueRequest(request)
+        blocked_clients.add(request.client_id)
+        continue
+
+      if request.next_state in self.HUNT_WIDE_STATES:
+        self.hunt_obj.HeartBeat()
+        self._Process(request, responses)
+        self.queue_manager.DeleteRequest(request)
+        shards[0].processed_requests += 1
+      else:
+        shard_index = 1 + hash(utils.SmartStr(request.client_id)) % (
+            len(shards) - 1)
+        shards[shard_index].requests.append((request, responses))
+
+  def _ProcessShards(self, shards, thread_pool):
+    """Processes the shards in parallel and the requests of a shard in order.
+
+    Args:
+      shards: A list of _RequestShard objects.
+      thread_pool: The thread pool to process the shards on.
+
+    Returns:
+      The total number of processed requests.
+    """
+    events = []
+    try:
+      for shard in shards:
+        if shard.requests:
+          event = threading.Event()
+          events.append(event)
+          thread_pool.AddTask(
+              target=self._ProcessShard,
+              args=(shard, event),
+              name="Hunt processing")
+    finally:
+      # Join any threads.
+      for event in events:
+        event.wait()
+
+    processed = sum(shard.processed_requests for shard in shards)
+    self.context.next_processed_request += processed
+    return processed
+
+  def _ProcessShard(self, shard, event):
+    """Processes the requests of a shard in order."""
+    try:
+      for request, responses in shard.requests:
+        # If we get here its all good - run the hunt.
+        self.hunt_obj.HeartBeat()
+        self._Process(request, responses)
+
+        # At this point we have processed this request - we can remove it and
+        # its responses from the queue.
+        self.queue_manager.DeleteRequest(request)
+        shard.processed_requests += 1
+    finally:
+      event.set()
 
   def RunStateMethod(self,
                      method,
@@ -481,17 +570,20 @@ class HuntRunner(object):
     """Flows can call this method to set a status message visible to users."""
     self.Log(format_str, *args)
 
-  def _AddClient(self, client_id):
-    next_client_due = self.hunt_obj.context.next_client_due
+  def _AddClient(self, client_id, start_time=None):
     if self.runner_args.client_rate > 0:
-      self.hunt_obj.context.next_client_due = (
-          next_client_due + 60.0 / self.runner_args.client_rate)
+      # The foreman usually tells us when the client may start. Otherwise we
+      # schedule the client ourselves.
+      if start_time is None:
+        start_time = self.hunt_obj.context.next_client_due
+        self.hunt_obj.context.next_client_due = (
+            start_time + 60.0 / self.runner_args.client_rate)
       self.hunt_obj.context.clients_queued_count += 1
       self.CallState(
           messages=[client_id],
           next_state="RegisterClient",
           client_id=client_id,
-          start_time=next_client_due)
+          start_time=start_time)
     else:
       self._RegisterAndRunClient(client_id)
 
@@ -499,10 +591,12 @@ class HuntRunner(object):
     self.hunt_obj.RegisterClient(client_id)
     self.RunStateMethod("RunClient", direct_response=[client_id])
 
-  def _Process(self, request, responses, thread_pool=None, events=None):
-    """Hunts process all responses concurrently in a threadpool."""
-    # This function is called and runs within the main processing thread. We do
-    # not need to lock the hunt object while running in this method.
+  # States that change hunt wide state. Requests for these are processed one by
+  # one in the main processing thread.
+  HUNT_WIDE_STATES = frozenset(["AddClient", "RegisterClient"])
+
+  def _Process(self, request, responses):
+    """Runs the state method for a completed request."""
     if request.next_state == "AddClient":
       if not self.IsHuntStarted():
         logging.debug(
@@ -529,8 +623,11 @@ class HuntRunner(object):
 
       # Add client to list of clients and optionally run it
       # (if client_rate == 0).
+      start_time = None
+      if request.HasField("data"):
+        start_time = request.data.GetItem("start_time")
 
-      self._AddClient(request.client_id)
+      self._AddClient(request.client_id, start_time=start_time)
       return
 
     if request.next_state == "RegisterClient":
@@ -549,14 +646,7 @@ class HuntRunner(object):
             self.hunt_obj.Get(self.hunt_obj.Schema.STATE))
       return
 
-    event = threading.Event()
-    events.append(event)
-    # In a hunt, all requests are independent and can be processed
-    # in separate threads.
-    thread_pool.AddTask(
-        target=self.RunStateMethod,
-        args=(request.next_state, request, responses, event),
-        name="Hunt processing")
+    self.RunStateMethod(request.next_state, request, responses)
 
   def Log(self, format_str, *args):
     """Logs the message using the hunt's standard logging.
@@ -670,7 +760,8 @@ class HuntRunner(object):
     foreman_rule.actions.Append(
         hunt_id=self.session_id,
         hunt_name=self.runner_args.hunt_name,
-        client_limit=self.runner_args.client_limit)
+        client_limit=self.runner_args.client_limit,
+        client_rate=self.runner_args.client_rate)
 
     # Make sure the rule makes sense.
     foreman_rule.Validate()
@@ -887,6 +978,13 @@ class GRRHunt(flow.FlowBase):
         versioned=False,
         creates_new_object_version=False)
 
+    CLIENT_COMPLETION_STATS = aff4.Attribute(
+        "aff4:client_completion_stats",
+        rdf_hunts.HuntClientCompletionStats,
+        "Counts of started, completed and failed clients over time.",
+        versioned=False,
+        creates_new_object_version=False)
+
     # This needs to be kept out the args semantic value since must be updated
     # without taking a lock on the hunt object.
     STATE = aff4.Attribute(
@@ -910,9 +1008,12 @@ class GRRHunt(flow.FlowBase):
     # Hunts run in multiple threads so we need to protect access.
     self.lock = threading.RLock()
     self.processed_responses = False
+    # Hunts created before the stats were introduced don't have them.
+    self.completion_stats = None
 
     if "r" in self.mode:
       self.client_count = self.Get(self.Schema.CLIENT_COUNT)
+      self.completion_stats = self.Get(self.Schema.CLIENT_COMPLETION_STATS)
       self.runner_args = self.Get(self.Schema.HUNT_RUNNER_ARGS)
       self.context = self.Get(self.Schema.HUNT_CONTEXT)
 
@@ -959,12 +1060,69 @@ class GRRHunt(flow.FlowBase):
 
   @classmethod
   def TypedResultCollectionForHID(cls, hunt_id):
-    return multi_type_collection.MultiTypeCollection(
+    return hunts_results.HuntResultMultiTypeCollection(
         hunt_id.Add("ResultsPerType"))
 
   def TypedResultCollection(self):
     return self.TypedResultCollectionForHID(self.session_id)
 
+  def GetResultsCount(self):
+    """Returns the number of results of this hunt."""
+    # Counts are only trusted once they were checked against the collections,
+    # e.g. hunts created before results were counted by type have never been.
+    if self.context.result_counts_reconciled_at:
+      return self.context.results_count
+
+    return len(self.ResultCollection())
+
+  def GetResultTypeCounts(self):
+    """Returns a dict mapping result type names to numbers of results."""
+    if self.context.result_counts_reconciled_at:
+      return dict((type_count.type_name, type_count.count)
+                  for type_count in self.context.result_type_counts)
+
+    collection = self.TypedResultCollection()
+    return dict((type_name, collection.LengthByType(type_name))
+                for type_name in collection.ListStoredTypes())
+
+  def _CountResultTypes(self, msgs):
+    """Adds the given results to the per type result counts."""
+    counts = dict((type_count.type_name, type_count.count)
+                  for type_count in self.context.result_type_counts)
+    for msg in msgs:
+      type_name = msg.args_rdf_name or rdf_flows.GrrMessage.__name__
+      counts[type_name] = counts.get(type_name, 0) + 1
+
+    self.context.result_type_counts = [
+        rdf_hunts.HuntResultTypeCount(type_name=type_name, count=count)
+        for type_name, count in sorted(counts.items())
+    ]
+
+  def ReconcileResultCounts(self):
+    """Sets the result counts to the numbers of results in the collections.
+
+    Results are counted as they are added, but counts can drift if a worker
+    dies between writing results and writing the hunt. This must only be
+    called while holding the hunt lease, so that no results are added
+    concurrently.
+    """
+    collection = self.TypedResultCollection()
+    type_counts = []
+    for type_name in sorted(collection.ListStoredTypes()):
+      type_counts.append(
+          rdf_hunts.HuntResultTypeCount(
+              type_name=type_name, count=collection.LengthByType(type_name)))
+
+    results_count = len(self.ResultCollection())
+    if results_count != self.context.results_count:
+      logging.warning("Hunt %s counted %d results, but has %d.", self.urn,
+                      self.context.results_count, results_count)
+      stats.STATS.IncrementCounter("hunt_result_counts_reconciled")
+
+    self.context.results_count = results_count
+    self.context.result_type_counts = type_counts
+    self.context.result_counts_reconciled_at = rdfvalue.RDFDatetime.Now()
+
   # Collection for logs.
   @property
   def logs_collection_urn(self):
@@ -1092,9 +1250,13 @@ class GRRHunt(flow.FlowBase):
     if self.context.clients_queued_count:
       self.context.clients_queued_count -= 1
     self._AddURNToCollection(client_urn, self.all_clients_collection_urn)
+    if self.completion_stats is not None:
+      self.completion_stats.RegisterStartedClient(rdfvalue.RDFDatetime.Now())
 
   def RegisterCompletedClient(self, client_urn):
     self._AddURNToCollection(client_urn, self.completed_clients_collection_urn)
+    if self.completion_stats is not None:
+      self.completion_stats.RegisterCompletedClient(rdfvalue.RDFDatetime.Now())
 
   def RegisterClientWithResults(self, client_urn):
     self._AddURNToCollection(client_urn,
@@ -1106,6 +1268,8 @@ class GRRHunt(flow.FlowBase):
       error.log_message = utils.SmartUnicode(log_message)
 
     self._AddHuntErrorToCollection(error, self.clients_errors_collection_urn)
+    if self.completion_stats is not None:
+      self.completion_stats.RegisterClientError()
 
   def OnDelete(self, deletion_pool=None):
     super(GRRHunt, self).OnDelete(deletion_pool=deletion_pool)
@@ -1202,7 +1366,7 @@ class GRRHunt(flow.FlowBase):
     return hunt_obj
 
   @classmethod
-  def StartClients(cls, hunt_id, client_ids, token=None):
+  def StartClients(cls, hunt_id, client_ids, token=None, start_time=None):
     """This method is called by the foreman for each client it discovers.
 
     Note that this function is performance sensitive since it is called by the
@@ -1212,6 +1376,9 @@ class GRRHunt(flow.FlowBase):
       hunt_id: The hunt to schedule.
       client_ids: List of clients that should be added to the hunt.
       token: An optional access token to use.
+      start_time: When the clients may be started, as determined by the
+        foreman's client rate limiter. If not set, rate limited hunts schedule
+        the clients themselves.
     """
     token = token or access_control.ACLToken(username="Hunt", reason="hunting")
 
@@ -1225,6 +1392,9 @@ class GRRHunt(flow.FlowBase):
             session_id=hunt_id,
             client_id=client_id,
             next_state="AddClient")
+        if start_time is not None:
+          state.data = rdf_protodict.Dict().FromDict(
+              {"start_time": start_time})
 
         # Queue the new request.
         flow_manager.QueueRequest(state)
@@ -1319,13 +1489,25 @@ class GRRHunt(flow.FlowBase):
             for response in responses
         ]
 
+        collection_msgs = msgs
+        if self.runner_args.deduplicate_results:
+          deduplicated = hunts_results.HuntResultCollection.DeduplicatePayloads(
+              msgs, token=self.token)
+          collection_msgs, deduplicated_count, deduplicated_bytes = deduplicated
+          self.context.deduplicated_results_count += deduplicated_count
+          self.context.deduplicated_results_bytes += deduplicated_bytes
+          stats.STATS.IncrementCounter(
+              "hunt_results_deduplicated", delta=deduplicated_count)
+          stats.STATS.IncrementCounter(
+              "hunt_results_deduplicated_bytes", delta=deduplicated_bytes)
+
         with data_store.DB.GetMutationPool() as pool:
-          for msg in msgs:
+          for msg in collection_msgs:
             hunts_results.HuntResultCollection.StaticAdd(
                 self.results_collection_urn, msg, mutation_pool=pool)
 
-          for msg in msgs:
-            multi_type_collection.MultiTypeCollection.StaticAdd(
+          for msg in collection_msgs:
+            hunts_results.HuntResultMultiTypeCollection.StaticAdd(
                 self.multi_type_output_urn, msg, mutation_pool=pool)
 
         self.context.completed_clients_count += 1
@@ -1333,6 +1515,7 @@ class GRRHunt(flow.FlowBase):
           self.RegisterClientWithResults(client_id)
           self.context.clients_with_results_count += 1
           self.context.results_count += len(responses)
+          self._CountResultTypes(msgs)
 
         self.StopHuntIfAverageLimitsExceeded()
 
@@ -1472,6 +1655,11 @@ class GRRHunt(flow.FlowBase):
     self.context.usage_stats.RegisterResources(resources)
 
   def GetClientsCounts(self):
+    """Returns the number of all, completed and failed clients."""
+    if self.completion_stats is not None:
+      return (self.completion_stats.started_clients_count,
+              self.completion_stats.completed_clients_count,
+              self.completion_stats.clients_errors_count)
 
     collections_dict = dict(
         (urn, col_type(urn))
@@ -1552,6 +1740,8 @@ class GRRHunt(flow.FlowBase):
       self.Set(self.Schema.HUNT_ARGS(self.args))
       self.Set(self.Schema.HUNT_CONTEXT(self.context))
       self.Set(self.Schema.HUNT_RUNNER_ARGS(self.runner_args))
+      if self.completion_stats is not None:
+        self.Set(self.Schema.CLIENT_COMPLETION_STATS(self.completion_stats))
 
 
 class HuntInitHook(registry.InitHook):
@@ -1559,3 +1749,6 @@ class HuntInitHook(registry.InitHook):
   def RunOnce(self):
     """Register standard hunt-related stats."""
     stats.STATS.RegisterCounterMetric("hunt_results_added")
+    stats.STATS.RegisterCounterMetric("hunt_results_deduplicated")
+    stats.STATS.RegisterCounterMetric("hunt_results_deduplicated_bytes")
+    stats.STATS.RegisterCounterMetric("hunt_result_counts_reconciled")
@@ -3,7 +3,10 @@
 """
 
 import logging
+import threading
+import time
 
+from grr import config
 from grr.lib import rdfvalue
 from grr.lib import stats
 from grr.lib import utils
@@ -15,6 +18,7 @@ from grr.server import aff4
 from grr.server import data_store
 from grr.server import flow
 from grr.server import output_plugin
+from grr.server import threadpool
 from grr.server.aff4_objects import cronjobs
 from grr.server.hunts import implementation
 from grr.server.hunts import results as hunts_results
@@ -49,11 +53,29 @@ class ResultsProcessingError(Exception):
     return "\n".join(messages)
 
 
+class _PluginConsumer(object):
+  """Feeds the claimed results of a hunt to one of its output plugins."""
+
+  def __init__(self, hunt_urn, plugin_def, plugin):
+    self.hunt_urn = hunt_urn
+    self.plugin_def = plugin_def
+    self.plugin = plugin
+    # The index of the next batch to process.
+    self.offset = 0
+    self.running = False
+    self.exceptions = []
+
+
 class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
   """Periodic cron flow that processes hunt results.
 
   The ProcessHuntResultCollectionsCronFlow reads hunt results stored in
   HuntResultCollections and feeds runs output plugins on them.
+
+  Several hunts are processed at the same time. Every output plugin of a hunt
+  is an independent consumer of the hunt's results, running on a shared thread
+  pool, so a slow plugin only holds back its own hunt and at most
+  Hunt.output_plugin_max_concurrent_batches pool threads.
   """
 
   frequency = rdfvalue.Duration("5m")
@@ -88,101 +110,305 @@ class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
       used_plugins.append((plugin_def, plugin_def.GetPluginForState(state)))
     return output_plugins, used_plugins
 
-  def RunPlugins(self, hunt_urn, plugins, results, exceptions_by_plugin):
-    for plugin_def, plugin in plugins:
-      try:
-        plugin.ProcessResponses(results)
-        plugin.Flush()
+  def RunPlugin(self, hunt_urn, plugin_def, plugin, results):
+    """Runs one output plugin over a batch of results.
 
-        plugin_status = output_plugin.OutputPluginBatchProcessingStatus(
-            plugin_descriptor=plugin_def,
-            status="SUCCESS",
-            batch_size=len(results))
+    Failures are retried up to Hunt.output_plugin_retries times with an
+    exponential backoff.
+
+    Args:
+      hunt_urn: Urn of the hunt the results belong to.
+      plugin_def: The OutputPluginDescriptor of the plugin.
+      plugin: The output plugin instance.
+      results: A list of results to process.
+
+    Returns:
+      The exception the last attempt failed with or None on success.
+    """
+    retries = config.CONFIG["Hunt.output_plugin_retries"]
+    retry_delay = config.CONFIG["Hunt.output_plugin_retry_delay"].seconds
+
+    for attempt in xrange(retries + 1):
+      if attempt:
         stats.STATS.IncrementCounter(
-            "hunt_results_ran_through_plugin",
-            delta=len(results),
-            fields=[plugin_def.plugin_name])
+            "hunt_output_plugin_retries", fields=[plugin_def.plugin_name])
+        time.sleep(retry_delay * 2**(attempt - 1))
 
+      try:
+        # Plugins get one homogeneous batch per result type, so that values
+        # of the same type are converted and written together.
+        for _, results_of_type in sorted(
+            utils.GroupBy(results, lambda r: r.args_rdf_name).items()):
+          plugin.ProcessResponses(results_of_type)
+        plugin.Flush()
       except Exception as e:  # pylint: disable=broad-except
         logging.exception("Error processing hunt results: hunt %s, "
                           "plugin %s", hunt_urn, utils.SmartStr(plugin))
-        self.Log("Error processing hunt results (hunt %s, "
-                 "plugin %s): %s" % (hunt_urn, utils.SmartStr(plugin), e))
-        stats.STATS.IncrementCounter(
-            "hunt_output_plugin_errors", fields=[plugin_def.plugin_name])
-
-        plugin_status = output_plugin.OutputPluginBatchProcessingStatus(
-            plugin_descriptor=plugin_def,
-            status="ERROR",
-            summary=utils.SmartStr(e),
-            batch_size=len(results))
-        exceptions_by_plugin.setdefault(plugin_def, []).append(e)
+        error = e
+      else:
+        error = None
+        break
 
-      with data_store.DB.GetMutationPool() as pool:
-        implementation.GRRHunt.PluginStatusCollectionForHID(hunt_urn).Add(
+    if error is None:
+      plugin_status = output_plugin.OutputPluginBatchProcessingStatus(
+          plugin_descriptor=plugin_def,
+          status="SUCCESS",
+          batch_size=len(results))
+      stats.STATS.IncrementCounter(
+          "hunt_results_ran_through_plugin",
+          delta=len(results),
+          fields=[plugin_def.plugin_name])
+    else:
+      stats.STATS.IncrementCounter(
+          "hunt_output_plugin_errors", fields=[plugin_def.plugin_name])
+      plugin_status = output_plugin.OutputPluginBatchProcessingStatus(
+          plugin_descriptor=plugin_def,
+          status="ERROR",
+          summary=utils.SmartStr(error),
+          batch_size=len(results))
+
+    with data_store.DB.GetMutationPool() as pool:
+      implementation.GRRHunt.PluginStatusCollectionForHID(hunt_urn).Add(
+          plugin_status, mutation_pool=pool)
+      if plugin_status.status == plugin_status.Status.ERROR:
+        implementation.GRRHunt.PluginErrorCollectionForHID(hunt_urn).Add(
             plugin_status, mutation_pool=pool)
-        if plugin_status.status == plugin_status.Status.ERROR:
-          implementation.GRRHunt.PluginErrorCollectionForHID(hunt_urn).Add(
-              plugin_status, mutation_pool=pool)
+
+    return error
+
+  def _RunConsumer(self, consumer, batch, results):
+    """Runs a consumer over one batch, called on the thread pool."""
+    try:
+      error = self.RunPlugin(consumer.hunt_urn, consumer.plugin_def,
+                             consumer.plugin, results)
+      if error is not None:
+        consumer.exceptions.append(error)
+
+      # The lag is the age of the oldest result in the batch.
+      oldest = min(r.value.timestamp for r in batch)
+      stats.STATS.RecordEvent(
+          "hunt_output_plugin_lag",
+          (rdfvalue.RDFDatetime.Now() - oldest).seconds,
+          fields=[consumer.plugin_def.plugin_name])
+    finally:
+      with self._condition:
+        consumer.offset += 1
+        consumer.running = False
+        self._running_batches[consumer.plugin_def.plugin_name] -= 1
+        self._completed_batches += 1
+        self._condition.notify_all()
+
+  def _ReserveCapacity(self, consumer):
+    """Returns True if the consumer's plugin type may run another batch.
+
+    Must be called with self._condition held.
+
+    Args:
+      consumer: The _PluginConsumer that wants to run.
+    """
+    plugin_name = consumer.plugin_def.plugin_name
+    running = self._running_batches.get(plugin_name, 0)
+    if running >= config.CONFIG["Hunt.output_plugin_max_concurrent_batches"]:
+      return False
+
+    self._running_batches[plugin_name] = running + 1
+    consumer.running = True
+    return True
+
+  def _RunConsumers(self, consumers, batches, metadata_obj, resolve):
+    """Runs all output plugins of a hunt over the batches.
+
+    Every consumer works through the batches at its own pace but may not get
+    more than Hunt.output_plugin_max_lead batches ahead of the slowest one.
+    Batches that all consumers are done with are committed: their
+    notifications are deleted and the number of processed results is updated.
+
+    Args:
+      consumers: A list of _PluginConsumer objects.
+      batches: A list of lists of notifications.
+      metadata_obj: The locked HuntResultsMetadata object of the hunt.
+      resolve: A function returning the results for a batch index.
+
+    Returns:
+      The number of results committed.
+    """
+    max_lead = max(1, config.CONFIG["Hunt.output_plugin_max_lead"])
+    resolved = {}
+    committed = 0
+    num_processed = int(
+        metadata_obj.Get(metadata_obj.Schema.NUM_PROCESSED_RESULTS))
+    # When we run out of time, consumers stop once they catch up with the
+    # leading one, so all plugins always see the same results.
+    end = len(batches)
+
+    while True:
+      with self._condition:
+        if end == len(batches) and self.CheckIfRunningTooLong():
+          logging.warning("Run too long, stopping.")
+          end = max([c.offset + c.running for c in consumers] or [committed])
+
+        lowest = min([c.offset for c in consumers] or [end])
+        to_start = []
+        for consumer in consumers:
+          if (not consumer.running and consumer.offset < end and
+              consumer.offset < lowest + max_lead and
+              self._ReserveCapacity(consumer)):
+            to_start.append(consumer)
+
+        completed_batches = self._completed_batches
+
+      # Reading results and talking to the data store happens without holding
+      # the lock, so consumers of other hunts can make progress.
+      for consumer in to_start:
+        if consumer.offset not in resolved:
+          resolved[consumer.offset] = resolve(consumer.offset)
+        self._pool.AddTask(
+            target=self._RunConsumer,
+            args=(consumer, batches[consumer.offset],
+                  resolved[consumer.offset]),
+            name="%s %s" % (consumer.hunt_urn, consumer.plugin_def.plugin_name),
+            inline=False)
+
+      while committed < min(lowest, end):
+        batch = batches[committed]
+        resolved.pop(committed, None)
+        hunts_results.HuntResultQueue.DeleteNotifications(
+            batch, token=self.token)
+        num_processed += len(batch)
+        committed += 1
+        metadata_obj.Set(
+            metadata_obj.Schema.NUM_PROCESSED_RESULTS(num_processed))
+        metadata_obj.UpdateLease(600)
+
+      if committed >= end:
+        break
+
+      with self._condition:
+        # Consumers of other hunts may free capacity for ours, so we also wake
+        # up when they finish a batch.
+        if completed_batches == self._completed_batches:
+          self._condition.wait(1)
+
+    return sum(len(batch) for batch in batches[:committed])
+
+  def _ShouldDeferResults(self, hunt_urn, results):
+    """Returns True if the results are to be left for a later run.
+
+    If Hunt.output_plugin_min_batch_size is set, results of a running hunt are
+    collected until there are that many of them or the oldest one has waited for
+    Hunt.output_plugin_max_batch_delay, otherwise hunts that produce results
+    slowly would pass many tiny batches to their output plugins. Results of
+    hunts that are paused or stopped are processed right away.
+
+    Args:
+      hunt_urn: Urn of the hunt the results belong to.
+      results: The claimed result notifications of the hunt.
+    """
+    if len(results) >= config.CONFIG["Hunt.output_plugin_min_batch_size"]:
+      return False
+
+    oldest = min(r.value.timestamp for r in results)
+    max_delay = config.CONFIG["Hunt.output_plugin_max_batch_delay"]
+    if oldest + max_delay <= rdfvalue.RDFDatetime.Now():
+      return False
+
+    try:
+      hunt = aff4.FACTORY.Open(
+          hunt_urn, aff4_type=implementation.GRRHunt, token=self.token)
+    except aff4.InstantiationError:
+      return False
+
+    return hunt.Get(hunt.Schema.STATE) == "STARTED"
 
   def ProcessOneHunt(self, exceptions_by_hunt):
     """Reads results for one hunt and process them."""
-    hunt_results_urn, results = (
-        hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
-            start_time=self.args.start_processing_time,
-            token=self.token,
-            lease_time=self.lifetime))
+    with self._claim_lock:
+      hunt_results_urn, results = (
+          hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
+              start_time=self.args.start_processing_time,
+              token=self.token,
+              lease_time=self.lifetime,
+              exclude_collections=(
+                  self._hunts_in_progress | self._deferred_hunts)))
+      if results:
+        self._hunts_in_progress.add(hunt_results_urn)
+
     logging.debug("Found %d results for hunt %s", len(results),
                   hunt_results_urn)
     if not results:
       return 0
 
+    hunt_urn = rdfvalue.RDFURN(hunt_results_urn.Dirname())
+    if self._ShouldDeferResults(hunt_urn, results):
+      logging.debug("Leaving %d results of hunt %s for a later run.",
+                    len(results), hunt_urn)
+      hunts_results.HuntResultQueue.ReleaseNotifications(
+          results, token=self.token)
+      with self._claim_lock:
+        self._hunts_in_progress.discard(hunt_results_urn)
+        # Released notifications could be claimed again right away.
+        self._deferred_hunts.add(hunt_results_urn)
+      stats.STATS.IncrementCounter("hunt_results_deferred", delta=len(results))
+      return len(results)
+
+    try:
+      return self._ProcessHuntResults(hunt_results_urn, results,
+                                      exceptions_by_hunt)
+    finally:
+      with self._claim_lock:
+        self._hunts_in_progress.discard(hunt_results_urn)
+
+  def _ProcessHuntResults(self, hunt_results_urn, results, exceptions_by_hunt):
+    """Runs the output plugins of a hunt over claimed notifications."""
     hunt_urn = rdfvalue.RDFURN(hunt_results_urn.Dirname())
     batch_size = self.args.batch_size or self.DEFAULT_BATCH_SIZE
     metadata_urn = hunt_urn.Add("ResultsMetadata")
-    exceptions_by_plugin = {}
-    num_processed_for_hunt = 0
     collection_obj = implementation.GRRHunt.ResultCollectionForHID(hunt_urn)
+    batches = list(utils.Grouper(results, batch_size))
+
+    def Resolve(index):
+      return list(
+          collection_obj.MultiResolve(
+              [r.value.ResultRecord() for r in batches[index]]))
+
     try:
       with aff4.FACTORY.OpenWithLock(
           metadata_urn, lease_time=600, token=self.token) as metadata_obj:
         all_plugins, used_plugins = self.LoadPlugins(metadata_obj)
-        num_processed = int(
-            metadata_obj.Get(metadata_obj.Schema.NUM_PROCESSED_RESULTS))
-        for batch in utils.Grouper(results, batch_size):
-          results = list(
-              collection_obj.MultiResolve(
-                  [r.value.ResultRecord() for r in batch]))
-          self.RunPlugins(hunt_urn, used_plugins, results, exceptions_by_plugin)
-
-          hunts_results.HuntResultQueue.DeleteNotifications(
-              batch, token=self.token)
-          num_processed += len(batch)
-          num_processed_for_hunt += len(batch)
-          self.HeartBeat()
-          metadata_obj.Set(
-              metadata_obj.Schema.NUM_PROCESSED_RESULTS(num_processed))
-          metadata_obj.UpdateLease(600)
-          if self.CheckIfRunningTooLong():
-            logging.warning("Run too long, stopping.")
-            break
+        consumers = [
+            _PluginConsumer(hunt_urn, plugin_def, plugin)
+            for plugin_def, plugin in used_plugins
+        ]
+        num_processed_for_hunt = self._RunConsumers(consumers, batches,
+                                                    metadata_obj, Resolve)
 
         metadata_obj.Set(metadata_obj.Schema.OUTPUT_PLUGINS(all_plugins))
-        metadata_obj.Set(
-            metadata_obj.Schema.NUM_PROCESSED_RESULTS(num_processed))
     except aff4.LockError:
       logging.warn("ProcessHuntResultCollectionsCronFlow: "
                    "Could not get lock on hunt metadata %s.", metadata_urn)
       return 0
 
-    if exceptions_by_plugin:
-      for plugin, exceptions in exceptions_by_plugin.items():
-        exceptions_by_hunt.setdefault(hunt_urn, {}).setdefault(
-            plugin, []).extend(exceptions)
+    with self._claim_lock:
+      for consumer in consumers:
+        if consumer.exceptions:
+          exceptions_by_hunt.setdefault(hunt_urn, {}).setdefault(
+              consumer.plugin_def, []).extend(consumer.exceptions)
 
     logging.debug("Processed %d results.", num_processed_for_hunt)
     return len(results)
 
+  def _ProcessHunts(self, exceptions_by_hunt):
+    """Processes hunts until there are no results left or time is up."""
+    try:
+      while not self.CheckIfRunningTooLong():
+        count = self.ProcessOneHunt(exceptions_by_hunt)
+        if not count:
+          break
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error processing hunt results: %s", e)
+      # Reraised by Start() on the flow's thread.
+      self._thread_errors.append(e)
+
   @flow.StateHandler()
   def Start(self):
     self.start_time = rdfvalue.RDFDatetime.Now()
@@ -192,15 +418,47 @@ class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
       self.args.max_running_time = rdfvalue.Duration("%ds" % int(
           ProcessHuntResultCollectionsCronFlow.lifetime.seconds * 0.6))
 
-    while not self.CheckIfRunningTooLong():
-      count = self.ProcessOneHunt(exceptions_by_hunt)
-      if not count:
-        break
+    # Guards the consumers of all hunts and the plugin type capacity.
+    self._condition = threading.Condition()
+    self._running_batches = {}
+    self._completed_batches = 0
+    # Guards claiming notifications, the set of hunts being processed and
+    # exceptions_by_hunt.
+    self._claim_lock = threading.Lock()
+    self._hunts_in_progress = set()
+    # Hunts whose results are left for a later run.
+    self._deferred_hunts = set()
+    self._thread_errors = []
+    self._pool = threadpool.ThreadPool.Factory(
+        "hunt_results_processing",
+        min_threads=1,
+        max_threads=config.CONFIG["Hunt.results_processing_threads"])
+    self._pool.Start()
+
+    threads = []
+    for i in xrange(config.CONFIG["Hunt.results_processing_concurrent_hunts"]):
+      thread = threading.Thread(
+          target=self._ProcessHunts,
+          args=(exceptions_by_hunt,),
+          name="ProcessHuntResults%d" % i)
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+
+    for thread in threads:
+      while thread.is_alive():
+        thread.join(10)
+        self.HeartBeat()
+
+    if self._thread_errors:
+      raise self._thread_errors[0]
 
     if exceptions_by_hunt:
       e = ResultsProcessingError()
       for hunt_urn, exceptions_by_plugin in exceptions_by_hunt.items():
         for plugin, exceptions in exceptions_by_plugin.items():
           for exception in exceptions:
+            self.Log("Error processing hunt results (hunt %s, plugin %s): %s" %
+                     (hunt_urn, plugin.plugin_name, exception))
             e.RegisterSubException(hunt_urn, plugin, exception)
       raise e
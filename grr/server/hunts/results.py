@@ -2,13 +2,18 @@
 """Classes to store and manage hunt results.
 """
 
+import hashlib
+import logging
+
 from grr.lib import rdfvalue
 from grr.lib import registry
+from grr.lib import utils
 from grr.lib.rdfvalues import structs as rdf_structs
 from grr_response_proto import jobs_pb2
 from grr.server import access_control
 from grr.server import aff4
 from grr.server import data_store
+from grr.server import multi_type_collection
 from grr.server import sequential_collection
 from grr.server.aff4_objects import aff4_queue
 
@@ -30,6 +35,10 @@ class HuntResultNotification(rdf_structs.RDFProtoStruct):
         value=None)
 
 
+class HuntResultPayloadReference(rdf_structs.RDFProtoStruct):
+  protobuf = jobs_pb2.HuntResultPayloadReference
+
+
 RESULT_NOTIFICATION_QUEUE = rdfvalue.RDFURN("aff4:/hunt_results_queue")
 
 
@@ -42,7 +51,8 @@ class HuntResultQueue(aff4_queue.Queue):
                                       token=None,
                                       start_time=None,
                                       lease_time=200,
-                                      collection=None):
+                                      collection=None,
+                                      exclude_collections=None):
     """Return unclaimed hunt result notifications for collection.
 
     Args:
@@ -57,6 +67,9 @@ class HuntResultQueue(aff4_queue.Queue):
       collection: The urn of the collection to find notifications for. If unset,
         the earliest (unclaimed) notification will determine the collection.
 
+      exclude_collections: If set, a collection of urns of collections that
+        must not be chosen when collection is unset.
+
     Returns:
       A pair (collection, results) where collection is the collection
       that notifications were retrieved for and results is a list of
@@ -66,15 +79,17 @@ class HuntResultQueue(aff4_queue.Queue):
 
     class CollectionFilter(object):
 
-      def __init__(self, collection):
+      def __init__(self, collection, exclude_collections):
         self.collection = collection
+        self.exclude_collections = exclude_collections or ()
 
       def FilterRecord(self, notification):
-        if self.collection is None:
+        if (self.collection is None and notification.result_collection_urn
+            not in self.exclude_collections):
           self.collection = notification.result_collection_urn
         return self.collection != notification.result_collection_urn
 
-    f = CollectionFilter(collection)
+    f = CollectionFilter(collection, exclude_collections)
     results = []
     with aff4.FACTORY.OpenWithLock(
         RESULT_NOTIFICATION_QUEUE,
@@ -97,9 +112,154 @@ class HuntResultQueue(aff4_queue.Queue):
     """Delete hunt notifications."""
     cls.DeleteRecords(records, token=token)
 
+  @classmethod
+  def ReleaseNotifications(cls, records, token=None):
+    """Release claimed hunt notifications so that they can be claimed again."""
+    cls.ReleaseRecords(records, token=token)
+
+
+class PayloadResolvingCollectionMixin(object):
+  """Resolves HuntResultPayloadReferences when results are read.
+
+  Scan() returns the stored messages as they are, so index updates and length
+  calculations do not read payloads. The other read methods return the
+  original payloads.
+  """
+
+  # How many results to look up payloads for at once.
+  RESOLVE_BATCH_SIZE = 100
+
+  @classmethod
+  def _ResolvePayloads(cls, messages):
+    """Replaces payload references in messages with the payloads."""
+    references = {}
+    for msg in messages:
+      if msg.args_rdf_name == HuntResultPayloadReference.__name__:
+        references[id(msg)] = msg.payload
+
+    if not references:
+      return
+
+    payloads = data_store.DB.ReadBlobs(
+        set(ref.digest for ref in references.itervalues()))
+
+    for msg in messages:
+      ref = references.get(id(msg))
+      if ref is None:
+        continue
+
+      payload = payloads.get(ref.digest)
+      if payload is None:
+        logging.warning("Payload %s of a result in %s is missing.", ref.digest,
+                        msg.source)
+        continue
+
+      msg.Set("args", payload)
+      msg.args_rdf_name = ref.payload_type
+
+  def _ResolveInBatches(self, messages):
+    for batch in utils.Grouper(messages, self.RESOLVE_BATCH_SIZE):
+      self._ResolvePayloads(batch)
+      for msg in batch:
+        yield msg
+
+  def ScanResolved(self, **kwargs):
+    """Like Scan() but yields messages with their original payloads."""
+    items = self.Scan(**kwargs)
+    for batch in utils.Grouper(items, self.RESOLVE_BATCH_SIZE):
+      self._ResolvePayloads([msg for _, msg in batch])
+      for item in batch:
+        yield item
+
+  def GenerateItems(self, offset=0):
+    items = super(PayloadResolvingCollectionMixin, self).GenerateItems(
+        offset=offset)
+    return self._ResolveInBatches(items)
+
+  def __getitem__(self, index):
+    msg = super(PayloadResolvingCollectionMixin, self).__getitem__(index)
+    self._ResolvePayloads([msg])
+    return msg
+
+  def __iter__(self):
+    return self._ResolveInBatches(
+        super(PayloadResolvingCollectionMixin, self).__iter__())
+
+  def MultiResolve(self, records):
+    return self._ResolveInBatches(
+        super(PayloadResolvingCollectionMixin, self).MultiResolve(records))
+
+
+class HuntResultCollection(PayloadResolvingCollectionMixin,
+                           sequential_collection.GrrMessageCollection):
+  """Sequential HuntResultCollection.
 
-class HuntResultCollection(sequential_collection.GrrMessageCollection):
-  """Sequential HuntResultCollection."""
+  Results may have their payload replaced by a HuntResultPayloadReference (see
+  DeduplicatePayloads). Readers of the collection always get the original
+  payloads.
+  """
+
+  @classmethod
+  def DeduplicatePayloads(cls, messages, token=None):
+    """Moves the payloads of messages to the blob store.
+
+    Every distinct payload is stored only once, the returned messages refer to
+    it by its digest.
+
+    Args:
+      messages: A list of GrrMessages.
+      token: Data store token.
+
+    Returns:
+      A tuple (messages, deduplicated_count, deduplicated_bytes). messages are
+      the GrrMessages to add to the collection instead of the given ones,
+      deduplicated_count and deduplicated_bytes are the number and the total
+      size of the payloads that did not have to be stored.
+    """
+    payloads = {}
+    digests = []
+    for msg in messages:
+      if msg.args_rdf_name:
+        payload = msg.Get("args") or ""
+        digest = hashlib.sha256(payload).hexdigest()
+        payloads[digest] = payload
+      else:
+        digest = None
+      digests.append(digest)
+
+    if not payloads:
+      return list(messages), 0, 0
+
+    existing = data_store.DB.BlobsExist(payloads.keys(), token=token)
+    new_payloads = {
+        digest: payload
+        for digest, payload in payloads.iteritems()
+        if not existing[digest]
+    }
+    if new_payloads:
+      data_store.DB.StoreHashedBlobs(new_payloads, token=token)
+
+    result = []
+    deduplicated_count = 0
+    deduplicated_bytes = 0
+    for msg, digest in zip(messages, digests):
+      if digest is None:
+        result.append(msg)
+        continue
+
+      # The first message with a new payload is the one that got it stored.
+      if digest in new_payloads:
+        del new_payloads[digest]
+      else:
+        deduplicated_count += 1
+        deduplicated_bytes += len(payloads[digest])
+
+      stub = msg.Copy()
+      stub.payload = HuntResultPayloadReference(
+          digest=digest, payload_type=msg.args_rdf_name)
+      result.append(stub)
+
+    return result, deduplicated_count, deduplicated_bytes
 
   @classmethod
   def StaticAdd(cls,
@@ -125,6 +285,38 @@ class HuntResultCollection(sequential_collection.GrrMessageCollection):
     return ts
 
 
+class HuntResultsOfTypeCollection(PayloadResolvingCollectionMixin,
+                                  sequential_collection.GrrMessageCollection):
+  """The results of one type in a HuntResultMultiTypeCollection."""
+
+
+class HuntResultMultiTypeCollection(multi_type_collection.MultiTypeCollection):
+  """Hunt results by type.
+
+  Results with deduplicated payloads are stored under their original type.
+  """
+
+  SUBCOLLECTION_CLS = HuntResultsOfTypeCollection
+
+  @classmethod
+  def _ValueType(cls, message):
+    if message.args_rdf_name == HuntResultPayloadReference.__name__:
+      return message.payload.payload_type
+
+    return super(HuntResultMultiTypeCollection, cls)._ValueType(message)
+
+  def ScanByType(self,
+                 type_name,
+                 after_timestamp=None,
+                 include_suffix=False,
+                 max_records=None):
+    sub_collection = self.SUBCOLLECTION_CLS(self.collection_id.Add(type_name))
+    return sub_collection.ScanResolved(
+        after_timestamp=after_timestamp,
+        include_suffix=include_suffix,
+        max_records=max_records)
+
+
 class ResultQueueInitHook(registry.InitHook):
   pre = [aff4.AFF4InitHook]
 
@@ -4,8 +4,11 @@
 
 from grr.lib import flags
 from grr.lib import rdfvalue
+from grr.lib import utils
+from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.server import data_store
+from grr.server import sequential_collection
 from grr.server.hunts import results as hunts_results
 from grr.test_lib import aff4_test_lib
 from grr.test_lib import test_lib
@@ -75,6 +78,115 @@ class ResultTest(aff4_test_lib.AFF4ObjectTest):
           token=self.token)
     self.assertEqual(results_3, results_1)
 
+  def _DeduplicatedResults(self):
+    messages = [
+        rdf_flows.GrrMessage(
+            source="C.%016d" % i,
+            payload=rdf_client.User(username="user%d" % (i % 2)))
+        for i in range(10)
+    ]
+    return hunts_results.HuntResultCollection.DeduplicatePayloads(
+        messages, token=self.token)
+
+  def testDeduplicatePayloadsStoresEveryPayloadOnce(self):
+    messages, deduplicated_count, deduplicated_bytes = (
+        self._DeduplicatedResults())
+
+    self.assertEqual(len(messages), 10)
+    for message in messages:
+      self.assertIsInstance(message.payload,
+                            hunts_results.HuntResultPayloadReference)
+    self.assertEqual(len(set(m.payload.digest for m in messages)), 2)
+
+    self.assertEqual(deduplicated_count, 8)
+    self.assertEqual(
+        deduplicated_bytes,
+        8 * len(rdf_client.User(username="user0").SerializeToString()))
+
+    # Payloads stored before are not stored again.
+    _, deduplicated_count, _ = self._DeduplicatedResults()
+    self.assertEqual(deduplicated_count, 10)
+
+  def testReadersGetDeduplicatedPayloads(self):
+    collection_urn = rdfvalue.RDFURN(
+        "aff4:/testReadersGetDeduplicatedPayloads/collection")
+    messages, _, _ = self._DeduplicatedResults()
+    with data_store.DB.GetMutationPool() as pool:
+      for message in messages:
+        hunts_results.HuntResultCollection.StaticAdd(
+            collection_urn, message, mutation_pool=pool)
+
+    collection = hunts_results.HuntResultCollection(collection_urn)
+    expected = sorted(
+        (u"C.%016d" % i, u"user%d" % (i % 2)) for i in range(10))
+
+    self.assertEqual(
+        sorted((m.source.Basename(), m.payload.username) for m in collection),
+        expected)
+    self.assertEqual(collection[3].payload.__class__, rdf_client.User)
+    self.assertEqual(
+        sorted((m.source.Basename(), m.payload.username)
+               for m in collection.GenerateItems()), expected)
+    self.assertEqual(
+        sorted((m.source.Basename(), m.payload.username)
+               for _, m in collection.ScanResolved()), expected)
+
+    results = hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
+        token=self.token)
+    resolved = collection.MultiResolve(
+        [r.value.ResultRecord() for r in results[1]])
+    self.assertEqual(
+        sorted((m.source.Basename(), m.payload.username) for m in resolved),
+        expected)
+
+  def testMultiTypeCollectionStoresReferencesUnderPayloadType(self):
+    collection_urn = rdfvalue.RDFURN(
+        "aff4:/testMultiTypeCollectionStoresReferences/collection")
+    messages, _, _ = self._DeduplicatedResults()
+    with data_store.DB.GetMutationPool() as pool:
+      for message in messages:
+        hunts_results.HuntResultMultiTypeCollection.StaticAdd(
+            collection_urn, message, mutation_pool=pool)
+
+    collection = hunts_results.HuntResultMultiTypeCollection(collection_urn)
+    self.assertEqual(list(collection.ListStoredTypes()), ["User"])
+    self.assertEqual(collection.LengthByType("User"), 10)
+
+    # The per-type collection only holds references to the payloads.
+    for _, message in sequential_collection.GrrMessageCollection(
+        collection_urn.Add("User")).Scan():
+      self.assertIsInstance(message.payload,
+                            hunts_results.HuntResultPayloadReference)
+
+    expected = sorted(
+        (u"C.%016d" % i, u"user%d" % (i % 2)) for i in range(10))
+    self.assertEqual(
+        sorted((m.source.Basename(), m.payload.username)
+               for _, m in collection.ScanByType("User")), expected)
+    self.assertEqual(
+        sorted((m.source.Basename(), m.payload.username) for m in collection),
+        expected)
+
+  def testScanDoesNotReadPayloads(self):
+    collection_urn = rdfvalue.RDFURN(
+        "aff4:/testScanDoesNotReadPayloads/collection")
+    messages, _, _ = self._DeduplicatedResults()
+    with data_store.DB.GetMutationPool() as pool:
+      for message in messages:
+        hunts_results.HuntResultCollection.StaticAdd(
+            collection_urn, message, mutation_pool=pool)
+
+    collection = hunts_results.HuntResultCollection(collection_urn)
+
+    def ReadBlobs(*unused_args, **unused_kwargs):
+      raise AssertionError("Payloads must not be read.")
+
+    with utils.Stubber(data_store.DB, "ReadBlobs", ReadBlobs):
+      for _, message in collection.Scan():
+        self.assertIsInstance(message.payload,
+                              hunts_results.HuntResultPayloadReference)
+      self.assertEqual(len(collection), 10)
+
   def testDelete(self):
     collection_urn = rdfvalue.RDFURN("aff4:/testDelete/collection")
     with data_store.DB.GetMutationPool() as pool:
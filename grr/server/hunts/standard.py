@@ -539,5 +539,10 @@ class StandardHuntInitHook(registry.InitHook):
         "hunt_output_plugin_errors", fields=[("plugin", str)])
     stats.STATS.RegisterCounterMetric(
         "hunt_results_ran_through_plugin", fields=[("plugin", str)])
+    stats.STATS.RegisterCounterMetric(
+        "hunt_output_plugin_retries", fields=[("plugin", str)])
+    stats.STATS.RegisterEventMetric(
+        "hunt_output_plugin_lag", fields=[("plugin", str)])
+    stats.STATS.RegisterCounterMetric("hunt_results_deferred")
     stats.STATS.RegisterCounterMetric("hunt_results_compacted")
     stats.STATS.RegisterCounterMetric("hunt_results_compaction_locking_errors")
@@ -17,6 +17,7 @@ from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import file_finder as rdf_file_finder
 from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import hunts as rdf_hunts
 from grr.lib.rdfvalues import paths as rdf_paths
 from grr.server import access_control
 from grr.server import aff4
@@ -408,6 +409,94 @@ class StandardHuntTest(flow_test_lib.FlowTestsBaseclass, StandardHuntTestMixin):
       self.assertEqual(hunt_obj.context.clients_with_results_count, 5)
       self.assertEqual(hunt_obj.context.results_count, 5)
 
+  def testHuntResultsAreTheSameForAnyNumberOfRequestShards(self):
+    for num_shards in [1, 3, 16]:
+      with test_lib.ConfigOverrider({
+          "Hunt.request_processing_shards": num_shards
+      }):
+        hunt_urn = self.StartHunt()
+        self.AssignTasksToClients()
+        self.RunHunt()
+        self.StopHunt(hunt_urn)
+
+      with aff4.FACTORY.Open(hunt_urn, token=self.token) as hunt_obj:
+        started, finished, errors = hunt_obj.GetClientsCounts()
+        self.assertEqual(started, 10)
+        self.assertEqual(finished, 10)
+        self.assertEqual(errors, 5)
+
+        collection = implementation.GRRHunt.ResultCollectionForHID(hunt_urn)
+        self.assertEqual(len(list(collection)), 5)
+
+  def testClientCompletionStatsMatchClientsCollections(self):
+    hunt_urn = self.StartHunt()
+    self.AssignTasksToClients()
+    self.RunHunt()
+    self.StopHunt(hunt_urn)
+
+    with aff4.FACTORY.Open(hunt_urn, mode="r", token=self.token) as hunt_obj:
+      completion_stats = hunt_obj.completion_stats
+      self.assertEqual(completion_stats.started_clients_count,
+                       len(hunt_obj.GetClients()))
+      self.assertEqual(completion_stats.completed_clients_count,
+                       len(hunt_obj.GetCompletedClients()))
+      self.assertEqual(completion_stats.clients_errors_count,
+                       len(list(hunt_obj.GetClientsErrors())))
+      self.assertEqual(
+          sum(b.started_clients for b in completion_stats.buckets),
+          completion_stats.started_clients_count)
+      self.assertEqual(
+          sum(b.completed_clients for b in completion_stats.buckets),
+          completion_stats.completed_clients_count)
+
+  def testClientCompletionStatsKeepNumberOfBucketsBounded(self):
+    completion_stats = rdf_hunts.HuntClientCompletionStats()
+    num_clients = 3 * completion_stats.MAX_BUCKETS
+    for i in range(num_clients):
+      completion_stats.RegisterStartedClient(
+          rdfvalue.RDFDatetime.FromSecondsFromEpoch(i))
+
+    self.assertLessEqual(
+        len(completion_stats.buckets), completion_stats.MAX_BUCKETS)
+    self.assertEqual(completion_stats.bucket_size, 4)
+    self.assertEqual(completion_stats.started_clients_count, num_clients)
+    self.assertEqual(
+        sum(b.started_clients for b in completion_stats.buckets), num_clients)
+
+  def testResultCountsMatchResultCollections(self):
+    hunt_urn = self.StartHunt()
+    self.AssignTasksToClients()
+    self.RunHunt()
+    self.StopHunt(hunt_urn)
+
+    with aff4.FACTORY.Open(hunt_urn, mode="r", token=self.token) as hunt_obj:
+      self.assertTrue(hunt_obj.context.result_counts_reconciled_at)
+      self.assertEqual(hunt_obj.GetResultsCount(),
+                       len(hunt_obj.ResultCollection()))
+
+      collection = hunt_obj.TypedResultCollection()
+      self.assertEqual(
+          hunt_obj.GetResultTypeCounts(),
+          dict((type_name, collection.LengthByType(type_name))
+               for type_name in collection.ListStoredTypes()))
+
+  def testReconcileResultCountsCorrectsCounts(self):
+    hunt_urn = self.StartHunt()
+    self.AssignTasksToClients()
+    self.RunHunt()
+    self.StopHunt(hunt_urn)
+
+    with aff4.FACTORY.Open(hunt_urn, mode="rw", token=self.token) as hunt_obj:
+      results_count = hunt_obj.GetResultsCount()
+      type_counts = hunt_obj.GetResultTypeCounts()
+
+      hunt_obj.context.results_count += 5
+      hunt_obj.context.result_type_counts = []
+      hunt_obj.ReconcileResultCounts()
+
+      self.assertEqual(hunt_obj.GetResultsCount(), results_count)
+      self.assertEqual(hunt_obj.GetResultTypeCounts(), type_counts)
+
   def testHuntWithoutForemanRules(self):
     """Check no foreman rules are created if we pass add_foreman_rules=False."""
     hunt_urn = self.StartHunt(add_foreman_rules=False)
@@ -708,6 +797,82 @@ class StandardHuntTest(flow_test_lib.FlowTestsBaseclass, StandardHuntTestMixin):
     # Check that call count hasn't changed.
     self.assertEqual(process_responses_mock.call_count, 1)
 
+  def testFailedOutputPluginBatchIsRetried(self):
+    self.StartHunt(output_plugins=[
+        output_plugin.OutputPluginDescriptor(
+            plugin_name="DummyHuntOutputPlugin")
+    ])
+
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+
+    calls = []
+
+    def ProcessResponsesStub(_, responses):
+      calls.append(len(responses))
+      if len(calls) == 1:
+        raise RuntimeError("Oh no!")
+
+    prev_retries = stats.STATS.GetMetricValue(
+        "hunt_output_plugin_retries", fields=["DummyHuntOutputPlugin"])
+
+    with test_lib.ConfigOverrider({
+        "Hunt.output_plugin_retries": 1,
+        "Hunt.output_plugin_retry_delay": rdfvalue.Duration("0s")
+    }):
+      with utils.Stubber(DummyHuntOutputPlugin, "ProcessResponses",
+                         ProcessResponsesStub):
+        self.ProcessHuntOutputPlugins()
+
+    self.assertEqual(calls, [10, 10])
+    self.assertEqual(
+        stats.STATS.GetMetricValue(
+            "hunt_output_plugin_retries", fields=["DummyHuntOutputPlugin"]) -
+        prev_retries, 1)
+
+  def testAllOutputPluginsSeeAllResultsInSmallBatches(self):
+    self.StartHunt(output_plugins=[
+        output_plugin.OutputPluginDescriptor(
+            plugin_name="DummyHuntOutputPlugin"),
+        output_plugin.OutputPluginDescriptor(
+            plugin_name="StatefulDummyHuntOutputPlugin")
+    ])
+
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+    self.ProcessHuntOutputPlugins(batch_size=1)
+
+    self.assertEqual(DummyHuntOutputPlugin.num_calls, 10)
+    self.assertEqual(DummyHuntOutputPlugin.num_responses, 10)
+    self.assertListEqual(StatefulDummyHuntOutputPlugin.data, range(10))
+
+    # Everything was committed, nothing is processed again.
+    self.ProcessHuntOutputPlugins(batch_size=1)
+    self.assertEqual(DummyHuntOutputPlugin.num_calls, 10)
+
+  def testResultsOfRunningHuntAreProcessedInFullBatches(self):
+    hunt_urn = self.StartHunt(output_plugins=[
+        output_plugin.OutputPluginDescriptor(
+            plugin_name="DummyHuntOutputPlugin")
+    ])
+
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+
+    with test_lib.ConfigOverrider({
+        "Hunt.output_plugin_min_batch_size": 20,
+        "Hunt.output_plugin_max_batch_delay": rdfvalue.Duration("1h")
+    }):
+      # 10 results are not enough for a batch while the hunt is running.
+      self.ProcessHuntOutputPlugins()
+      self.assertEqual(DummyHuntOutputPlugin.num_calls, 0)
+
+      # Stopping the hunt flushes the results that were left.
+      self.StopHunt(hunt_urn)
+      self.ProcessHuntOutputPlugins()
+      self.assertEqual(DummyHuntOutputPlugin.num_calls, 1)
+      self.assertEqual(DummyHuntOutputPlugin.num_responses, 10)
+
   def testUpdatesStatsCounterOnSuccess(self):
     failing_plugin_descriptor = output_plugin.OutputPluginDescriptor(
         plugin_name="DummyHuntOutputPlugin")
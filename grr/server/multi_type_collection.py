@@ -12,6 +12,9 @@ from grr.server import sequential_collection
 class MultiTypeCollection(object):
   """A collection that stores multiple types of data in per-type sequences."""
 
+  # The collection class of the per-type sequences.
+  SUBCOLLECTION_CLS = sequential_collection.GrrMessageCollection
+
   def __init__(self, collection_id):
     super(MultiTypeCollection, self).__init__()
     # The collection_id for this collection is a RDFURN for now.
@@ -59,24 +62,80 @@ class MultiTypeCollection(object):
     if mutation_pool is None:
       raise ValueError("Mutation pool can't be none.")
 
+    value_type = cls._AddToSubcollection(
+        collection_urn,
+        rdf_value,
+        timestamp=timestamp,
+        suffix=suffix,
+        mutation_pool=mutation_pool)
+
+    mutation_pool.CollectionAddStoredTypeIndex(collection_urn, value_type)
+
+  @classmethod
+  def StaticAddMultiple(cls, collection_urn, rdf_values, mutation_pool=None):
+    """Adds a batch of rdf values to a collection.
+
+    This is equivalent to calling StaticAdd() for every value but writes the
+    stored type index only once per distinct type in the batch.
+
+    Args:
+      collection_urn: The urn of the collection to add to.
+
+      rdf_values: An iterable of rdf values to add to the collection. Values
+          that are not GrrMessages will be wrapped into GrrMessages.
+
+      mutation_pool: A MutationPool object to write to.
+
+    Raises:
+      ValueError: one of the rdf_values is None.
+
+    """
+    if mutation_pool is None:
+      raise ValueError("Mutation pool can't be none.")
+
+    stored_types = set()
+    for rdf_value in rdf_values:
+      if rdf_value is None:
+        raise ValueError("Can't add None to MultiTypeCollection")
+
+      stored_types.add(
+          cls._AddToSubcollection(
+              collection_urn, rdf_value, mutation_pool=mutation_pool))
+
+    for value_type in stored_types:
+      mutation_pool.CollectionAddStoredTypeIndex(collection_urn, value_type)
+
+  @classmethod
+  def _AddToSubcollection(cls,
+                          collection_urn,
+                          rdf_value,
+                          timestamp=None,
+                          suffix=None,
+                          mutation_pool=None):
+    """Adds a value to its per-type subcollection and returns the type."""
     if not isinstance(rdf_value, rdf_flows.GrrMessage):
       rdf_value = rdf_flows.GrrMessage(payload=rdf_value)
 
-    value_type = rdf_value.args_rdf_name or rdf_flows.GrrMessage.__name__
+    value_type = cls._ValueType(rdf_value)
 
     # In order to make this fast, we never actually generate the
     # subcollections, we just use them. This means that we cannot use
     # ListChildren to get all the items stored in this
     # MultiTypeCollection.
     subpath = collection_urn.Add(value_type)
-    sequential_collection.GrrMessageCollection.StaticAdd(
+    cls.SUBCOLLECTION_CLS.StaticAdd(
         subpath,
         rdf_value,
         timestamp=timestamp,
         suffix=suffix,
         mutation_pool=mutation_pool)
 
-    mutation_pool.CollectionAddStoredTypeIndex(collection_urn, value_type)
+    return value_type
+
+  @classmethod
+  def _ValueType(cls, message):
+    """Returns the name of the type the message is stored under."""
+    return message.args_rdf_name or rdf_flows.GrrMessage.__name__
 
   def ListStoredTypes(self):
     for t in data_store.DB.CollectionReadStoredTypes(self.collection_id):
@@ -109,8 +168,7 @@ class MultiTypeCollection(object):
 
     """
     sub_collection_urn = self.collection_id.Add(type_name)
-    sub_collection = sequential_collection.GrrMessageCollection(
-        sub_collection_urn)
+    sub_collection = self.SUBCOLLECTION_CLS(sub_collection_urn)
     for item in sub_collection.Scan(
         after_timestamp=after_timestamp,
         include_suffix=include_suffix,
@@ -119,8 +177,7 @@ class MultiTypeCollection(object):
 
   def LengthByType(self, type_name):
     sub_collection_urn = self.collection_id.Add(type_name)
-    sub_collection = sequential_collection.GrrMessageCollection(
-        sub_collection_urn)
+    sub_collection = self.SUBCOLLECTION_CLS(sub_collection_urn)
     return len(sub_collection)
 
   def Add(self, rdf_value, timestamp=None, suffix=None, mutation_pool=None):
@@ -164,8 +221,7 @@ class MultiTypeCollection(object):
         for stored_type in self.ListStoredTypes()
     ]
     for sub_collection_urn in sub_collection_urns:
-      sub_collection = sequential_collection.GrrMessageCollection(
-          sub_collection_urn)
+      sub_collection = self.SUBCOLLECTION_CLS(sub_collection_urn)
       for item in sub_collection:
         yield item
 
@@ -176,8 +232,7 @@ class MultiTypeCollection(object):
         for stored_type in self.ListStoredTypes()
     ]
     for sub_collection_urn in sub_collection_urns:
-      sub_collection = sequential_collection.GrrMessageCollection(
-          sub_collection_urn)
+      sub_collection = self.SUBCOLLECTION_CLS(sub_collection_urn)
       l += len(sub_collection)
 
     return l
@@ -130,6 +130,32 @@ class MultiTypeCollectionTest(aff4_test_lib.AFF4ObjectTest):
     self.assertEqual(101,
                      self.collection.LengthByType(rdfvalue.RDFString.__name__))
 
+  def testStaticAddMultipleAddsValuesOfMultipleTypes(self):
+    values = [rdfvalue.RDFInteger(i) for i in range(10)]
+    values += [rdfvalue.RDFString(i) for i in range(5)]
+    with self.pool:
+      multi_type_collection.MultiTypeCollection.StaticAddMultiple(
+          self.collection.collection_id, values, mutation_pool=self.pool)
+
+    self.assertEqual(
+        set(self.collection.ListStoredTypes()),
+        set([rdfvalue.RDFInteger.__name__, rdfvalue.RDFString.__name__]))
+    self.assertEqual(10,
+                     self.collection.LengthByType(rdfvalue.RDFInteger.__name__))
+    self.assertEqual(5,
+                     self.collection.LengthByType(rdfvalue.RDFString.__name__))
+
+  def testStaticAddMultipleWritesStoredTypeIndexOncePerType(self):
+    values = [rdfvalue.RDFInteger(i) for i in range(10)]
+    with self.pool:
+      multi_type_collection.MultiTypeCollection.StaticAddMultiple(
+          self.collection.collection_id, values, mutation_pool=self.pool)
+      type_index_writes = [
+          r for r in self.pool.set_requests
+          if r[0] == self.collection.collection_id
+      ]
+      self.assertEqual(len(type_index_writes), 1)
+
   def testDeletingCollectionDeletesAllSubcollections(self):
     if not isinstance(data_store.DB, fake_data_store.FakeDataStore):
       self.skipTest("Only supported on FakeDataStore.")
@@ -4,6 +4,7 @@
 import collections
 import logging
 import random
+import threading
 
 from grr import config
 from grr.lib import rdfvalue
@@ -51,6 +52,120 @@ def _GetClientIdFromQueue(q):
   return str_client_id
 
 
+class PendingMutations(object):
+  """Data store mutations collected by a QueueManager and not written yet."""
+
+  def __init__(self,
+               requests=None,
+               responses=None,
+               requests_to_delete=None,
+               client_messages_to_delete=None,
+               new_client_messages=None,
+               notifications=None,
+               notifications_first_queued=None):
+    self.requests = requests or []
+    self.responses = responses or []
+    self.requests_to_delete = requests_to_delete or []
+    self.client_messages_to_delete = client_messages_to_delete or {}
+    self.new_client_messages = new_client_messages or []
+    self.notifications = notifications or {}
+    # When the notifications that were not queued before are first queued.
+    self.notifications_first_queued = notifications_first_queued
+
+    # Set by the FlushCoordinator once the mutations were written.
+    self.written = False
+    self.error = None
+
+  def __len__(self):
+    return (len(self.requests) + len(self.responses) +
+            len(self.requests_to_delete) + len(self.new_client_messages) +
+            len(self.notifications) +
+            sum(len(x) for x in self.client_messages_to_delete.itervalues()))
+
+
+class FlushCoordinator(object):
+  """Groups flushes of many queue managers into combined data store writes.
+
+  A worker processes many flows concurrently and each of them flushes its own
+  queue manager. Queue managers that have a flush coordinator set hand their
+  pending mutations over to it instead. The first flushing thread writes
+  everything collected so far in one batch while threads flushing in the
+  meantime wait and have their mutations written together in the next batch.
+
+  Flush() only returns once the mutations passed in were written, so for every
+  single flow requests and responses are still written before the flow's
+  notifications, and nothing is written before the flow state was saved under
+  its lease.
+  """
+
+  def __init__(self, max_batch_size=10000, token=None):
+    """Constructor.
+
+    Args:
+      max_batch_size: The maximum number of mutations written in one batch.
+        Mutations collected from a single queue manager are never split.
+      token: The token used to write the mutations.
+    """
+    self.max_batch_size = max_batch_size
+    self.token = token
+
+    self._condition = threading.Condition()
+    self._pending = []
+    self._flushing = False
+
+  def Flush(self, mutations):
+    """Writes the given PendingMutations, possibly together with others."""
+    with self._condition:
+      self._pending.append(mutations)
+
+      while not mutations.written:
+        if self._flushing:
+          self._condition.wait()
+          continue
+
+        # No flush is in progress, this thread writes the next batch.
+        self._flushing = True
+        batch = self._TakeBatch()
+
+        self._condition.release()
+        try:
+          self._WriteBatch(batch)
+        finally:
+          self._condition.acquire()
+          for m in batch:
+            m.written = True
+          self._flushing = False
+          self._condition.notify_all()
+
+    if mutations.error is not None:
+      raise mutations.error  # pylint: disable=raising-bad-type
+
+  def _WriteBatch(self, batch):
+    """Writes a batch and records errors in all its PendingMutations."""
+    try:
+      QueueManager(token=self.token)._WriteMutations(batch)  # pylint: disable=protected-access
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error while flushing %d queue managers.", len(batch))
+      for m in batch:
+        m.error = e
+
+    stats.STATS.RecordEvent("queue_manager_flush_batch_size", len(batch))
+
+  def _TakeBatch(self):
+    """Removes up to max_batch_size pending mutations and returns them."""
+    batch = []
+    batch_size = 0
+    while self._pending:
+      size = len(self._pending[0])
+      if batch and batch_size + size > self.max_batch_size:
+        break
+
+      batch.append(self._pending.pop(0))
+      batch_size += size
+
+    return batch
+
+
 class QueueManager(object):
   """This class manages the representation of the flow within the data store.
 
@@ -112,6 +227,10 @@ class QueueManager(object):
     self.prev_frozen_timestamps = []
     self.frozen_timestamp = None
 
+    # If set, Flush() hands the pending mutations over to this
+    # FlushCoordinator instead of writing them directly.
+    self.flush_coordinator = None
+
     self.num_notification_shards = config.CONFIG["Worker.queue_shards"]
 
   def GetNotificationShard(self, queue):
@@ -289,21 +408,81 @@ class QueueManager(object):
 
   def Flush(self):
     """Writes the changes in this object to the datastore."""
+    mutations = self._TakePendingMutations()
+
+    if self.flush_coordinator is not None:
+      if mutations:
+        self.flush_coordinator.Flush(mutations)
+    else:
+      self._WriteMutations([mutations])
+
+  def _TakePendingMutations(self):
+    """Returns the pending mutations and clears them in this object."""
+    # The timestamps are resolved now, the mutations might be written by
+    # another queue manager.
+    new_client_messages = [(msg, timestamp or self.frozen_timestamp)
+                           for msg, timestamp in self.new_client_messages]
+
+    mutations = PendingMutations(
+        requests=self.request_queue,
+        responses=self.response_queue,
+        requests_to_delete=self.requests_to_delete,
+        client_messages_to_delete=self.client_messages_to_delete,
+        new_client_messages=new_client_messages,
+        notifications=self.notifications,
+        notifications_first_queued=(self.frozen_timestamp or
+                                    rdfvalue.RDFDatetime.Now()))
+
+    self.request_queue = []
+    self.response_queue = []
+    self.requests_to_delete = []
+
+    self.client_messages_to_delete = {}
+    self.notifications = {}
+    self.new_client_messages = []
+
+    return mutations
+
+  def _WriteMutations(self, mutations_list):
+    """Writes the given PendingMutations in a single batch."""
+    new_requests = []
+    new_responses = []
+    requests_to_delete = []
+    client_messages_to_delete = {}
+    new_client_messages = []
+    notifications = {}
+    notifications_first_queued = {}
+    for mutations in mutations_list:
+      new_requests.extend(mutations.requests)
+      new_responses.extend(mutations.responses)
+      requests_to_delete.extend(mutations.requests_to_delete)
+      for client_id, messages in mutations.client_messages_to_delete.iteritems():
+        client_messages_to_delete.setdefault(client_id, []).extend(messages)
+      new_client_messages.extend(mutations.new_client_messages)
+
+      # Same as in QueueNotification, only keep the notification with the
+      # highest request number for every session id and timestamp.
+      for key, notification in mutations.notifications.iteritems():
+        existing = notifications.get(key)
+        if (existing is None or
+            existing.last_status < notification.last_status):
+          notifications[key] = notification
+          notifications_first_queued[key] = mutations.notifications_first_queued
 
     self.data_store.StoreRequestsAndResponses(
-        new_requests=self.request_queue,
-        new_responses=self.response_queue,
-        requests_to_delete=self.requests_to_delete)
+        new_requests=new_requests,
+        new_responses=new_responses,
+        requests_to_delete=requests_to_delete)
 
     # We need to make sure that notifications are written after the requests so
     # we flush after writing all requests and only notify afterwards.
     mutation_pool = self.data_store.GetMutationPool()
     with mutation_pool:
-      for client_id, messages in self.client_messages_to_delete.iteritems():
+      for client_id, messages in client_messages_to_delete.iteritems():
         self.Delete(client_id.Queue(), messages, mutation_pool=mutation_pool)
 
-      if self.new_client_messages:
-        for timestamp, messages in utils.GroupBy(self.new_client_messages,
+      if new_client_messages:
+        for timestamp, messages in utils.GroupBy(new_client_messages,
                                                  lambda x: x[1]).iteritems():
 
           self.Schedule(
@@ -311,20 +490,18 @@ class QueueManager(object):
               timestamp=timestamp,
               mutation_pool=mutation_pool)
 
-    if self.notifications:
-      for notification in self.notifications.itervalues():
-        self.NotifyQueue(notification, mutation_pool=mutation_pool)
+    if notifications:
+      # Notifications are stamped with the time of the queue manager that
+      # queued them, which is not necessarily this one.
+      for first_queued, keys in utils.GroupBy(
+          notifications, notifications_first_queued.get).iteritems():
+        self.MultiNotifyQueue(
+            [notifications[key] for key in keys],
+            mutation_pool=mutation_pool,
+            first_queued=first_queued)
 
       mutation_pool.Flush()
 
-    self.request_queue = []
-    self.response_queue = []
-    self.requests_to_delete = []
-
-    self.client_messages_to_delete = {}
-    self.notifications = {}
-    self.new_client_messages = []
-
   def QueueResponse(self, response, timestamp=None):
     """Queues the message on the flow's state."""
     if timestamp is None:
@@ -529,12 +706,15 @@ class QueueManager(object):
     self._MultiNotifyQueue(notification.session_id.Queue(), [notification],
                            **kwargs)
 
-  def MultiNotifyQueue(self, notifications, mutation_pool=None):
+  def MultiNotifyQueue(self, notifications, mutation_pool=None,
+                       first_queued=None):
     """This is the same as NotifyQueue but for several session_ids at once.
 
     Args:
       notifications: A list of notifications.
       mutation_pool: A MutationPool object to schedule Notifications on.
+      first_queued: When notifications that were not queued before are queued.
+        Defaults to the frozen timestamp or now.
 
     Raises:
       RuntimeError: An invalid session_id was passed.
@@ -542,15 +722,23 @@ class QueueManager(object):
     extract_queue = lambda notification: notification.session_id.Queue()
     for queue, notifications in utils.GroupBy(notifications,
                                               extract_queue).iteritems():
-      self._MultiNotifyQueue(queue, notifications, mutation_pool=mutation_pool)
-
-  def _MultiNotifyQueue(self, queue, notifications, mutation_pool=None):
+      self._MultiNotifyQueue(
+          queue,
+          notifications,
+          mutation_pool=mutation_pool,
+          first_queued=first_queued)
+
+  def _MultiNotifyQueue(self,
+                        queue,
+                        notifications,
+                        mutation_pool=None,
+                        first_queued=None):
     """Does the actual queuing."""
     notification_list = []
     now = rdfvalue.RDFDatetime.Now()
     for notification in notifications:
       if not notification.first_queued:
-        notification.first_queued = (self.frozen_timestamp or
+        notification.first_queued = (first_queued or self.frozen_timestamp or
                                      rdfvalue.RDFDatetime.Now())
       else:
         diff = now - notification.first_queued
@@ -624,6 +812,94 @@ class QueueManager(object):
       return mutation_pool.QueueQueryAndOwn(queue, lease_seconds, limit,
                                             self.frozen_timestamp)
 
+  def CompactClientQueue(self, client_id, mutation_pool):
+    """Removes expired and duplicate tasks from a client's queue.
+
+    Tasks are removed if their ttl is exhausted, if they were leased before
+    and their request was completed in the meantime or if the same message is
+    scheduled more than once. The number of tasks left is stored as the
+    client's queue backlog, see GetClientQueueBacklogs().
+
+    Args:
+      client_id: The client whose queue should be compacted.
+      mutation_pool: A MutationPool object to schedule the deletions on.
+
+    Returns:
+      A tuple (remaining, removed) with the number of tasks left in the queue
+      and the number of tasks removed.
+    """
+    queue = rdf_client.ClientURN(client_id).Queue()
+    tasks = self.data_store.QueueQueryTasks(queue, limit=None)
+
+    to_delete = []
+    leased_before = []
+    by_message = {}
+    for task in tasks:
+      if task.task_ttl <= 0:
+        to_delete.append(task)
+        stats.STATS.IncrementCounter(
+            "grr_client_queue_compacted_tasks", fields=["expired"])
+        continue
+
+      if task.task_ttl < rdf_flows.GrrMessage.max_ttl:
+        leased_before.append(task)
+
+      by_message.setdefault((task.session_id, task.request_id,
+                             task.response_id), []).append(task)
+
+    for duplicates in by_message.itervalues():
+      if len(duplicates) < 2:
+        continue
+
+      # Keep the copy that was retransmitted the least.
+      duplicates.sort(key=lambda t: (-t.task_ttl, t.task_id))
+      to_delete.extend(duplicates[1:])
+      stats.STATS.IncrementCounter(
+          "grr_client_queue_compacted_tasks",
+          delta=len(duplicates) - 1,
+          fields=["duplicate"])
+
+    if leased_before:
+      deleted_ids = set(t.task_id for t in to_delete)
+      completed = [
+          t for t in self.MultiCheckStatus(leased_before)
+          if t.task_id not in deleted_ids
+      ]
+      to_delete.extend(completed)
+      stats.STATS.IncrementCounter(
+          "grr_client_queue_compacted_tasks",
+          delta=len(completed),
+          fields=["completed"])
+
+    if to_delete:
+      self.Delete(queue, to_delete, mutation_pool=mutation_pool)
+
+    remaining = len(tasks) - len(to_delete)
+    mutation_pool.Set(
+        queue, self.data_store.QUEUE_BACKLOG_ATTRIBUTE, remaining)
+    return remaining, len(to_delete)
+
+  def GetClientQueueBacklogs(self, client_ids):
+    """Returns the queue backlogs recorded by the last compaction.
+
+    Args:
+      client_ids: A list of client ids.
+
+    Returns:
+      A dict mapping ClientURNs to the number of tasks that were left in their
+      queue when it was last compacted. Clients whose queue was never compacted
+      are not included.
+    """
+    client_ids = [rdf_client.ClientURN(c) for c in client_ids]
+    queues = {utils.SmartStr(c.Queue()): c for c in client_ids}
+    result = {}
+    for queue, values in self.data_store.MultiResolvePrefix(
+        queues.keys(), self.data_store.QUEUE_BACKLOG_ATTRIBUTE):
+      for _, value, _ in values:
+        result[queues[utils.SmartStr(queue)]] = int(value)
+
+    return result
+
 
 class WellKnownQueueManager(QueueManager):
   """A flow manager for well known flows."""
@@ -664,3 +940,10 @@ class QueueManagerInit(registry.InitHook):
         "notification_queue_count",
         int,
         fields=[("queue_name", str), ("priority", str)])
+    stats.STATS.RegisterEventMetric(
+        "queue_manager_flush_batch_size", bins=[1, 2, 5, 10, 20, 50, 100, 200])
+    stats.STATS.RegisterCounterMetric(
+        "grr_client_queue_compacted_tasks", fields=[("reason", str)])
+    stats.STATS.RegisterEventMetric(
+        "grr_client_queue_backlog", bins=[0, 1, 10, 100, 1000, 10000, 100000])
+    stats.STATS.RegisterGaugeMetric("grr_client_queue_max_backlog", int)
@@ -8,6 +8,7 @@ from grr.lib import flags
 from grr.lib import queues
 from grr.lib import rdfvalue
 from grr.lib import stats
+from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.server import data_store
 from grr.server import queue_manager
@@ -458,6 +459,202 @@ class QueueManagerTest(flow_test_lib.FlowTestsBaseclass):
                      queue_manager._GetClientIdFromQueue(
                          MockQueue("/c.ABCDEFABCDEFABCDE/tasks")))
 
+  def testQueryAndOwnDoesNotCountExpiredTasksTowardsLimit(self):
+    test_queue = rdfvalue.RDFURN("fooQueryAndOwnLimit")
+    tasks = []
+    for i in range(10):
+      task = rdf_flows.GrrMessage(
+          session_id="Test%d" % i, queue=test_queue, generate_task_id=True)
+      if i % 2:
+        # These tasks expire when they are leased the next time.
+        task.task_ttl = 1
+      tasks.append(task)
+
+    manager = queue_manager.QueueManager(token=self.token)
+    with data_store.DB.GetMutationPool() as pool:
+      manager.Schedule(tasks, pool)
+
+    leased = manager.QueryAndOwn(test_queue, lease_seconds=100, limit=5)
+    self.assertEqual(
+        sorted(t.task_id for t in leased),
+        sorted(t.task_id for t in tasks[::2]))
+
+  def testCompactClientQueueRemovesExpiredAndDuplicateTasks(self):
+    client_id = test_lib.TEST_CLIENT_ID
+    session_id = rdfvalue.SessionID(flow_name="compact")
+
+    def MakeTask(request_id, task_ttl=None):
+      task = rdf_flows.GrrMessage(
+          queue=client_id.Queue(),
+          session_id=session_id,
+          request_id=request_id,
+          generate_task_id=True)
+      if task_ttl is not None:
+        task.task_ttl = task_ttl
+      return task
+
+    tasks = [
+        MakeTask(1),
+        # Scheduled twice, the copy that was leased before is removed.
+        MakeTask(2),
+        MakeTask(2, task_ttl=3),
+        # Expired.
+        MakeTask(3, task_ttl=0),
+        # Leased before and completed.
+        MakeTask(4, task_ttl=4),
+    ]
+    manager = queue_manager.QueueManager(token=self.token)
+    with data_store.DB.GetMutationPool() as pool:
+      manager.Schedule(tasks, pool)
+
+    with queue_manager.QueueManager(token=self.token) as m:
+      m.QueueResponse(
+          rdf_flows.GrrMessage(
+              session_id=session_id,
+              request_id=4,
+              response_id=1,
+              type=rdf_flows.GrrMessage.Type.STATUS))
+
+    with data_store.DB.GetMutationPool() as pool:
+      remaining, removed = manager.CompactClientQueue(client_id, pool)
+
+    self.assertEqual(remaining, 2)
+    self.assertEqual(removed, 3)
+
+    stored_tasks = manager.Query(client_id, limit=100)
+    self.assertEqual(
+        sorted(t.task_id for t in stored_tasks),
+        sorted([tasks[0].task_id, tasks[1].task_id]))
+
+    self.assertEqual(
+        manager.GetClientQueueBacklogs([client_id]), {client_id: 2})
+
+  def testGetClientQueueBacklogsSkipsClientsThatWereNotCompacted(self):
+    manager = queue_manager.QueueManager(token=self.token)
+    self.assertEqual(
+        manager.GetClientQueueBacklogs([test_lib.TEST_CLIENT_ID]), {})
+
+  def _QueueFlowMutations(self, manager, flow_name):
+    session_id = rdfvalue.SessionID(flow_name=flow_name)
+    request = rdf_flows.RequestState(
+        id=1,
+        client_id=test_lib.TEST_CLIENT_ID,
+        next_state="TestState",
+        session_id=session_id)
+    manager.QueueRequest(request)
+    manager.QueueResponse(
+        rdf_flows.GrrMessage(
+            session_id=session_id, request_id=1, response_id=1))
+    manager.QueueClientMessage(
+        rdf_flows.GrrMessage(
+            queue=test_lib.TEST_CLIENT_ID.Queue(),
+            session_id=session_id,
+            generate_task_id=True))
+    manager.QueueNotification(session_id=session_id)
+    return session_id
+
+  def testFlushCoordinatorWritesMutationsOfAllManagers(self):
+    coordinator = queue_manager.FlushCoordinator(token=self.token)
+
+    session_ids = []
+    for i in range(3):
+      manager = queue_manager.QueueManager(token=self.token)
+      manager.flush_coordinator = coordinator
+      session_ids.append(self._QueueFlowMutations(manager, "coord%d" % i))
+      manager.Flush()
+
+    manager = queue_manager.QueueManager(token=self.token)
+    for session_id in session_ids:
+      requests = list(manager.FetchRequestsAndResponses(session_id))
+      self.assertEqual(len(requests), 1)
+      self.assertEqual(len(requests[0][1]), 1)
+
+    tasks = data_store.DB.QueueQueryTasks(
+        test_lib.TEST_CLIENT_ID.Queue(), limit=100)
+    self.assertEqual(
+        sorted(t.session_id for t in tasks), sorted(session_ids))
+
+    notifications = manager.GetNotificationsForAllShards(queues.FLOWS)
+    self.assertEqual(
+        sorted(n.session_id for n in notifications), sorted(session_ids))
+
+  def testFlushCoordinatorWritesPendingMutationsInOneBatch(self):
+    coordinator = queue_manager.FlushCoordinator(token=self.token)
+
+    pending = []
+    session_ids = []
+    for i in range(3):
+      manager = queue_manager.QueueManager(token=self.token)
+      session_ids.append(self._QueueFlowMutations(manager, "batch%d" % i))
+      pending.append(manager._TakePendingMutations())
+
+    # Pretend the first two were queued while another flush was running.
+    coordinator._pending.extend(pending[:2])
+
+    batches = []
+    original_write = queue_manager.QueueManager._WriteMutations
+
+    def RecordingWrite(manager, mutations_list):
+      batches.append(len(mutations_list))
+      original_write(manager, mutations_list)
+
+    with utils.Stubber(queue_manager.QueueManager, "_WriteMutations",
+                       RecordingWrite):
+      coordinator.Flush(pending[2])
+
+    self.assertEqual(batches, [3])
+    for mutations in pending:
+      self.assertTrue(mutations.written)
+
+    manager = queue_manager.QueueManager(token=self.token)
+    for session_id in session_ids:
+      self.assertEqual(
+          len(list(manager.FetchRequestsAndResponses(session_id))), 1)
+
+  def testFlushCoordinatorRespectsMaxBatchSize(self):
+    coordinator = queue_manager.FlushCoordinator(
+        max_batch_size=4, token=self.token)
+
+    pending = []
+    for i in range(3):
+      manager = queue_manager.QueueManager(token=self.token)
+      self._QueueFlowMutations(manager, "size%d" % i)
+      pending.append(manager._TakePendingMutations())
+
+    coordinator._pending.extend(pending[:2])
+
+    batches = []
+    original_write = queue_manager.QueueManager._WriteMutations
+
+    def RecordingWrite(manager, mutations_list):
+      batches.append(len(mutations_list))
+      original_write(manager, mutations_list)
+
+    with utils.Stubber(queue_manager.QueueManager, "_WriteMutations",
+                       RecordingWrite):
+      coordinator.Flush(pending[2])
+
+    # Every manager queued 4 mutations, so each one is written on its own.
+    self.assertEqual(batches, [1, 1, 1])
+
+  def testFlushCoordinatorReraisesWriteErrors(self):
+    coordinator = queue_manager.FlushCoordinator(token=self.token)
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.flush_coordinator = coordinator
+    self._QueueFlowMutations(manager, "error")
+
+    def FailingWrite(unused_manager, unused_mutations_list):
+      raise IOError("Write failed.")
+
+    with utils.Stubber(queue_manager.QueueManager, "_WriteMutations",
+                       FailingWrite):
+      with self.assertRaises(IOError):
+        manager.Flush()
+
+    # The coordinator is usable after a failed write.
+    self._QueueFlowMutations(manager, "error2")
+    manager.Flush()
+
 
 class MultiShardedQueueManagerTest(QueueManagerTest):
   """Test for QueueManager with multiple notification shards enabled."""
@@ -591,6 +788,27 @@ class MultiShardedQueueManagerTest(QueueManagerTest):
           notifications = manager.GetNotifications(queues.HUNTS)
           self.assertEqual(len(notifications), 0)
 
+  def testFreshNotificationsOfLongRunningManagerAreNotExpired(self):
+    with test_lib.ConfigOverrider({"Worker.queue_shards": 1}):
+      session_id = rdfvalue.SessionID(
+          base="aff4:/testflows", queue=queues.HUNTS, flow_name="123")
+      expired = 1000 + queue_manager.QueueManager.notification_expiry_time
+      with test_lib.FakeTime(1000):
+        manager = queue_manager.QueueManager(token=self.token)
+        manager.FreezeTimestamp()
+        manager.QueueNotification(session_id=session_id)
+
+      # The manager was frozen longer than the expiry time ago but the
+      # notification is only written now, so it must not be dropped.
+      with test_lib.FakeTime(expired + 100):
+        manager.Flush()
+
+        with queue_manager.QueueManager(token=self.token) as reader:
+          notifications = reader.GetNotifications(queues.HUNTS)
+          self.assertEqual(len(notifications), 1)
+          self.assertEqual(notifications[0].first_queued.AsSecondsFromEpoch(),
+                           1000)
+
 
 def main(argv):
   test_lib.main(argv)
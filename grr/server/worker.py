@@ -92,6 +92,10 @@ class GRRWorker(object):
     self.token = token
     self.last_active = 0
 
+    # Flows processed concurrently by this worker write their queued requests,
+    # responses and notifications to the data store in combined batches.
+    self.flush_coordinator = queue_manager_lib.FlushCoordinator(token=token)
+
     # Well known flows are just instantiated.
     self.well_known_flows = flow.WellKnownFlow.GetAllWellKnownFlows(token=token)
 
@@ -253,6 +257,7 @@ class GRRWorker(object):
       raise FlowProcessingError("Not a GRRFlow.")
 
     runner = flow_obj.GetRunner()
+    runner.queue_manager.flush_coordinator = self.flush_coordinator
     try:
       runner.ProcessCompletedRequests(notification, self.__class__.thread_pool)
     except Exception as e:  # pylint: disable=broad-except
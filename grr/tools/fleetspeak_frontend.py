@@ -108,6 +108,8 @@ def main(argv):
       time.sleep(600)
   except KeyboardInterrupt:
     print "Caught keyboard interrupt, stopping"
+  finally:
+    fsd.frontend.Stop()
 
 
 if __name__ == "__main__":
@@ -2,14 +2,24 @@
 """This is the GRR frontend HTTP Server."""
 
 
+import asynchat
+import asyncore
 import BaseHTTPServer
 import cgi
 import cStringIO
 import logging
+import multiprocessing
+from multiprocessing import reduction
+import os
 import pdb
+import Queue
+import select
+import signal
 import socket
 import SocketServer
 import threading
+import time
+import zlib
 
 
 import ipaddr
@@ -22,6 +32,7 @@ from grr.lib import server_plugins
 
 from grr import config
 from grr.lib import communicator
+from grr.lib import config_lib
 from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib import stats
@@ -32,6 +43,7 @@ from grr.server import front_end
 from grr.server import master
 from grr.server import server_logging
 from grr.server import server_startup
+from grr.server import threadpool
 
 
 class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
@@ -41,7 +53,8 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       200: "200 OK",
       404: "404 Not Found",
       406: "406 Not Acceptable",
-      500: "500 Internal Server Error"
+      500: "500 Internal Server Error",
+      503: "503 Service Unavailable"
   }
 
   active_counter_lock = threading.Lock()
@@ -298,6 +311,10 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       # client appropriately.
       self.Send("Enrollment required", status=406)
 
+    except front_end.OverloadedError:
+      # The client keeps the messages and sends them again later.
+      self.Send("Server overloaded", status=503)
+
     finally:
       with GRRHTTPServerHandler.active_counter_lock:
         GRRHTTPServerHandler.active_counter -= 1
@@ -305,6 +322,16 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             "frontend_active_count", self.active_counter, fields=["http"])
 
 
+# Not exported by the socket module of all Python versions.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+
+def _AddressFamily(address):
+  if ipaddr.IPAddress(address).version == 4:
+    return socket.AF_INET
+  return socket.AF_INET6
+
+
 class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
   """The GRR HTTP frontend server."""
 
@@ -313,7 +340,13 @@ class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
 
   address_family = socket.AF_INET6
 
-  def __init__(self, server_address, handler, frontend=None, *args, **kwargs):
+  def __init__(self,
+               server_address,
+               handler,
+               frontend=None,
+               reuse_port=False,
+               *args,
+               **kwargs):
     stats.STATS.SetGaugeValue("frontend_max_active_count",
                               self.request_queue_size)
 
@@ -336,22 +369,377 @@ class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     elif version == 6:
       self.address_family = socket.AF_INET6
 
+    self.reuse_port = reuse_port
+
     logging.info("Will attempt to listen on %s", server_address)
     BaseHTTPServer.HTTPServer.__init__(self, server_address, handler, *args,
                                        **kwargs)
 
+  def server_bind(self):
+    if self.reuse_port:
+      self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    BaseHTTPServer.HTTPServer.server_bind(self)
+
+  def AddConnection(self, sock, client_address):
+    """Serves a connection that was accepted by another process."""
+    self.process_request(sock, client_address)
+
+
+class _BufferedRequestHandler(GRRHTTPServerHandler):
+  """Handles a single request that was already read by the event loop.
+
+  The request is read from and the response written to memory buffers so the
+  handler can run in a worker thread while the event loop does all the socket
+  IO.
+  """
+
+  # Lets BaseHTTPRequestHandler honor keep-alive requests.
+  protocol_version = "HTTP/1.1"
+
+  def setup(self):
+    self.rfile = cStringIO.StringIO(self.request)
+    self.wfile = cStringIO.StringIO()
+
+  def handle(self):
+    self.close_connection = 1
+    self.handle_one_request()
+
+  def finish(self):
+    pass
+
+  def Send(self,
+           data,
+           status=200,
+           ctype="application/octet-stream",
+           additional_headers=None,
+           last_modified=0):
+    headers = dict(additional_headers or {})
+    headers["Connection"] = "close" if self.close_connection else "keep-alive"
+    GRRHTTPServerHandler.Send(
+        self,
+        data,
+        status=status,
+        ctype=ctype,
+        additional_headers=headers,
+        last_modified=last_modified)
+
+  def log_message(self, fmt, *args):
+    logging.debug("%s - %s", self.client_address[0], fmt % args)
+
+
+class _EventLoopHTTPConnection(asynchat.async_chat):
+  """A client connection served by the GRREventLoopHTTPServer."""
+
+  # Requests whose headers are larger than this are rejected.
+  MAX_HEADER_SIZE = 64 * 1024
+
+  ac_in_buffer_size = 64 * 1024
+  ac_out_buffer_size = 64 * 1024
+
+  def __init__(self, sock, client_address, server, socket_map):
+    asynchat.async_chat.__init__(self, sock=sock, map=socket_map)
+    self.client_address = client_address
+    self.server = server
+    self.processing = False
+    self.last_activity = time.time()
+    self._ResetRequest()
+
+  def _ResetRequest(self):
+    self._request_head = None
+    self._buffer = []
+    self._buffer_size = 0
+    self.set_terminator("\r\n\r\n")
+
+  def readable(self):
+    # Requests on a connection are processed one at a time, further data is
+    # left in the socket until the response was sent.
+    return not self.processing and asynchat.async_chat.readable(self)
+
+  def collect_incoming_data(self, data):
+    self.last_activity = time.time()
+    self._buffer.append(data)
+    self._buffer_size += len(data)
+    if self._request_head is None and self._buffer_size > self.MAX_HEADER_SIZE:
+      logging.info("Request headers from %s too large.", self.client_address[0])
+      self.close()
+
+  def found_terminator(self):
+    if self._request_head is None:
+      self._request_head = "".join(self._buffer) + "\r\n\r\n"
+      self._buffer = []
+      self._buffer_size = 0
+
+      content_length = self._GetContentLength(self._request_head)
+      if content_length is None:
+        self.close()
+        return
+
+      if content_length:
+        self.set_terminator(content_length)
+        return
+
+    request = self._request_head + "".join(self._buffer)
+    self.processing = True
+    self.set_terminator(None)
+    self.server.ProcessRequest(self, request)
+
+  def _GetContentLength(self, request_head):
+    """Returns the length of the request body or None if unsupported."""
+    for line in request_head.split("\r\n")[1:]:
+      name, _, value = line.partition(":")
+      name = name.strip().lower()
+      if name == "content-length":
+        try:
+          return int(value)
+        except ValueError:
+          return None
+      elif name == "transfer-encoding":
+        # Chunked requests are not supported by this server.
+        return None
+
+    return 0
+
+  def SendResponse(self, response, keep_alive):
+    """Sends a response, called from the event loop thread."""
+    self.last_activity = time.time()
+    self.push(response)
+    if keep_alive:
+      self.processing = False
+      self._ResetRequest()
+    else:
+      self.close_when_done()
+
+  def handle_error(self):
+    logging.exception("Error on connection from %s.", self.client_address[0])
+    self.close()
+
+
+class _EventLoopWaker(asyncore.file_dispatcher):
+  """Wakes up the event loop when a worker thread has finished a request."""
+
+  def __init__(self, socket_map):
+    self._read_fd, self._write_fd = os.pipe()
+    asyncore.file_dispatcher.__init__(self, self._read_fd, map=socket_map)
+    self.callbacks = Queue.Queue()
+
+  def writable(self):
+    return False
+
+  def Wake(self, callback):
+    """Runs callback in the event loop thread."""
+    self.callbacks.put(callback)
+    os.write(self._write_fd, "x")
+
+  def handle_read(self):
+    self.recv(4096)
+    while True:
+      try:
+        callback = self.callbacks.get_nowait()
+      except Queue.Empty:
+        return
+
+      callback()
+
+  def close(self):
+    asyncore.file_dispatcher.close(self)
+    os.close(self._write_fd)
+
+
+class GRREventLoopHTTPServer(asyncore.dispatcher):
+  """A GRR HTTP frontend server that multiplexes connections in an event loop.
+
+  Unlike GRRHTTPServer, which uses one thread per connection, all sockets are
+  handled by a single thread. Complete requests are processed by the same
+  handler code in a bounded worker pool and the responses are sent back by the
+  event loop. Connections are kept alive between requests if the client asks
+  for it.
+  """
+
+  request_queue_size = 500
+
+  # How often the event loop checks for shutdown and idle connections.
+  poll_interval = 0.5
+
+  def __init__(self,
+               server_address,
+               frontend=None,
+               max_workers=None,
+               reuse_port=False,
+               listen=True):
+    self._socket_map = {}
+    asyncore.dispatcher.__init__(self, map=self._socket_map)
+
+    if frontend:
+      self.frontend = frontend
+    else:
+      self.frontend = front_end.FrontEndServer(
+          certificate=config.CONFIG["Frontend.certificate"],
+          private_key=config.CONFIG["PrivateKeys.server_key"],
+          max_queue_size=config.CONFIG["Frontend.max_queue_size"],
+          message_expiry_time=config.CONFIG["Frontend.message_expiry_time"],
+          max_retransmission_time=config.CONFIG[
+              "Frontend.max_retransmission_time"])
+    self.server_cert = config.CONFIG["Frontend.certificate"]
+    self.keep_alive_timeout = config.CONFIG["Frontend.keep_alive_timeout"]
+
+    if max_workers is None:
+      max_workers = config.CONFIG["Frontend.event_loop_worker_threads"]
+    stats.STATS.SetGaugeValue("frontend_max_active_count", max_workers)
+
+    self.worker_pool = threadpool.ThreadPool.Factory(
+        "grr_frontend_pool", min_threads=2, max_threads=max_workers)
+    self.worker_pool.Start()
+
+    self.waker = _EventLoopWaker(self._socket_map)
+    self.accepted_connections = 0
+    self._shutdown_requested = False
+    self._stopped = threading.Event()
+    self._next_idle_check = 0
 
-def CreateServer(frontend=None):
-  """Start frontend http server."""
+    if not listen:
+      return
+
+    logging.info("Will attempt to listen on %s", server_address)
+    self.create_socket(_AddressFamily(server_address[0]), socket.SOCK_STREAM)
+    try:
+      self.set_reuse_addr()
+      if reuse_port:
+        self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+      self.bind(server_address)
+      self.listen(self.request_queue_size)
+    except socket.error:
+      self.close()
+      self.waker.close()
+      raise
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is None:
+      return
+
+    self._AddConnection(*pair)
+
+  def _AddConnection(self, sock, client_address):
+    self.accepted_connections += 1
+    _EventLoopHTTPConnection(sock, client_address, self, self._socket_map)
+
+  def AddConnection(self, sock, client_address):
+    """Serves a connection that was accepted by another process."""
+    self.waker.Wake(lambda: self._AddConnection(sock, client_address))
+
+  def ProcessRequest(self, connection, request):
+    """Hands a complete request over to the worker pool."""
+    try:
+      self.worker_pool.AddTask(
+          target=self._HandleRequest,
+          args=(connection, request),
+          name="frontend_request",
+          blocking=False,
+          inline=False)
+    except threadpool.Full:
+      stats.STATS.IncrementCounter("frontend_overload_count")
+      connection.SendResponse(
+          "HTTP/1.0 503 Service Unavailable\r\n"
+          "Content-Length: 0\r\n"
+          "Connection: close\r\n\r\n",
+          keep_alive=False)
+
+  def _HandleRequest(self, connection, request):
+    """Runs the request handler, called in a worker thread."""
+    try:
+      handler = _BufferedRequestHandler(request, connection.client_address,
+                                        self)
+      response = handler.wfile.getvalue()
+      keep_alive = not handler.close_connection
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error handling request: %s", e)
+      response, keep_alive = "", False
+
+    self.waker.Wake(lambda: self._SendResponse(connection, response,
+                                               keep_alive))
+
+  def _SendResponse(self, connection, response, keep_alive):
+    if not connection.connected:
+      # The client went away in the meantime.
+      return
+
+    connection.SendResponse(response, keep_alive)
+
+  def _CloseIdleConnections(self):
+    deadline = time.time() - self.keep_alive_timeout
+    for dispatcher in self._socket_map.values():
+      if (isinstance(dispatcher, _EventLoopHTTPConnection) and
+          not dispatcher.processing and dispatcher.last_activity < deadline):
+        dispatcher.close()
+
+  def serve_forever(self):
+    """Runs the event loop until shutdown() is called."""
+    self._stopped.clear()
+    try:
+      while not self._shutdown_requested:
+        asyncore.loop(
+            timeout=self.poll_interval,
+            use_poll=True,
+            map=self._socket_map,
+            count=1)
+
+        # Looking for idle connections visits every connection, so it is not
+        # done after every event. Idle connections are closed at most a
+        # quarter of the keep alive timeout late.
+        now = time.time()
+        if now >= self._next_idle_check:
+          self._CloseIdleConnections()
+          self._next_idle_check = now + max(self.poll_interval,
+                                            self.keep_alive_timeout / 4.0)
+    finally:
+      self.server_close()
+      self._stopped.set()
+
+  def server_close(self):
+    """Closes the listening socket and all connections."""
+    asyncore.close_all(map=self._socket_map)
+
+  def shutdown(self):
+    """Stops the event loop and waits for it to exit."""
+    self._shutdown_requested = True
+    self._stopped.wait()
+
+
+def CreateServer(frontend=None, reuse_port=False, listen=True):
+  """Start frontend http server.
+
+  Args:
+    frontend: The FrontEndServer to use, by default one is created.
+    reuse_port: If set, the listening socket is bound with SO_REUSEPORT so
+      several processes can serve the same port.
+    listen: If false, the server does not listen itself and only serves
+      connections passed to AddConnection().
+
+  Returns:
+    The server.
+  """
   max_port = config.CONFIG.Get("Frontend.port_max",
                                config.CONFIG["Frontend.bind_port"])
+  if reuse_port or not listen:
+    max_port = config.CONFIG["Frontend.bind_port"]
 
   for port in range(config.CONFIG["Frontend.bind_port"], max_port + 1):
 
     server_address = (config.CONFIG["Frontend.bind_address"], port)
     try:
-      httpd = GRRHTTPServer(
-          server_address, GRRHTTPServerHandler, frontend=frontend)
+      if config.CONFIG["Frontend.server_mode"] == "event_loop":
+        httpd = GRREventLoopHTTPServer(
+            server_address,
+            frontend=frontend,
+            reuse_port=reuse_port,
+            listen=listen)
+      else:
+        httpd = GRRHTTPServer(
+            server_address,
+            GRRHTTPServerHandler,
+            frontend=frontend,
+            reuse_port=reuse_port,
+            bind_and_activate=listen)
       break
     except socket.error as e:
       if e.errno == socket.errno.EADDRINUSE and port < max_port:
@@ -359,26 +747,239 @@ def CreateServer(frontend=None):
       else:
         raise
 
-  sa = httpd.socket.getsockname()
-  logging.info("Serving HTTP on %s port %d ...", sa[0], sa[1])
+  if listen:
+    sa = httpd.socket.getsockname()
+    logging.info("Serving HTTP on %s port %d ...", sa[0], sa[1])
   return httpd
 
 
-def main(argv):
-  """Main."""
-  del argv  # Unused.
-  config.CONFIG.AddContext("HTTPServer Context")
+def _ReceiveConnections(httpd, connection_pipe):
+  """Serves connections passed in by the FrontendProcessPool."""
+  family = _AddressFamily(config.CONFIG["Frontend.bind_address"])
+  while True:
+    try:
+      fd = reduction.recv_handle(connection_pipe)
+    except EOFError:
+      logging.info("Frontend process pool went away, exiting.")
+      os._exit(0)  # pylint: disable=protected-access
+
+    sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+    os.close(fd)
+    try:
+      client_address = sock.getpeername()
+    except socket.error:
+      # The client disconnected already.
+      sock.close()
+      continue
+
+    httpd.AddConnection(sock, client_address)
+
+
+def _RaiseKeyboardInterrupt(unused_signum, unused_frame):
+  raise KeyboardInterrupt()
+
+
+def RunFrontendProcess(index=None, connection_pipe=None):
+  """Initializes the server and serves clients until interrupted.
+
+  Args:
+    index: The index of this process in a FrontendProcessPool, None if the
+      frontend runs in a single process.
+    connection_pipe: If given, connections accepted by the FrontendProcessPool
+      are received from this pipe instead of listening on the frontend port.
+  """
+  if index is not None:
+    # Every process reports its own stats.
+    monitoring_port = config.CONFIG["Monitoring.http_port"]
+    if monitoring_port:
+      flags.FLAGS.parameter.append(
+          "Monitoring.http_port=%d" % (monitoring_port + index))
+    process_id = config.CONFIG["StatsStore.process_id"]
+    if process_id:
+      flags.FLAGS.parameter.append(
+          "StatsStore.process_id=%s_%d" % (process_id, index))
 
   server_startup.Init()
 
-  httpd = CreateServer()
+  if index is not None:
+    # The FrontendProcessPool stops its processes with SIGTERM, shut down
+    # cleanly so buffered client metadata is written.
+    signal.signal(signal.SIGTERM, _RaiseKeyboardInterrupt)
+
+  if connection_pipe is not None:
+    httpd = CreateServer(listen=False)
+  else:
+    httpd = CreateServer(reuse_port=index is not None)
 
   server_startup.DropPrivileges()
 
   try:
-    httpd.serve_forever()
+    if connection_pipe is None:
+      httpd.serve_forever()
+    elif isinstance(httpd, GRRHTTPServer):
+      # The threaded server has no socket to serve, every connection received
+      # is handled in a new thread.
+      _ReceiveConnections(httpd, connection_pipe)
+    else:
+      receiver = threading.Thread(
+          target=_ReceiveConnections,
+          args=(httpd, connection_pipe),
+          name="FrontendConnectionReceiver")
+      receiver.daemon = True
+      receiver.start()
+      httpd.serve_forever()
   except KeyboardInterrupt:
     print "Caught keyboard interrupt, stopping"
+  finally:
+    httpd.frontend.Stop()
+
+
+class FrontendProcessPool(object):
+  """Runs the frontend in several pre-forked processes.
+
+  Every process initializes the server on its own after the fork, so it has
+  its own data store connections and communicator caches. By default all
+  processes bind the frontend port with SO_REUSEPORT and the kernel distributes
+  incoming connections. With client affinity this process accepts the
+  connections instead and passes each one to the process selected by a hash of
+  the client address, so the caches of a client's public key and session
+  ciphers are always in the process that serves it. The client common name is
+  only known after the request was decrypted, the address is the closest
+  stable key available when the connection is accepted.
+
+  Dead processes are restarted.
+  """
+
+  # How often the pool checks for processes that exited.
+  poll_interval = 1
+
+  def __init__(self, processes, affinity=False):
+    self.processes = processes
+    self.affinity = affinity
+
+    self._listener = None
+    self._pids = {}
+    self._connection_pipes = {}
+
+  def _Listen(self):
+    address = config.CONFIG["Frontend.bind_address"]
+    port = config.CONFIG["Frontend.bind_port"]
+
+    listener = socket.socket(_AddressFamily(address), socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((address, port))
+    listener.listen(GRRHTTPServer.request_queue_size)
+    logging.info("Serving HTTP on %s port %d with %d processes ...", address,
+                 port, self.processes)
+    return listener
+
+  def _StartProcess(self, index):
+    """Forks the frontend process with the given index."""
+    connection_pipe = child_pipe = None
+    if self.affinity:
+      connection_pipe, child_pipe = multiprocessing.Pipe()
+
+    pid = os.fork()
+    if pid == 0:
+      exit_code = 0
+      try:
+        if self._listener:
+          self._listener.close()
+        for pipe in self._connection_pipes.values() + [connection_pipe]:
+          if pipe:
+            pipe.close()
+        RunFrontendProcess(index=index, connection_pipe=child_pipe)
+      except Exception:  # pylint: disable=broad-except
+        logging.exception("Frontend process %d failed.", index)
+        exit_code = 1
+      finally:
+        os._exit(exit_code)  # pylint: disable=protected-access
+
+    if child_pipe:
+      child_pipe.close()
+      self._connection_pipes[index] = connection_pipe
+
+    logging.info("Started frontend process %d with pid %d.", index, pid)
+    self._pids[pid] = index
+
+  def _DispatchConnection(self):
+    """Passes a new connection to the process serving its client."""
+    try:
+      sock, client_address = self._listener.accept()
+    except socket.error:
+      return
+
+    try:
+      index = (zlib.crc32(client_address[0]) & 0xffffffff) % self.processes
+      pid = [p for p, i in self._pids.iteritems() if i == index][0]
+      reduction.send_handle(self._connection_pipes[index], sock.fileno(), pid)
+    except (IndexError, IOError, OSError) as e:
+      logging.warning("Unable to pass connection to frontend process: %s", e)
+    finally:
+      sock.close()
+
+  def _RestartExitedProcesses(self):
+    while self._pids:
+      pid, status = os.waitpid(-1, os.WNOHANG)
+      if not pid:
+        return
+
+      index = self._pids.pop(pid, None)
+      if index is None:
+        continue
+
+      logging.error("Frontend process %d (pid %d) exited with status %d.",
+                    index, pid, status)
+      pipe = self._connection_pipes.pop(index, None)
+      if pipe:
+        pipe.close()
+      self._StartProcess(index)
+
+  def Run(self):
+    """Starts the processes and supervises them until interrupted."""
+    if self.affinity:
+      self._listener = self._Listen()
+
+    for index in range(self.processes):
+      self._StartProcess(index)
+
+    try:
+      while True:
+        if self._listener:
+          readable, _, _ = select.select([self._listener], [], [],
+                                         self.poll_interval)
+          if readable:
+            self._DispatchConnection()
+        else:
+          time.sleep(self.poll_interval)
+
+        self._RestartExitedProcesses()
+    except KeyboardInterrupt:
+      print "Caught keyboard interrupt, stopping"
+    finally:
+      for pid in self._pids:
+        try:
+          os.kill(pid, signal.SIGTERM)
+        except OSError:
+          pass
+
+
+def main(argv):
+  """Main."""
+  del argv  # Unused.
+  config.CONFIG.AddContext("HTTPServer Context")
+
+  # The number of processes has to be known before anything else is
+  # initialized, everything else is initialized after forking.
+  config_lib.SetPlatformArchContext()
+  config_lib.ParseConfigCommandLine()
+
+  processes = config.CONFIG["Frontend.processes"]
+  if processes > 1:
+    FrontendProcessPool(
+        processes, affinity=config.CONFIG["Frontend.process_affinity"]).Run()
+  else:
+    RunFrontendProcess()
 
 
 if __name__ == "__main__":
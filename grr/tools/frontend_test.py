@@ -13,6 +13,7 @@ import requests
 
 from google.protobuf import json_format
 
+from grr_response_client import comms
 from grr.lib import flags
 from grr.lib import utils
 from grr.lib.rdfvalues import file_finder as rdf_file_finder
@@ -53,8 +54,7 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     # Bring up a local server for testing.
     port = portpicker.PickUnusedPort()
     ip = utils.ResolveHostnameToIP("localhost", port)
-    cls.httpd = frontend.GRRHTTPServer((ip, port),
-                                       frontend.GRRHTTPServerHandler)
+    cls.httpd = cls._CreateServer((ip, port))
 
     if ipaddr.IPAddress(ip).version == 6:
       cls.address_family = socket.AF_INET6
@@ -67,9 +67,15 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     cls.httpd_thread.daemon = True
     cls.httpd_thread.start()
 
+  @classmethod
+  def _CreateServer(cls, server_address):
+    return frontend.GRRHTTPServer(server_address,
+                                  frontend.GRRHTTPServerHandler)
+
   @classmethod
   def tearDownClass(cls):
     cls.httpd.shutdown()
+    cls.httpd.frontend.Stop()
     cls.config_overrider.Stop()
 
   def setUp(self):
@@ -281,6 +287,80 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     self.assertEqual(profile.data[:2], "\x1f\x8b")
 
 
+class GRREventLoopHTTPServerTest(GRRHTTPServerTest):
+  """Runs the http server tests against the event loop server."""
+
+  @classmethod
+  def _CreateServer(cls, server_address):
+    return frontend.GRREventLoopHTTPServer(server_address, max_workers=4)
+
+  def testKeepAliveConnectionsAreReused(self):
+    accepted_connections = self.httpd.accepted_connections
+
+    session = requests.Session()
+    for _ in range(3):
+      req = session.get(self.base_url + "server.pem")
+      self.assertEqual(req.status_code, 200)
+      self.assertTrue("BEGIN CERTIFICATE" in req.content)
+
+    self.assertEqual(self.httpd.accepted_connections, accepted_connections + 1)
+
+  def testClientConnectionRate(self):
+    """Compares the connections a polling client makes with keep-alive."""
+    for keep_alive, expected_connections in [(True, 1), (False, 10)]:
+      with test_lib.ConfigOverrider({
+          "Client.server_urls": [self.base_url],
+          "Client.http_keep_alive": keep_alive
+      }):
+        manager = comms.HTTPManager()
+
+      accepted_connections = self.httpd.accepted_connections
+      for _ in range(10):
+        result = manager.OpenServerEndpoint("server.pem")
+        self.assertEqual(result.code, 200)
+
+      self.assertEqual(self.httpd.accepted_connections - accepted_connections,
+                       expected_connections)
+
+  def testConnectionIsClosedIfNotKeptAlive(self):
+    accepted_connections = self.httpd.accepted_connections
+
+    for _ in range(2):
+      req = requests.get(
+          self.base_url + "server.pem", headers={"Connection": "close"})
+      self.assertEqual(req.status_code, 200)
+      self.assertEqual(req.headers["Connection"], "close")
+
+    self.assertEqual(self.httpd.accepted_connections, accepted_connections + 2)
+
+
+class ReusePortTest(test_lib.GRRBaseTest):
+  """Tests servers sharing a port as done by the FrontendProcessPool."""
+
+  def setUp(self):
+    super(ReusePortTest, self).setUp()
+    front_end.FrontendInit().RunOnce()
+
+  def testServersCanShareAPortWithReusePort(self):
+    port = portpicker.PickUnusedPort()
+    ip = utils.ResolveHostnameToIP("localhost", port)
+
+    servers = []
+    try:
+      servers.append(
+          frontend.GRRHTTPServer(
+              (ip, port), frontend.GRRHTTPServerHandler, reuse_port=True))
+      servers.append(
+          frontend.GRREventLoopHTTPServer(
+              (ip, port), max_workers=1, reuse_port=True))
+    finally:
+      for server in servers:
+        server.server_close()
+        server.frontend.Stop()
+
+    self.assertEqual(len(servers), 2)
+
+
 def main(args):
   test_lib.main(args)
 
@@ -949,6 +949,7 @@ class GrrWorkerTest(flow_test_lib.FlowTestsBaseclass):
     ]
 
     frontend_server.ReceiveMessages(self.client_id, messages + statuses)
+    frontend_server.Stop()
 
     with queue_manager.QueueManager(token=self.token) as q:
       all_notifications = q.GetNotificationsByPriorityForAllShards(